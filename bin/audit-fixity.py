@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+run one budgeted pass of the rolling fixity audit over a directory of image packages, stalest files first, and report as json
+"""
+
+import _mypath
+import argparse
+from functools import wraps
+from isaw.images import audit
+import json
+import logging
+import os
+import re
+import sys
+import traceback
+
+DEFAULTLOGLEVEL = logging.WARNING
+
+def arglogger(func):
+    """
+    decorator to log argument calls to functions
+    """
+    @wraps(func)
+    def inner(*args, **kwargs): 
+        logger = logging.getLogger(func.__name__)
+        logger.debug("called with arguments: %s, %s" % (args, kwargs))
+        return func(*args, **kwargs) 
+    return inner    
+
+
+@arglogger
+def main (args):
+    """
+    main functions
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+
+    logger.info("beginning fixity audit run on {0}".format(args.tgt))
+    state = audit.Audit(args.state)
+    try:
+        summary = state.run(args.tgt, byte_budget=args.bytes, time_budget=args.minutes * 60 if args.minutes is not None else None, cycle_days=args.cycle)
+    finally:
+        state.close()
+    if args.output is None:
+        print json.dumps(summary, sort_keys=True, indent=4)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, sort_keys=True, indent=4)
+        logger.info("wrote audit summary on {0}".format(args.output))
+    logger.info("verified {0} files ({1} bytes); {2} failed, {3} still overdue".format(summary['files_verified'], summary['bytes_verified'], len(summary['failures']), summary['overdue']))
+    return len(summary['failures']) == 0
+
+
+if __name__ == "__main__":
+    log_level = DEFAULTLOGLEVEL
+    log_level_name = logging.getLevelName(log_level)
+    logging.basicConfig(level=log_level)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument ("-l", "--loglevel", type=str, help="desired logging level (case-insensitive string: DEBUG, INFO, WARNING, ERROR" )
+        parser.add_argument ("-v", "--verbose", action="store_true", default=False, help="verbose output (logging level == INFO")
+        parser.add_argument ("-vv", "--veryverbose", action="store_true", default=False, help="very verbose output (logging level == DEBUG")
+        parser.add_argument ("-s", "--state", type=str, required=True, help="path of the audit state database to consult and update")
+        parser.add_argument ("-b", "--bytes", type=int, default=None, help="most bytes to read this run (default: the collection's size divided by --cycle)")
+        parser.add_argument ("-m", "--minutes", type=float, default=None, help="most minutes to spend this run")
+        parser.add_argument ("-c", "--cycle", type=int, default=audit.CYCLE_DAYS, help="days over which the whole collection should be verified once")
+        parser.add_argument ("-o", "--output", type=str, default=None, help="path of json summary file to write (default: standard output)")
+        parser.add_argument('tgt', help='target directory containing image packages')
+        args = parser.parse_args()
+        if args.loglevel is not None:
+            args_log_level = re.sub('\s+', '', args.loglevel.strip().upper())
+            try:
+                log_level = getattr(logging, args_log_level)
+            except AttributeError:
+                logging.error("command line option to set log_level failed because '%s' is not a valid level name; using %s" % (args_log_level, log_level_name))
+        if args.veryverbose:
+            log_level = logging.DEBUG
+        elif args.verbose:
+            log_level = logging.INFO
+        log_level_name = logging.getLevelName(log_level)
+        logging.getLogger().setLevel(log_level)
+        if log_level != DEFAULTLOGLEVEL:
+            logging.warning("logging level changed to %s via command line option" % log_level_name)
+        else:
+            logging.info("using default logging level: %s" % log_level_name)
+        logging.debug("command line: '%s'" % ' '.join(sys.argv))
+        if main(args):
+            sys.exit(0)
+        sys.exit(2)
+    except KeyboardInterrupt, e: # Ctrl-C
+        raise e
+    except SystemExit, e: # sys.exit()
+        raise e
+    except Exception, e:
+        print "ERROR, UNEXPECTED EXCEPTION"
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
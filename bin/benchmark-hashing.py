@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmark throughput and peak memory of file hashing on large synthetic TIFFs
+"""
+
+import _mypath
+import argparse
+from functools import wraps
+import hashlib
+from isaw.images import filehashing
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import traceback
+
+DEFAULTLOGLEVEL = logging.WARNING
+
+def arglogger(func):
+    """
+    decorator to log argument calls to functions
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        logger = logging.getLogger(func.__name__)
+        logger.debug("called with arguments: %s, %s" % (args, kwargs))
+        return func(*args, **kwargs)
+    return inner
+
+
+def legacy_hash_of_file(filepath):
+    """
+    the original whole-file implementation of filehashing.hash_of_file, for comparison
+    """
+    with open(filepath, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+@arglogger
+def write_synthetic_tiff(path, megabytes):
+    """
+    write an uncompressed 8-bit RGB TIFF of roughly the requested size, streaming
+    random pixel data to disk so that generating it does not itself need the RAM
+    """
+    width = 8192
+    height = max(1, (megabytes * 1024 * 1024) // (width * 3))
+    strip_bytes = width * 3
+    header_size = 8
+    data_size = strip_bytes * height
+    ifd_offset = header_size + data_size
+    if ifd_offset % 2:
+        ifd_offset += 1
+    entries = [
+        (256, 4, 1, width),          # ImageWidth
+        (257, 4, 1, height),         # ImageLength
+        (258, 3, 1, 8),              # BitsPerSample (same for all samples)
+        (259, 3, 1, 1),              # Compression: none
+        (262, 3, 1, 2),              # PhotometricInterpretation: RGB
+        (273, 4, 1, header_size),    # StripOffsets (one strip)
+        (277, 3, 1, 3),              # SamplesPerPixel
+        (278, 4, 1, height),         # RowsPerStrip
+        (279, 4, 1, data_size),      # StripByteCounts
+        (284, 3, 1, 1),              # PlanarConfiguration: chunky
+    ]
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<2sHI', b'II', 42, ifd_offset))
+        remaining = data_size
+        while remaining > 0:
+            n = min(remaining, filehashing.CHUNK_SIZE)
+            f.write(os.urandom(n))
+            remaining -= n
+        if f.tell() < ifd_offset:
+            f.write(b'\0')
+        f.write(struct.pack('<H', len(entries)))
+        for tag, tagtype, count, value in entries:
+            if tagtype == 3:
+                f.write(struct.pack('<HHIHH', tag, tagtype, count, value, 0))
+            else:
+                f.write(struct.pack('<HHII', tag, tagtype, count, value))
+        f.write(struct.pack('<I', 0))
+    return os.path.getsize(path)
+
+
+def run_measurement(queue, method, path, chunk_size):
+    """
+    hash path in a fresh child process and report elapsed time and peak RSS
+    """
+    start = time.time()
+    if method == 'legacy':
+        digest = legacy_hash_of_file(path)
+    elif method == 'stream':
+        digest = filehashing.hash_of_file(path, chunk_size=chunk_size)
+    elif method == 'mmap':
+        digest = filehashing.hash_of_file(path, chunk_size=chunk_size, use_mmap=True)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024 # linux reports kilobytes, mac reports bytes
+    queue.put((digest, elapsed, peak))
+
+
+@arglogger
+def measure(method, path, chunk_size):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_measurement, args=(queue, method, path, chunk_size))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+@arglogger
+def main (args):
+    """
+    main functions
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+
+    workdir = tempfile.mkdtemp(prefix='isaw-hash-bench-', dir=args.dir)
+    try:
+        print "{0:>8} {1:>8} {2:>12} {3:>10} {4:>12}  {5}".format('size MB', 'method', 'chunk', 'MB/s', 'peak RSS MB', 'sha1')
+        for megabytes in args.sizes:
+            path = os.path.join(workdir, 'synthetic-{0}.tif'.format(megabytes))
+            size = write_synthetic_tiff(path, megabytes)
+            logger.info("wrote synthetic tiff of {0} bytes on {1}".format(size, path))
+            digests = set()
+            for method in args.methods:
+                for chunk_size in (args.chunks if method != 'legacy' else [0]):
+                    digest, elapsed, peak = measure(method, path, chunk_size)
+                    digests.add(digest)
+                    rate = (size / 1048576.0) / elapsed if elapsed > 0 else float('inf')
+                    print "{0:>8} {1:>8} {2:>12} {3:>10.1f} {4:>12.1f}  {5}".format(megabytes, method, chunk_size or '-', rate, peak / 1048576.0, digest)
+            if len(digests) != 1:
+                logger.error("hash methods disagree on {0}: {1}".format(path, sorted(digests)))
+            os.remove(path)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    log_level = DEFAULTLOGLEVEL
+    log_level_name = logging.getLevelName(log_level)
+    logging.basicConfig(level=log_level)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument ("-l", "--loglevel", type=str, help="desired logging level (case-insensitive string: DEBUG, INFO, WARNING, ERROR" )
+        parser.add_argument ("-v", "--verbose", action="store_true", default=False, help="verbose output (logging level == INFO")
+        parser.add_argument ("-vv", "--veryverbose", action="store_true", default=False, help="very verbose output (logging level == DEBUG")
+        parser.add_argument ("-d", "--dir", type=str, default=None, help="directory in which to write the synthetic tiffs (default: system temp)")
+        parser.add_argument ("-s", "--sizes", type=int, nargs='+', default=[64, 512, 2048], help="sizes of synthetic tiffs to test, in megabytes")
+        parser.add_argument ("-c", "--chunks", type=int, nargs='+', default=[filehashing.CHUNK_SIZE], help="chunk sizes to test for the streaming and mmap methods, in bytes")
+        parser.add_argument ("-m", "--methods", type=str, nargs='+', default=['legacy', 'stream', 'mmap'], choices=['legacy', 'stream', 'mmap'], help="hashing methods to compare")
+        args = parser.parse_args()
+        if args.loglevel is not None:
+            args_log_level = re.sub('\s+', '', args.loglevel.strip().upper())
+            try:
+                log_level = getattr(logging, args_log_level)
+            except AttributeError:
+                logging.error("command line option to set log_level failed because '%s' is not a valid level name; using %s" % (args_log_level, log_level_name))
+        if args.veryverbose:
+            log_level = logging.DEBUG
+        elif args.verbose:
+            log_level = logging.INFO
+        log_level_name = logging.getLevelName(log_level)
+        logging.getLogger().setLevel(log_level)
+        if log_level != DEFAULTLOGLEVEL:
+            logging.warning("logging level changed to %s via command line option" % log_level_name)
+        else:
+            logging.info("using default logging level: %s" % log_level_name)
+        logging.debug("command line: '%s'" % ' '.join(sys.argv))
+        main(args)
+        sys.exit(0)
+    except KeyboardInterrupt, e: # Ctrl-C
+        raise e
+    except SystemExit, e: # sys.exit()
+        raise e
+    except Exception, e:
+        print "ERROR, UNEXPECTED EXCEPTION"
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
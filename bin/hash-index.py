@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+index the content hashes of a collection of image packages and query the index for duplicates, as json
+"""
+
+import _mypath
+import argparse
+from functools import wraps
+from isaw.images import hashindex
+import json
+import logging
+import os
+import re
+import sys
+import traceback
+
+DEFAULTLOGLEVEL = logging.WARNING
+
+def arglogger(func):
+    """
+    decorator to log argument calls to functions
+    """
+    @wraps(func)
+    def inner(*args, **kwargs): 
+        logger = logging.getLogger(func.__name__)
+        logger.debug("called with arguments: %s, %s" % (args, kwargs))
+        return func(*args, **kwargs) 
+    return inner    
+
+
+@arglogger
+def main (args):
+    """
+    main functions
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+
+    index = hashindex.HashIndex(args.database)
+    try:
+        if args.tgt is not None:
+            logger.info("indexing manifests of packages under {0}".format(args.tgt))
+            index.index_collection(args.tgt)
+        result = {}
+        if args.find is not None:
+            result['found'] = index.find(args.find, args.algorithm, not args.all)
+        if args.duplicates:
+            result['duplicates'] = index.duplicates(args.algorithm, not args.all)
+    finally:
+        index.close()
+    if args.find is not None or args.duplicates:
+        print json.dumps(result, sort_keys=True, indent=4)
+    return len(result.get('found', [])) == 0 and len(result.get('duplicates', {})) == 0
+
+
+if __name__ == "__main__":
+    log_level = DEFAULTLOGLEVEL
+    log_level_name = logging.getLevelName(log_level)
+    logging.basicConfig(level=log_level)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument ("-l", "--loglevel", type=str, help="desired logging level (case-insensitive string: DEBUG, INFO, WARNING, ERROR" )
+        parser.add_argument ("-v", "--verbose", action="store_true", default=False, help="verbose output (logging level == INFO")
+        parser.add_argument ("-vv", "--veryverbose", action="store_true", default=False, help="very verbose output (logging level == DEBUG")
+        parser.add_argument ("-d", "--database", type=str, required=True, help="path of the hash index database to query and update")
+        parser.add_argument ("-f", "--find", type=str, default=None, help="list the packages holding an original with this digest")
+        parser.add_argument ("-u", "--duplicates", action="store_true", default=False, help="list originals held by more than one package")
+        parser.add_argument ("-a", "--all", action="store_true", default=False, help="with --find or --duplicates, consider every file rather than only originals")
+        parser.add_argument ("-g", "--algorithm", type=str, default='sha1', help="hash algorithm of the digests to query")
+        parser.add_argument('tgt', nargs='?', default=None, help='target directory containing image packages to (re)index before querying')
+        args = parser.parse_args()
+        if args.loglevel is not None:
+            args_log_level = re.sub('\s+', '', args.loglevel.strip().upper())
+            try:
+                log_level = getattr(logging, args_log_level)
+            except AttributeError:
+                logging.error("command line option to set log_level failed because '%s' is not a valid level name; using %s" % (args_log_level, log_level_name))
+        if args.veryverbose:
+            log_level = logging.DEBUG
+        elif args.verbose:
+            log_level = logging.INFO
+        log_level_name = logging.getLevelName(log_level)
+        logging.getLogger().setLevel(log_level)
+        if log_level != DEFAULTLOGLEVEL:
+            logging.warning("logging level changed to %s via command line option" % log_level_name)
+        else:
+            logging.info("using default logging level: %s" % log_level_name)
+        logging.debug("command line: '%s'" % ' '.join(sys.argv))
+        if main(args):
+            sys.exit(0)
+        sys.exit(2)
+    except KeyboardInterrupt, e: # Ctrl-C
+        raise e
+    except SystemExit, e: # sys.exit()
+        raise e
+    except Exception, e:
+        print "ERROR, UNEXPECTED EXCEPTION"
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+create image packages for a batch of originals, with the stages of package creation pipelined across worker processes, and report as json
+"""
+
+import _mypath
+import argparse
+from functools import wraps
+from isaw.images import ingest
+import json
+import logging
+import os
+import re
+import sys
+import traceback
+
+DEFAULTLOGLEVEL = logging.WARNING
+
+def arglogger(func):
+    """
+    decorator to log argument calls to functions
+    """
+    @wraps(func)
+    def inner(*args, **kwargs): 
+        logger = logging.getLogger(func.__name__)
+        logger.debug("called with arguments: %s, %s" % (args, kwargs))
+        return func(*args, **kwargs) 
+    return inner    
+
+
+@arglogger
+def main (args):
+    """
+    main functions
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+
+    originals = []
+    for tgt in args.tgt:
+        if os.path.isdir(tgt):
+            originals.extend(ingest.find_originals(tgt))
+        else:
+            originals.append(tgt)
+    workers = {}
+    if args.workers is not None:
+        for pair in args.workers.split(','):
+            stage, count = pair.split('=')
+            workers[stage.strip()] = int(count)
+    algorithms = [a.strip() for a in args.algorithms.split(',')] if args.algorithms is not None else None
+    logger.info("beginning ingest of {0} original(s) into {1}".format(len(originals), args.destination))
+    summary = ingest.ingest(originals, args.destination, workers=workers, queue_size=args.queue, algorithms=algorithms, index_path=args.index, pyramid=args.pyramid or None)
+    if args.output is None:
+        print json.dumps(summary, sort_keys=True, indent=4)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, sort_keys=True, indent=4)
+        logger.info("wrote ingest summary on {0}".format(args.output))
+    logger.info("created {0}, failed {1} of {2} packages".format(summary['created'], summary['failed'], summary['originals']))
+    return summary['failed'] == 0
+
+
+if __name__ == "__main__":
+    log_level = DEFAULTLOGLEVEL
+    log_level_name = logging.getLevelName(log_level)
+    logging.basicConfig(level=log_level)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument ("-l", "--loglevel", type=str, help="desired logging level (case-insensitive string: DEBUG, INFO, WARNING, ERROR" )
+        parser.add_argument ("-v", "--verbose", action="store_true", default=False, help="verbose output (logging level == INFO")
+        parser.add_argument ("-vv", "--veryverbose", action="store_true", default=False, help="very verbose output (logging level == DEBUG")
+        parser.add_argument ("-d", "--destination", type=str, required=True, help="directory in which to create the packages")
+        parser.add_argument ("-w", "--workers", type=str, default=None, help="worker processes per stage, e.g. 'original=2,master=8,derivatives=8,metadata=1' (default: see ingest.WORKERS)")
+        parser.add_argument ("-q", "--queue", type=int, default=ingest.QUEUE_SIZE, help="most originals waiting in front of each stage")
+        parser.add_argument ("-a", "--algorithms", type=str, default=None, help="comma-separated manifest hash algorithms, e.g. 'sha1,sha256' (default: package.MANIFEST_ALGORITHMS)")
+        parser.add_argument ("-i", "--index", type=str, default=None, help="path of a hash index database, to reject originals already ingested")
+        parser.add_argument ("-p", "--pyramid", action="store_true", default=False, help="also write a pyramidal tiff of each master")
+        parser.add_argument ("-o", "--output", type=str, default=None, help="path of json summary file to write (default: standard output)")
+        parser.add_argument('tgt', nargs='+', help='original image files, or directories to search for them')
+        args = parser.parse_args()
+        if args.loglevel is not None:
+            args_log_level = re.sub('\s+', '', args.loglevel.strip().upper())
+            try:
+                log_level = getattr(logging, args_log_level)
+            except AttributeError:
+                logging.error("command line option to set log_level failed because '%s' is not a valid level name; using %s" % (args_log_level, log_level_name))
+        if args.veryverbose:
+            log_level = logging.DEBUG
+        elif args.verbose:
+            log_level = logging.INFO
+        log_level_name = logging.getLevelName(log_level)
+        logging.getLogger().setLevel(log_level)
+        if log_level != DEFAULTLOGLEVEL:
+            logging.warning("logging level changed to %s via command line option" % log_level_name)
+        else:
+            logging.info("using default logging level: %s" % log_level_name)
+        logging.debug("command line: '%s'" % ' '.join(sys.argv))
+        if main(args):
+            sys.exit(0)
+        sys.exit(2)
+    except KeyboardInterrupt, e: # Ctrl-C
+        raise e
+    except SystemExit, e: # sys.exit()
+        raise e
+    except Exception, e:
+        print "ERROR, UNEXPECTED EXCEPTION"
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
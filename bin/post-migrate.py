@@ -7,7 +7,7 @@ script to run after running migrate.sh
 import _mypath
 import argparse
 from functools import wraps
-from isaw.images import package, proof_sheet, validate_path
+from isaw.images import fixity, package, proof_sheet, validate_path
 import logging
 import os
 import re
@@ -41,20 +41,25 @@ def main (args):
     # get a list of all the directories at path, determine which are image packages, open and validate
     directories = [o for o in os.listdir(real_path) if os.path.isdir(os.path.join(real_path,o))]
     logger.debug("found {0} sub-directories".format(len(directories)))
+    if args.cache is not None:
+        cache = fixity.FixityCache(args.cache)
+    else:
+        cache = None
     for d in directories:
         pkg = package.Package()
         try:
-            pkg.open(os.path.join(real_path,d))
+            pkg.open(os.path.join(real_path,d), readonly=True)
         except IOError, e:
             logger.info("failed trying to open directory '{0}' as a package: {1}".format(d, e))
         else:
-            if pkg.validate():
+            if pkg.validate(cache, args.trustdays):
                 logger.info("directory '{0}' is a valid image package".format(d))
                 pass
             else:
                 logger.warning("successfully opened directory '{0}' as a package, but it failed to validate".format(d))
         del pkg
-    proof_sheet.Proof(real_path)
+    # the proof sheet validates every package again; with a cache it can trust what we just verified
+    proof_sheet.Proof(real_path, cache, args.trustdays if cache is not None else None)
     logger.info("wrote proof sheet on {0}".format(os.path.join(real_path, 'index.html')))
     logger.info("finished post-migration on {0}".format(real_path))
 
@@ -69,6 +74,8 @@ if __name__ == "__main__":
         parser.add_argument ("-l", "--loglevel", type=str, help="desired logging level (case-insensitive string: DEBUG, INFO, WARNING, ERROR" )
         parser.add_argument ("-v", "--verbose", action="store_true", default=False, help="verbose output (logging level == INFO")
         parser.add_argument ("-vv", "--veryverbose", action="store_true", default=False, help="very verbose output (logging level == DEBUG")
+        parser.add_argument ("-c", "--cache", type=str, default=None, help="path of a fixity cache database to consult and update during validation")
+        parser.add_argument ("-t", "--trustdays", type=float, default=None, help="with --cache, trust files unchanged since verification within this many days instead of rehashing them")
         parser.add_argument('tgt', help='target directory in which to run post-migration')
         args = parser.parse_args()
         if args.loglevel is not None:
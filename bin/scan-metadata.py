@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+read selected metadata fields from the meta.xml of every package under one or more directories, in parallel, and write one json record per package per line
+"""
+
+import _mypath
+import argparse
+from functools import wraps
+from isaw.images import metascan
+import json
+import logging
+import os
+import re
+import sys
+import traceback
+
+DEFAULTLOGLEVEL = logging.WARNING
+
+def arglogger(func):
+    """
+    decorator to log argument calls to functions
+    """
+    @wraps(func)
+    def inner(*args, **kwargs): 
+        logger = logging.getLogger(func.__name__)
+        logger.debug("called with arguments: %s, %s" % (args, kwargs))
+        return func(*args, **kwargs) 
+    return inner    
+
+
+@arglogger
+def main (args):
+    """
+    main functions
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+
+    packages = []
+    for tgt in args.tgt:
+        packages.extend(metascan.find_packages(tgt))
+    fields = [f.strip() for f in args.fields.split(',')] if args.fields is not None else None
+    logger.info("scanning metadata of {0} package(s)".format(len(packages)))
+    if args.output is None:
+        out = sys.stdout
+    else:
+        out = open(args.output, 'w')
+    failed = 0
+    try:
+        for record in metascan.scan(packages, fields, workers=args.workers):
+            if 'error' in record.keys():
+                logger.warning("could not read metadata of package '{0}': {1}".format(record['id'], record['error']))
+                failed += 1
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        if args.output is not None:
+            out.close()
+            logger.info("wrote metadata records on {0}".format(args.output))
+    logger.info("scanned {0} package(s), {1} unreadable".format(len(packages), failed))
+    return failed == 0
+
+
+if __name__ == "__main__":
+    log_level = DEFAULTLOGLEVEL
+    log_level_name = logging.getLevelName(log_level)
+    logging.basicConfig(level=log_level)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument ("-l", "--loglevel", type=str, help="desired logging level (case-insensitive string: DEBUG, INFO, WARNING, ERROR" )
+        parser.add_argument ("-v", "--verbose", action="store_true", default=False, help="verbose output (logging level == INFO")
+        parser.add_argument ("-vv", "--veryverbose", action="store_true", default=False, help="very verbose output (logging level == DEBUG")
+        parser.add_argument ("-f", "--fields", type=str, default=None, help="comma-separated fields to read, e.g. 'status,title,photographer:name' (default: see metascan.FIELDS)")
+        parser.add_argument ("-w", "--workers", type=int, default=metascan.WORKERS, help="worker processes reading meta.xml files")
+        parser.add_argument ("-o", "--output", type=str, default=None, help="path of json lines file to write (default: standard output)")
+        parser.add_argument('tgt', nargs='+', help='directories to search for image packages')
+        args = parser.parse_args()
+        if args.loglevel is not None:
+            args_log_level = re.sub('\s+', '', args.loglevel.strip().upper())
+            try:
+                log_level = getattr(logging, args_log_level)
+            except AttributeError:
+                logging.error("command line option to set log_level failed because '%s' is not a valid level name; using %s" % (args_log_level, log_level_name))
+        if args.veryverbose:
+            log_level = logging.DEBUG
+        elif args.verbose:
+            log_level = logging.INFO
+        log_level_name = logging.getLevelName(log_level)
+        logging.getLogger().setLevel(log_level)
+        if log_level != DEFAULTLOGLEVEL:
+            logging.warning("logging level changed to %s via command line option" % log_level_name)
+        else:
+            logging.info("using default logging level: %s" % log_level_name)
+        logging.debug("command line: '%s'" % ' '.join(sys.argv))
+        if main(args):
+            sys.exit(0)
+        sys.exit(2)
+    except KeyboardInterrupt, e: # Ctrl-C
+        raise e
+    except SystemExit, e: # sys.exit()
+        raise e
+    except Exception, e:
+        print "ERROR, UNEXPECTED EXCEPTION"
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+verify fixity of every image package in a directory, in parallel, and report failures as json
+"""
+
+import _mypath
+import argparse
+from functools import wraps
+from isaw.images import fixity
+import json
+import logging
+import os
+import re
+import sys
+import traceback
+
+DEFAULTLOGLEVEL = logging.WARNING
+
+def arglogger(func):
+    """
+    decorator to log argument calls to functions
+    """
+    @wraps(func)
+    def inner(*args, **kwargs): 
+        logger = logging.getLogger(func.__name__)
+        logger.debug("called with arguments: %s, %s" % (args, kwargs))
+        return func(*args, **kwargs) 
+    return inner    
+
+
+@arglogger
+def main (args):
+    """
+    main functions
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+
+    logger.info("beginning fixity verification on {0}".format(args.tgt))
+    report = fixity.verify_collection(args.tgt, workers=args.workers, io_limit=args.iolimit, cache_path=args.cache, trust_days=args.trustdays)
+    if args.output is None:
+        print json.dumps(report, sort_keys=True, indent=4)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, sort_keys=True, indent=4)
+        logger.info("wrote fixity report on {0}".format(args.output))
+    logger.info("verified {0} files ({1} trusted from the cache) in {2} packages; {3} packages failed".format(report['files_checked'], report['files_trusted'], report['packages'], report['packages_failed']))
+    return report['packages_failed'] == 0
+
+
+if __name__ == "__main__":
+    log_level = DEFAULTLOGLEVEL
+    log_level_name = logging.getLevelName(log_level)
+    logging.basicConfig(level=log_level)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument ("-l", "--loglevel", type=str, help="desired logging level (case-insensitive string: DEBUG, INFO, WARNING, ERROR" )
+        parser.add_argument ("-v", "--verbose", action="store_true", default=False, help="verbose output (logging level == INFO")
+        parser.add_argument ("-vv", "--veryverbose", action="store_true", default=False, help="very verbose output (logging level == DEBUG")
+        parser.add_argument ("-w", "--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+        parser.add_argument ("-i", "--iolimit", type=int, default=None, help="maximum number of files read at once across all workers (default: no limit)")
+        parser.add_argument ("-c", "--cache", type=str, default=None, help="path of a fixity cache database to consult and update")
+        parser.add_argument ("-t", "--trustdays", type=float, default=None, help="with --cache, trust files unchanged since verification within this many days instead of rehashing them")
+        parser.add_argument ("-o", "--output", type=str, default=None, help="path of json report file to write (default: standard output)")
+        parser.add_argument('tgt', help='target directory containing image packages')
+        args = parser.parse_args()
+        if args.loglevel is not None:
+            args_log_level = re.sub('\s+', '', args.loglevel.strip().upper())
+            try:
+                log_level = getattr(logging, args_log_level)
+            except AttributeError:
+                logging.error("command line option to set log_level failed because '%s' is not a valid level name; using %s" % (args_log_level, log_level_name))
+        if args.veryverbose:
+            log_level = logging.DEBUG
+        elif args.verbose:
+            log_level = logging.INFO
+        log_level_name = logging.getLevelName(log_level)
+        logging.getLogger().setLevel(log_level)
+        if log_level != DEFAULTLOGLEVEL:
+            logging.warning("logging level changed to %s via command line option" % log_level_name)
+        else:
+            logging.info("using default logging level: %s" % log_level_name)
+        logging.debug("command line: '%s'" % ' '.join(sys.argv))
+        if main(args):
+            sys.exit(0)
+        sys.exit(2)
+    except KeyboardInterrupt, e: # Ctrl-C
+        raise e
+    except SystemExit, e: # sys.exit()
+        raise e
+    except Exception, e:
+        print "ERROR, UNEXPECTED EXCEPTION"
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+rolling fixity audit: verify a little of the collection each run, stalest files first
+"""
+
+from arglogger import arglogger
+import datetime
+from filehashing import hash_of_file
+from fixity import DAY, find_packages
+import logging
+import manifest # part of isaw.images
+import os
+import sqlite3
+import sys
+import time
+
+# how long a full pass over the collection should take, unless told otherwise
+CYCLE_DAYS = 30
+
+# sql condition selecting the rows for packages under one root directory; a plain
+# prefix comparison, since LIKE would treat '_' and '%' in paths as wildcards
+UNDER = "substr(package_path, 1, length(?)) = ?"
+
+def __under__(root):
+    prefix = os.path.join(root, '')
+    return (prefix, prefix)
+
+class Audit():
+    """
+    a small local state store recording when each managed file was last verified,
+    and a scheduler that spends a per-run budget on the stalest files
+    """
+
+    @arglogger
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "package_path TEXT, filename TEXT, algorithm TEXT, digest TEXT, size INTEGER, "
+            "last_verified REAL, last_result TEXT, PRIMARY KEY (package_path, filename))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS files_staleness ON files (last_verified)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "started REAL, finished REAL, root TEXT, files INTEGER, bytes INTEGER, failures INTEGER)")
+        self.connection.commit()
+
+    @arglogger
+    def refresh(self, path):
+        """
+        bring the state store in line with the manifests of the packages under path
+
+        new files are added as never verified; files whose manifest entry changed
+        are marked never verified; files no longer listed are dropped
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        package_paths, others = find_packages(path)
+        root = os.path.realpath(path)
+        known = {}
+        for package_path, filename, digest in self.connection.execute(
+                "SELECT package_path, filename, digest FROM files WHERE " + UNDER, __under__(root)):
+            known[(package_path, filename)] = digest
+        seen = set()
+        for package_path in package_paths:
+            manifests = manifest.find_manifests(package_path)
+            if len(manifests) == 0:
+                logger.warning("no supported manifest found in {0}".format(package_path))
+                continue
+            algorithm = manifest.preferred_algorithm(manifests.keys())
+            for filename, digest in manifests[algorithm].get_all().items():
+                seen.add((package_path, filename))
+                if known.get((package_path, filename)) == digest:
+                    continue
+                try:
+                    size = os.path.getsize(os.path.join(package_path, filename))
+                except OSError:
+                    size = 0
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO files (package_path, filename, algorithm, digest, size, last_verified, last_result) VALUES (?, ?, ?, ?, ?, NULL, NULL)",
+                    (package_path, filename, algorithm, digest, size))
+        gone = [k for k in known.keys() if k not in seen]
+        for package_path, filename in gone:
+            self.connection.execute("DELETE FROM files WHERE package_path=? AND filename=?", (package_path, filename))
+        self.connection.commit()
+        logger.info("tracking {0} files in {1} packages under {2}".format(len(seen), len(package_paths), root))
+        return len(seen)
+
+    @arglogger
+    def run(self, path, byte_budget=None, time_budget=None, cycle_days=CYCLE_DAYS, refresh=True):
+        """
+        verify the stalest files under path until the run's budget is spent
+
+        byte_budget caps the bytes read and time_budget the seconds spent; with
+        neither, the run reads its share of the collection for one day of a
+        cycle_days cycle. at least one file is verified per run. returns a summary
+        dict that can be serialized as json
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        if refresh:
+            self.refresh(path)
+        root = os.path.realpath(path)
+        total_files, total_bytes = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE " + UNDER, __under__(root)).fetchone()
+        if byte_budget is None and time_budget is None:
+            byte_budget = -(-total_bytes // cycle_days) # ceiling
+        started = time.time()
+        summary = {
+            'root': root,
+            'started': datetime.datetime.utcfromtimestamp(started).isoformat() + 'Z',
+            'byte_budget': byte_budget,
+            'time_budget': time_budget,
+            'cycle_days': cycle_days,
+            'files_verified': 0,
+            'bytes_verified': 0,
+            'failures': [],
+        }
+        rows = self.connection.execute(
+            "SELECT package_path, filename, algorithm, digest, size FROM files WHERE " + UNDER +
+            " ORDER BY last_verified IS NOT NULL, last_verified", __under__(root)).fetchall()
+        for package_path, filename, algorithm, digest, size in rows:
+            if summary['files_verified'] > 0:
+                if byte_budget is not None and summary['bytes_verified'] + size > byte_budget:
+                    break
+                if time_budget is not None and time.time() - started >= time_budget:
+                    break
+            filepath = os.path.join(package_path, filename)
+            try:
+                actual = hash_of_file(filepath, algorithm=algorithm)
+            except (IOError, OSError):
+                result = 'missing' if not os.path.exists(filepath) else 'unreadable'
+            else:
+                result = 'ok' if actual == digest else 'checksum mismatch'
+            if result != 'ok':
+                logger.error("fixity audit FAILED on '{0}': {1}".format(filepath, result))
+                summary['failures'].append({'package': os.path.basename(package_path), 'file': filename, 'error': result})
+            self.connection.execute(
+                "UPDATE files SET last_verified=?, last_result=? WHERE package_path=? AND filename=?",
+                (time.time(), result, package_path, filename))
+            self.connection.commit()
+            summary['files_verified'] += 1
+            summary['bytes_verified'] += size
+        finished = time.time()
+        self.connection.execute(
+            "INSERT INTO runs (started, finished, root, files, bytes, failures) VALUES (?, ?, ?, ?, ?, ?)",
+            (started, finished, root, summary['files_verified'], summary['bytes_verified'], len(summary['failures'])))
+        self.connection.commit()
+        overdue, never = self.connection.execute(
+            "SELECT COALESCE(SUM(last_verified IS NULL OR last_verified < ?), 0), COALESCE(SUM(last_verified IS NULL), 0) FROM files WHERE " + UNDER,
+            (finished - cycle_days * DAY,) + __under__(root)).fetchone()
+        summary['finished'] = datetime.datetime.utcfromtimestamp(finished).isoformat() + 'Z'
+        summary['seconds'] = round(finished - started, 3)
+        summary['collection_files'] = total_files
+        summary['collection_bytes'] = total_bytes
+        summary['never_verified'] = never
+        summary['overdue'] = overdue
+        return summary
+
+    @arglogger
+    def close(self):
+        self.connection.close()
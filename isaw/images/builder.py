@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+rebuild derivative images across a whole collection of image packages in parallel
+"""
+
+from arglogger import arglogger
+import datetime
+import derivatives # part of isaw.images
+from fixity import find_packages, MANIFEST
+from functools import partial
+import logging
+import manifest # part of isaw.images
+import multiprocessing
+import os
+import package # part of isaw.images
+import resource
+import sys
+import time
+
+# packages a worker builds before it is replaced by a fresh process, so that
+# memory fragmented by huge images is handed back to the system
+TASKS_PER_WORKER = 50
+
+@arglogger
+def derivatives_current(package_path):
+    """
+    true if every registered derivative (see derivatives.PROFILES) was made from the current master with its current profile settings
+    """
+    try:
+        entries = manifest.Manifest(os.path.join(package_path, MANIFEST)).get_all()
+    except IOError:
+        return False
+    return len(derivatives.stale(package_path, entries)) == 0
+
+def __init_worker__(memory_limit=None):
+    # cap this worker's address space; a package that needs more fails with
+    # MemoryError instead of pushing the whole machine into swap
+    if memory_limit is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+def build_package(package_path, force=False):
+    """
+    rebuild one package's stale derivatives, or all of them if force is set
+
+    the package is checked read-only, and opened for writing (which also
+    rewrites its index.html) only if there is something to build. returns
+    (package id, 'built' or 'skipped' or 'failed', error message or None,
+    seconds spent, bytes of master.tif processed)
+    """
+    package_id = os.path.basename(package_path)
+    started = time.time()
+    try:
+        pkg = package.Package()
+        pkg.open(package_path, readonly=True)
+        if not force and len(derivatives.stale(pkg.path, pkg.manifest.get_all())) == 0:
+            return package_id, 'skipped', None, time.time() - started, 0
+        pkg.open(package_path)
+        built = pkg.make_derivatives(overwrite=force)
+    except MemoryError:
+        return package_id, 'failed', 'out of memory', time.time() - started, 0
+    except Exception as e:
+        return package_id, 'failed', '{0}: {1}'.format(type(e).__name__, e), time.time() - started, 0
+    if not built:
+        # another process made them while we waited for the lock
+        return package_id, 'skipped', None, time.time() - started, 0
+    return package_id, 'built', None, time.time() - started, os.path.getsize(os.path.join(package_path, 'master.tif'))
+
+@arglogger
+def build_collection(path, workers=None, memory_limit=None, force=False, tasks_per_worker=TASKS_PER_WORKER):
+    """
+    rebuild the derivatives of every package under path across a process pool
+
+    workers defaults to the number of cpus; memory_limit, if given, caps each
+    worker's address space in bytes. packages whose derivatives are current
+    are skipped unless force is set (e.g. after a change to the derivative
+    spec). returns a summary dict that can be serialized as json, with
+    failures keyed by package id
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    started = time.time()
+    package_paths, others = find_packages(path)
+    summary = {
+        'root': os.path.realpath(path),
+        'started': datetime.datetime.utcfromtimestamp(started).isoformat() + 'Z',
+        'workers': workers or multiprocessing.cpu_count(),
+        'memory_limit': memory_limit,
+        'force': force,
+        'packages': len(package_paths),
+        'other_directories': others,
+        'built': 0,
+        'skipped': 0,
+        'failed': 0,
+        'master_bytes': 0,
+        'build_seconds': 0.0,
+        'failures': {},
+    }
+    logger.info("building derivatives for {0} package(s) under {1}".format(len(package_paths), path))
+    pool = multiprocessing.Pool(workers, __init_worker__, (memory_limit,), tasks_per_worker)
+    try:
+        for package_id, status, error, seconds, nbytes in pool.imap_unordered(partial(build_package, force=force), package_paths):
+            summary[status] += 1
+            summary['build_seconds'] += seconds
+            summary['master_bytes'] += nbytes
+            if error is not None:
+                summary['failures'][package_id] = error
+                logger.warning("building derivatives FAILED for package '{0}': {1}".format(package_id, error))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    finished = time.time()
+    elapsed = finished - started
+    summary['finished'] = datetime.datetime.utcfromtimestamp(finished).isoformat() + 'Z'
+    summary['seconds'] = round(elapsed, 3)
+    summary['build_seconds'] = round(summary['build_seconds'], 3)
+    summary['packages_per_second'] = round(summary['built'] / elapsed, 3) if elapsed > 0 else None
+    summary['master_bytes_per_second'] = int(summary['master_bytes'] / elapsed) if elapsed > 0 else None
+    return summary
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+convert images between ICC profiles, caching parsed profiles and built transforms
+for the life of the process, and a strip at a time where the image is too big to
+hold twice over
+"""
+
+from arglogger import arglogger
+import hashlib
+from io import BytesIO
+import logging
+import os
+from PIL import Image
+from PIL.ImageCms import applyTransform, buildTransform, getOpenProfile, INTENT_PERCEPTUAL
+from pyramid import ifd_bytes, LONG, MODES, SHORT, UNDEFINED
+import struct
+import sys
+
+# most bytes of decoded pixels per strip; the raw, decoded, converted and encoded
+# copies of one strip are alive at once, so peak memory is a few times this
+STRIP_BYTES = 16 * 1024 * 1024
+
+# most bytes of decoded pixels that iter_strips will decode whole from an image it
+# cannot read strip by strip (e.g. a jpeg or a compressed tiff); bigger images
+# raise MemoryError instead
+DECODE_BYTES = 1024 * 1024 * 1024
+
+# bytes per sample of the pillow modes whose samples are wider than a byte
+SAMPLE_BYTES = {'I;16': 2, 'I;16B': 2}
+
+# the modes of image that can be converted, and the mode each is transformed in: 16-bit
+# gray keeps its top 8 bits, as masters have 8 bits per sample
+TRANSFORM_MODES = {
+    'L': 'L',
+    'I;16': 'L',
+    'I;16B': 'L',
+    'RGB': 'RGB',
+    'RGBA': 'RGBA',
+    'CMYK': 'CMYK',
+}
+
+# the color space of profile that pixels in each transform mode are converted from, and
+# the mode they come out in: the target profiles are rgb, so gray and cmyk become rgb.
+# gray under an rgb profile (e.g. the one assigned to untagged originals) is taken as
+# neutral rgb in that profile
+COLOR_SPACES = {
+    'L': ('GRAY', 'RGB'),
+    'RGB': ('RGB', 'RGB'),
+    'RGBA': ('RGB', 'RGBA'),
+    'CMYK': ('CMYK', 'RGB'),
+}
+
+# parsed profiles and their raw bytes keyed by digest (see identify()), the
+# digests of parsed profiles keyed by id() and of profile files keyed by path, and
+# built transforms keyed by both profiles' digests, modes and intent: batch ingest
+# meets the same few camera and scanner profiles over and over
+PROFILES = {}
+PROFILE_BYTES = {}
+DIGESTS = {}
+PROFILE_FILES = {}
+TRANSFORMS = {}
+
+# header fields that say which software last wrote a profile rather than what it
+# is (preferred cmm, platform, flags, intent, creator and profile id), as
+# (start, end) byte ranges; they are ignored when telling profiles apart
+WRITER_FIELDS = [(4, 8), (40, 48), (64, 68), (80, 100)]
+
+def identify(data):
+    """
+    a digest of the raw bytes of an ICC profile that is the same however it has been re-serialized
+    """
+    data = bytearray(data)
+    for start, end in WRITER_FIELDS:
+        data[start:end] = b'\0' * (end - start)
+    return hashlib.sha1(bytes(data)).hexdigest()
+
+def digest_of(profile):
+    # littlecms may re-serialize a profile differently once it has been used in a
+    # transform, so profiles from get_profile() keep the digest of their original bytes
+    try:
+        return DIGESTS[id(profile)]
+    except KeyError:
+        return identify(profile.tobytes())
+
+def bytes_of(profile):
+    """
+    the bytes of a profile, to embed in an image; for profiles from get_profile()
+    these are the bytes it was parsed from, whatever transforms it has been used in
+    """
+    try:
+        return PROFILE_BYTES[DIGESTS[id(profile)]]
+    except KeyError:
+        return profile.tobytes()
+
+@arglogger
+def get_profile(data=None, path=None):
+    """
+    the parsed profile for the raw bytes of an ICC profile, or for the .icc file at
+    path, parsing (and reading) it only the first time it is asked for; the same
+    profile embedded by different software yields the same object
+    """
+    if path is not None:
+        path = os.path.realpath(path)
+        digest = PROFILE_FILES.get(path)
+        if digest is not None:
+            return PROFILES[digest]
+        with open(path, 'rb') as f:
+            data = f.read()
+    digest = identify(data)
+    if path is not None:
+        PROFILE_FILES[path] = digest
+    try:
+        return PROFILES[digest]
+    except KeyError:
+        profile = PROFILES[digest] = getOpenProfile(BytesIO(data))
+        PROFILE_BYTES[digest] = data
+        DIGESTS[id(profile)] = digest # cached profiles live as long as the process, so ids are not reused
+        return profile
+
+@arglogger
+def same_profile(input_profile, output_profile):
+    """
+    true if converting between the two profiles would be a no-op because they are the same profile
+    """
+    return input_profile is output_profile or digest_of(input_profile) == digest_of(output_profile)
+
+@arglogger
+def get_transform(input_profile, output_profile, input_mode, output_mode=None, intent=INTENT_PERCEPTUAL):
+    """
+    the transform ImageCms.profileToProfile would build for these arguments, built only once
+    """
+    if output_mode is None:
+        output_mode = input_mode
+    key = (digest_of(input_profile), digest_of(output_profile), input_mode, output_mode, intent)
+    try:
+        return TRANSFORMS[key]
+    except KeyError:
+        transform = TRANSFORMS[key] = buildTransform(input_profile, output_profile, input_mode, output_mode, intent)
+        return transform
+
+def color_space(profile):
+    return profile.profile.xcolor_space.strip()
+
+def __prepare__(image, input_profile):
+    """
+    image in the mode its pixels are transformed in (see TRANSFORM_MODES and COLOR_SPACES)
+    """
+    if image.mode in ('I;16', 'I;16B'):
+        image = Image.frombytes('L', image.size, image.tobytes(), 'raw', image.mode.replace('I', 'L'))
+    if image.mode == 'L' and color_space(input_profile) != 'GRAY':
+        image = image.convert('RGB')
+    return image
+
+def __transform_for__(mode, input_profile, output_profile):
+    """
+    the transform for pixels prepared from an image in mode, or None if the
+    profiles are the same; raises ValueError for images that cannot be converted
+    """
+    if mode not in TRANSFORM_MODES.keys():
+        raise ValueError("cannot convert an image in mode '{0}'".format(mode))
+    mode = TRANSFORM_MODES[mode]
+    if mode == 'L' and color_space(input_profile) != 'GRAY':
+        mode = 'RGB'
+    if same_profile(input_profile, output_profile):
+        return None
+    space, output_mode = COLOR_SPACES[mode]
+    if color_space(input_profile) != space:
+        raise ValueError("cannot convert an image in mode '{0}' from a {1} profile".format(mode, color_space(input_profile)))
+    return get_transform(input_profile, output_profile, mode, output_mode)
+
+@arglogger
+def convert(image, input_profile, output_profile):
+    """
+    convert image between profiles as ImageCms.profileToProfile does, with a cached
+    transform, into the mode given by TRANSFORM_MODES and COLOR_SPACES; if the
+    profiles are the same, the image is returned unconverted (but for its mode)
+    """
+    transform = __transform_for__(image.mode, input_profile, output_profile)
+    image = __prepare__(image, input_profile)
+    if transform is None:
+        return image
+    return applyTransform(image, transform)
+
+@arglogger
+def decoded_bytes(image, rows=None):
+    """
+    bytes of decoded pixels in rows (default: all) rows of image
+    """
+    if rows is None:
+        rows = image.size[1]
+    return image.size[0] * rows * len(image.getbands()) * SAMPLE_BYTES.get(image.mode, 1)
+
+@arglogger
+def rows_per_strip(image, strip_bytes=STRIP_BYTES):
+    return max(1, strip_bytes // decoded_bytes(image, 1))
+
+@arglogger
+def raw_strips(image):
+    """
+    describe where an uncompressed, chunky tiff keeps its rows, so that they can
+    be read a few at a time straight from the file
+
+    returns a list of (first row, end row, file offset, bytes per row, rawmode)
+    per tiff strip, or None if the image is not stored that way
+    """
+    tags = getattr(image, 'tag_v2', None)
+    if image.format != 'TIFF' or tags is None or tags.get(284, 1) != 1 or 279 not in tags:
+        return None
+    counts = tags[279]
+    if len(counts) != len(image.tile):
+        return None
+    strips = []
+    for (decoder, box, offset, args), count in zip(image.tile, counts):
+        if decoder != 'raw' or box[0] != 0 or box[2] != image.size[0] or (len(args) > 2 and args[2] != 1):
+            return None
+        rows = box[3] - box[1]
+        strips.append((box[1], box[3], offset, count // rows, args[0]))
+    return strips
+
+def __read_rows__(image, f, strips, start, end):
+    """
+    decode rows start to end of image from the raw strips of its open file f
+    """
+    pieces = []
+    for first, last, offset, row_bytes, rawmode in strips:
+        if last <= start or first >= end:
+            continue
+        top = max(first, start)
+        bottom = min(last, end)
+        f.seek(offset + (top - first) * row_bytes)
+        pieces.append((top, Image.frombytes(image.mode, (image.size[0], bottom - top), f.read((bottom - top) * row_bytes), 'raw', rawmode, row_bytes)))
+    if len(pieces) == 1:
+        return pieces[0][1]
+    rows = Image.new(image.mode, (image.size[0], end - start))
+    for top, piece in pieces:
+        rows.paste(piece, (0, top - start))
+    return rows
+
+@arglogger
+def iter_strips(path, strip_bytes=STRIP_BYTES):
+    """
+    yield (first row, image of rows) down the image at path, each strip within strip_bytes
+
+    uncompressed tiffs are read from the file strip by strip; anything else is
+    decoded whole once and then cut into strips, if it is within DECODE_BYTES
+    decoded, or else MemoryError is raised
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    image = Image.open(path)
+    rows = rows_per_strip(image, strip_bytes)
+    strips = raw_strips(image)
+    if strips is None:
+        if decoded_bytes(image) > DECODE_BYTES:
+            raise MemoryError("{0} cannot be read a strip at a time, and decoding all {1} bytes of it would exceed DECODE_BYTES ({2})".format(path, decoded_bytes(image), DECODE_BYTES))
+        logger.info("decoding all of {0} ({1} bytes) before cutting it into strips".format(path, decoded_bytes(image)))
+        image.load()
+        for y in range(0, image.size[1], rows):
+            yield y, image.crop((0, y, image.size[0], min(y + rows, image.size[1])))
+    else:
+        with open(path, 'rb') as f:
+            for y in range(0, image.size[1], rows):
+                yield y, __read_rows__(image, f, strips, y, min(y + rows, image.size[1]))
+
+@arglogger
+def convert_to_tiff(source_path, dest_path, input_profile, output_profile, strip_bytes=STRIP_BYTES):
+    """
+    convert the image at source_path from input_profile to output_profile, writing
+    an uncompressed tiff tagged with output_profile at dest_path as it goes
+
+    the transform is the one ImageCms.profileToProfile would apply (perceptual
+    intent) and acts on each pixel alone, so the result is pixel-identical to
+    converting the image whole with convert(); as there, if the profiles are the
+    same the pixels are copied unconverted, and the modes are those given by
+    TRANSFORM_MODES and COLOR_SPACES. returns the image size
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    image = Image.open(source_path)
+    transform = __transform_for__(image.mode, input_profile, output_profile)
+    width, height = image.size
+    rows = rows_per_strip(image, strip_bytes)
+    offsets = []
+    counts = []
+    temp_path = '{0}.{1}.tmp'.format(dest_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack('<2sHI', b'II', 42, 0))
+        for y, strip in iter_strips(source_path, strip_bytes):
+            strip = __prepare__(strip, input_profile)
+            if transform is not None:
+                strip = applyTransform(strip, transform)
+            mode = strip.mode
+            data = strip.tobytes()
+            offsets.append(f.tell())
+            counts.append(len(data))
+            f.write(data)
+            if f.tell() % 2:
+                f.write(b'\0')
+        samples, photometric = MODES[mode]
+        entries = [
+            (256, LONG, [width]),                       # ImageWidth
+            (257, LONG, [height]),                      # ImageLength
+            (258, SHORT, [8] * samples),                # BitsPerSample
+            (259, SHORT, [1]),                          # Compression: none
+            (262, SHORT, [photometric]),
+            (273, LONG, offsets),                       # StripOffsets
+            (277, SHORT, [samples]),                    # SamplesPerPixel
+            (278, LONG, [rows]),                        # RowsPerStrip
+            (279, LONG, counts),                        # StripByteCounts
+            (284, SHORT, [1]),                          # PlanarConfiguration: chunky
+            (34675, UNDEFINED, bytearray(bytes_of(output_profile))),
+        ]
+        if mode == 'RGBA':
+            entries.append((338, SHORT, [2]))           # ExtraSamples: unassociated alpha
+        ifd_offset = f.tell()
+        f.write(ifd_bytes(entries, ifd_offset))
+        f.seek(4)
+        f.write(struct.pack('<I', ifd_offset))
+    os.rename(temp_path, dest_path)
+    logger.debug("converted {0} to {1} in {2} strip(s) of up to {3} rows".format(source_path, dest_path, len(offsets), rows))
+    return width, height
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+make downscaled images cheaply, decoding and copying no more of the source than needed,
+from a registry of named derivative profiles, and keep the ones made on demand in a
+size-bounded cache
+"""
+
+from arglogger import arglogger
+import json
+import logging
+import os
+from PIL import Image
+import sqlite3
+import sys
+import time
+
+# default byte budget of a DerivativeCache
+CACHE_BYTES = 1024 * 1024 * 1024
+
+# the source of every derivative chain, as named in derivative profiles
+MASTER = 'master'
+
+# unmanaged sidecar in each package recording, per derivative file, the master
+# hash and profile settings it was made from (see stale())
+PROVENANCE = 'derivatives.json'
+
+# the derivatives Package.make_derivatives() writes, by name: the box each must
+# fit within (None for full resolution), resampling filter, format and encoder
+# options, and optionally the profile (or MASTER) to make it from; use
+# register() to add more, e.g. a 2048px 'web' jpeg, which the preview and
+# thumbnail are then made from in turn
+PROFILES = {
+    'maximum': {'filename': 'maximum.jpg', 'size': None, 'format': 'JPEG', 'options': {'optimize': True, 'progressive': False, 'quality': 95}, 'resample': Image.BICUBIC, 'source': None},
+    'preview': {'filename': 'preview.jpg', 'size': (800, 600), 'format': 'JPEG', 'options': {'optimize': True, 'progressive': True, 'quality': 80}, 'resample': Image.BICUBIC, 'source': None},
+    'thumbnail': {'filename': 'thumb.jpg', 'size': (128, 128), 'format': 'JPEG', 'options': {'optimize': True, 'progressive': True, 'quality': 80}, 'resample': Image.BICUBIC, 'source': None},
+}
+
+def fit(source_size, size):
+    """
+    the size of an image of source_size scaled down, preserving aspect ratio, to
+    fit within size (the same arithmetic as Image.thumbnail)
+    """
+    x, y = source_size
+    if x > size[0]:
+        y = int(max(float(y) * size[0] / x, 1))
+        x = int(size[0])
+    if y > size[1]:
+        x = int(max(float(x) * size[1] / y, 1))
+        y = int(size[1])
+    return x, y
+
+@arglogger
+def levels(image):
+    """
+    list (frame index, size) for each resolution level in an open image
+
+    a pyramidal tiff stores reduced copies of the full frame as further pages;
+    pages that are not smaller copies of the first (e.g. unrelated images in a
+    multi-page file) are ignored
+    """
+    result = [(0, image.size)]
+    frames = getattr(image, 'n_frames', 1)
+    if frames > 1:
+        width, height = image.size
+        for i in range(1, frames):
+            image.seek(i)
+            w, h = image.size
+            if w < width and h < height and abs(float(w) / h - float(width) / height) < 0.02:
+                result.append((i, image.size))
+        image.seek(0)
+    return result
+
+@arglogger
+def open_reduced(path, size):
+    """
+    open the image at path with no more resolution than is needed to fit it within size
+
+    jpegs are decoded at 1/2, 1/4 or 1/8 scale if that is still big enough
+    (Image.draft); for files with pyramid levels, the smallest adequate level
+    is selected. either way the result may still be larger than size: pass it
+    to shrink() to finish
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    image = Image.open(path)
+    target = fit(image.size, size)
+    if image.format == 'JPEG':
+        image.draft(image.mode, target)
+    else:
+        adequate = [(w * h, i) for i, (w, h) in levels(image) if w >= target[0] and h >= target[1]]
+        index = min(adequate)[1]
+        if index != 0:
+            image.seek(index)
+    logger.debug("opened {0} at {1} for a target of {2}".format(path, image.size, target))
+    return image
+
+@arglogger
+def shrink(image, size, resample=Image.BICUBIC):
+    """
+    return a new image scaled down to fit within size
+
+    big reductions are done first by an integer factor with box averaging
+    (Image.reduce where pillow has it), which is cheap and needs no full-size
+    copy, down to within twice the target; the resampling filter only runs on
+    what is left. the source image is not modified
+    """
+    target = fit(image.size, size)
+    factor = min(image.size[0] // (target[0] * 2), image.size[1] // (target[1] * 2))
+    if factor >= 2:
+        reduce = getattr(image, 'reduce', None)
+        if reduce is not None:
+            image = reduce(factor)
+        else:
+            image = image.resize((image.size[0] // factor, image.size[1] // factor), Image.BOX)
+    if image.size != target:
+        return image.resize(target, resample)
+    if factor >= 2:
+        return image
+    return image.copy()
+
+@arglogger
+def render(path, size, resample=Image.BICUBIC):
+    """
+    make an image fitting within size from the file at path, as cheaply as the format allows
+    """
+    return shrink(open_reduced(path, size), size, resample)
+
+@arglogger
+def register(name, filename, size=None, format='JPEG', options=None, resample=Image.BICUBIC, source=None):
+    """
+    add (or replace) a named derivative profile in PROFILES
+
+    size is the box the derivative must fit within, or None for full resolution;
+    options are passed to the encoder. by default a derivative is made from the
+    smallest other profile that is still big enough (see plan()); name another
+    profile, or MASTER, as source to pin it
+    """
+    PROFILES[name] = {
+        'filename': filename,
+        'size': size,
+        'format': format,
+        'options': dict(options or {}),
+        'resample': resample,
+        'source': source,
+    }
+
+@arglogger
+def filenames(names=None):
+    """
+    the filenames of the named derivative profiles (all of them by default)
+    """
+    if names is None:
+        names = PROFILES.keys()
+    return sorted(PROFILES[name]['filename'] for name in names)
+
+def __target__(source_size, name):
+    size = PROFILES[name]['size']
+    if size is None:
+        return tuple(source_size)
+    return fit(source_size, size)
+
+@arglogger
+def plan(source_size, names=None):
+    """
+    work out how to make the named derivatives (all profiles by default) of a
+    master of source_size, each from the smallest adequate parent
+
+    a derivative without a pinned source is made from whichever of the other
+    requested derivatives (or the master) is smallest while still at least as
+    big as it, so e.g. the thumbnail is made from the preview rather than from
+    the full-resolution master. returns (name, parent, size) steps with every
+    parent before its children; pinned sources that were not asked for are
+    included as steps of their own
+    """
+    if names is None:
+        names = PROFILES.keys()
+    names = set(names)
+    unknown = [name for name in names if name not in PROFILES.keys()]
+    if len(unknown) > 0:
+        raise ValueError("unknown derivative profile(s): {0}".format(', '.join(sorted(unknown))))
+    # pull in pinned sources, and their pinned sources in turn
+    pending = list(names)
+    wanted = set(names)
+    while len(pending) > 0:
+        source = PROFILES[pending.pop()]['source']
+        if source not in (None, MASTER) and source not in wanted:
+            if source not in PROFILES.keys():
+                raise ValueError("unknown derivative profile: {0}".format(source))
+            wanted.add(source)
+            pending.append(source)
+    targets = dict((name, __target__(source_size, name)) for name in wanted)
+    parents = {}
+    for name in wanted:
+        target = targets[name]
+        source = PROFILES[name]['source']
+        if source is None:
+            candidates = [(w * h, other) for other, (w, h) in targets.items() if other in names and w >= target[0] and h >= target[1] and (w, h) != target]
+            source = min(candidates)[1] if len(candidates) > 0 else MASTER
+        elif source != MASTER and (targets[source][0] < target[0] or targets[source][1] < target[1]):
+            raise ValueError("cannot make derivative '{0}' from the smaller '{1}'".format(name, source))
+        parents[name] = source
+    steps = []
+    done = set([MASTER])
+    def visit(name, path):
+        if name in done:
+            return
+        if name in path:
+            raise ValueError("derivative profiles form a cycle: {0}".format(' -> '.join(path + [name])))
+        visit(parents[name], path + [name])
+        steps.append((name, parents[name], targets[name]))
+        done.add(name)
+    for name in sorted(wanted, key=lambda n: (-targets[n][0] * targets[n][1], n)):
+        visit(name, [])
+    return steps
+
+@arglogger
+def settings(name):
+    """
+    the settings of a derivative profile that its output depends on, as they read back from json
+    """
+    spec = dict(PROFILES[name])
+    del spec['filename']
+    return json.loads(json.dumps(spec, sort_keys=True))
+
+@arglogger
+def read_provenance(package_path):
+    """
+    the provenance records of a package's derivatives, keyed by filename; empty if there are none
+    """
+    try:
+        with open(os.path.join(package_path, PROVENANCE), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+@arglogger
+def write_provenance(package_path, records):
+    path = os.path.join(package_path, PROVENANCE)
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(records, f, sort_keys=True, indent=4)
+    os.rename(temp_path, path)
+
+@arglogger
+def provenance(name, master_digest, digest):
+    """
+    the provenance record of a derivative file with manifest digest, made by profile name from a master with master_digest
+    """
+    return {'profile': name, 'master': master_digest, 'settings': settings(name), 'digest': digest}
+
+@arglogger
+def stale(package_path, entries, names=None):
+    """
+    list the named derivative profiles (all by default) of the package at
+    package_path that need to be made again
+
+    entries are the package's sha1 manifest entries. a derivative is stale
+    unless its provenance record says it was made by the current settings of
+    its profile from the master now in the manifest, and the file the record
+    describes is still the one in the manifest
+    """
+    if names is None:
+        names = PROFILES.keys()
+    master_digest = entries.get('master.tif')
+    records = read_provenance(package_path)
+    result = []
+    for name in sorted(names):
+        filename = PROFILES[name]['filename']
+        record = records.get(filename)
+        if master_digest is None or filename not in entries.keys() or record != provenance(name, master_digest, entries[filename]):
+            result.append(name)
+    return result
+
+@arglogger
+def derive(image, names=None):
+    """
+    yield (name, image) for the named derivatives (all profiles by default) of
+    an open master image, in plan() order
+
+    the master is decoded once, and an intermediate image is kept only until
+    the last derivative made from it; full-resolution derivatives are the
+    master image itself, not copies. pinned sources that were not asked for
+    are made but not yielded
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    steps = plan(image.size, names)
+    if names is None:
+        names = PROFILES.keys()
+    children = {}
+    for name, parent, size in steps:
+        children[parent] = children.get(parent, 0) + 1
+    images = {MASTER: image}
+    del image
+    for name, parent, size in steps:
+        source = images[parent]
+        if PROFILES[name]['size'] is None:
+            derived = source
+        else:
+            derived = shrink(source, PROFILES[name]['size'], PROFILES[name]['resample'])
+        logger.debug("made derivative '{0}' at {1} from '{2}' at {3}".format(name, derived.size, parent, source.size))
+        del source
+        children[parent] -= 1
+        if children[parent] == 0:
+            del images[parent] # save RAM
+        if children.get(name, 0) > 0:
+            images[name] = derived
+        if name in names:
+            yield name, derived
+        del derived
+
+
+class DerivativeCache():
+    """
+    a directory of rendered derivative files, evicted least recently used first
+    once their total size exceeds max_bytes
+
+    entries are named by a caller-chosen key, which should identify everything
+    the rendering depends on (e.g. the source's manifest hash and the output
+    size, format and quality) so that a stale entry can never be served; a
+    small sqlite database in the directory records sizes and last use
+    """
+
+    @arglogger
+    def __init__(self, path, max_bytes=CACHE_BYTES):
+        self.path = os.path.realpath(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(os.path.join(self.path, 'cache.db'), timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.connection.commit()
+
+    def __entry_path__(self, key):
+        return os.path.join(self.path, key[0:2], key)
+
+    @arglogger
+    def get(self, key):
+        """
+        the path of the cached file for key, or None if there is none
+        """
+        filepath = self.__entry_path__(key)
+        with self.connection:
+            updated = self.connection.execute("UPDATE entries SET last_used=? WHERE key=?", (time.time(), key)).rowcount
+        if updated == 0:
+            return None
+        if not os.path.isfile(filepath):
+            # removed behind our back
+            self.forget(key)
+            return None
+        return filepath
+
+    @arglogger
+    def put(self, key, write):
+        """
+        make the cached file for key by calling write(path), then evict as needed
+
+        write must create the file at the path it is given; the file is moved
+        into place only once it is complete. returns the cached file's path
+        """
+        filepath = self.__entry_path__(key)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            try:
+                os.makedirs(os.path.dirname(filepath))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(filepath)):
+                    raise
+        root, extension = os.path.splitext(filepath)
+        temp_path = '{0}.{1}.tmp{2}'.format(root, os.getpid(), extension)
+        write(temp_path)
+        os.rename(temp_path, filepath)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)",
+                (key, os.path.getsize(filepath), time.time()))
+        self.evict(keep=key)
+        return filepath
+
+    @arglogger
+    def evict(self, keep=None):
+        """
+        remove least recently used files until the cache is within its budget
+
+        the entry named keep, if any, is never removed; returns the number removed
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        removed = 0
+        if total <= self.max_bytes:
+            return removed
+        for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.forget(key)
+            total -= size
+            removed += 1
+        logger.debug("evicted {0} derivative(s) from {1}".format(removed, self.path))
+        return removed
+
+    @arglogger
+    def forget(self, key):
+        try:
+            os.remove(self.__entry_path__(key))
+        except OSError:
+            pass
+        with self.connection:
+            self.connection.execute("DELETE FROM entries WHERE key=?", (key,))
+
+    @arglogger
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+keep one long-lived exiftool process per python process, shared by every package
+created in it, instead of paying perl's startup for each one
+"""
+
+from arglogger import arglogger
+import atexit
+import exiftool
+import logging
+import os
+import sys
+import threading
+
+# most files passed to exiftool in one command
+BATCH_FILES = 500
+
+# times a command is retried on a fresh exiftool process after the old one died
+RETRIES = 1
+
+class ExifTool(exiftool.ExifTool):
+    """
+    pyexiftool's ExifTool, except that a command fails with IOError if the
+    exiftool process dies, instead of waiting forever for its output
+    """
+
+    def execute(self, *params):
+        if not self.running:
+            raise ValueError("ExifTool instance not running.")
+        self._process.stdin.write(b"\n".join(params + (b"-execute\n",)))
+        self._process.stdin.flush()
+        output = b""
+        fd = self._process.stdout.fileno()
+        while not output[-32:].strip().endswith(exiftool.sentinel):
+            data = os.read(fd, exiftool.block_size)
+            if len(data) == 0:
+                raise IOError("exiftool exited unexpectedly with status {0}".format(self._process.wait()))
+            output += data
+        return output.strip()[:-len(exiftool.sentinel)]
+
+    def kill(self):
+        """
+        stop the exiftool process without waiting for it to finish what it is doing
+        """
+        if not self.running:
+            return
+        try:
+            self._process.kill()
+            self._process.wait()
+        except OSError:
+            pass
+        del self._process
+        self.running = False
+
+
+class ExifWorker():
+    """
+    a persistent exiftool process (-stay_open), started when first needed and
+    restarted whenever it dies; safe to share between threads
+    """
+
+    @arglogger
+    def __init__(self, executable=None):
+        self.executable = executable
+        self.tool = None
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def __start__(self):
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        if self.tool is not None:
+            self.tool.kill()
+            self.restarts += 1
+            logger.warning("restarting exiftool (restart {0})".format(self.restarts))
+        self.tool = ExifTool(self.executable)
+        self.tool.start()
+
+    def __execute__(self, paths):
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        with self.lock:
+            attempt = 0
+            while True:
+                if self.tool is None or not self.tool.running or self.tool._process.poll() is not None:
+                    self.__start__()
+                try:
+                    return self.tool.get_metadata_batch(paths)
+                except (IOError, OSError) as e:
+                    logger.warning("exiftool failed on {0} file(s): {1}".format(len(paths), e))
+                    self.tool.kill()
+                    if attempt == RETRIES:
+                        raise
+                    attempt += 1
+
+    @arglogger
+    def get_metadata_batch(self, paths):
+        """
+        exiftool metadata for each of the files at paths, as pyexiftool's get_metadata_batch returns it
+        """
+        results = []
+        for i in range(0, len(paths), BATCH_FILES):
+            results.extend(self.__execute__(paths[i:i + BATCH_FILES]))
+        return results
+
+    @arglogger
+    def close(self):
+        with self.lock:
+            if self.tool is not None:
+                try:
+                    self.tool.terminate()
+                except (IOError, OSError):
+                    self.tool.kill()
+                self.tool = None
+
+
+# the worker of this process, and the id of the process it belongs to
+WORKER = None
+WORKER_PID = None
+
+@arglogger
+def get_worker():
+    """
+    the shared ExifWorker of the calling process
+
+    a process forked from one that had a worker (e.g. a multiprocessing pool
+    worker) gets a worker of its own: the pipes it inherited lead to its
+    parent's exiftool
+    """
+    global WORKER, WORKER_PID
+    if WORKER is None or WORKER_PID != os.getpid():
+        if WORKER is not None and WORKER.tool is not None:
+            # forget the parent's process without telling it to exit
+            WORKER.tool.running = False
+        WORKER = ExifWorker()
+        WORKER_PID = os.getpid()
+    return WORKER
+
+@atexit.register
+def __close_worker__():
+    if WORKER is not None and WORKER_PID == os.getpid():
+        WORKER.close()
@@ -5,25 +5,148 @@ utility functions to create and exploit file checksums
 """
 
 import hashlib
+import mmap
+import os
 import shutil
+import sys
 
-def hash_of_file(filepath):
+# bytes read per call when streaming a file through a hasher; large enough that
+# hashlib releases the GIL and per-call overhead is negligible, small enough that
+# memory use stays flat no matter how big the file is
+CHUNK_SIZE = 1024 * 1024
+
+def stat_key(filepath):
+    """
+    the (device, inode, size, mtime in nanoseconds) tuple that identifies one
+    version of a file on disk, for deciding whether a recorded hash is still good
     """
-    generate sha1 hash for a file
+    st = os.stat(filepath)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+def hashes_of_file(filepath, algorithms=('sha1',), chunk_size=CHUNK_SIZE, use_mmap=False):
+    """
+    generate hashes for a file with several algorithms in a single read
+
+    returns a dictionary of hex digests keyed by algorithm name; each chunk read
+    from the file is fed to every hasher in turn, so adding algorithms costs cpu
+    but no extra i/o
     """
+    hashers = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
     with open(filepath, 'rb') as f:
-        return hashlib.sha1(f.read()).hexdigest()
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, size, chunk_size):
+                        chunk = m[offset:offset+chunk_size]
+                        for algorithm, h in hashers:
+                            h.update(chunk)
+                finally:
+                    m.close()
+        else:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                for algorithm, h in hashers:
+                    h.update(chunk)
+    return dict((algorithm, h.hexdigest()) for algorithm, h in hashers)
 
-def safe_copy(src, dest, tries=2):
+def hash_of_file(filepath, chunk_size=CHUNK_SIZE, use_mmap=False, algorithm='sha1'):
+    """
+    generate sha1 (or another algorithm's) hash for a file
+
+    the file is streamed through the hasher chunk_size bytes at a time, so
+    memory use does not grow with file size; with use_mmap=True the file is
+    memory-mapped instead and fed to the hasher in chunk_size slices (mapped
+    pages are file-backed and reclaimable, though the OS counts them as RSS)
+    """
+    return hashes_of_file(filepath, (algorithm,), chunk_size, use_mmap)[algorithm]
+
+def copy_and_hash(src, dest, chunk_size=CHUNK_SIZE):
+    """
+    copy src to dest, hashing the bytes as they stream through; returns the sha1
+    of what was read from src (permission bits and times are copied as by copy2)
+    """
+    h = hashlib.sha1()
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'wb') as fdest:
+            for chunk in iter(lambda: fsrc.read(chunk_size), b''):
+                h.update(chunk)
+                fdest.write(chunk)
+    shutil.copystat(src, dest)
+    return h.hexdigest()
+
+def kernel_copy(src, dest, chunk_size=CHUNK_SIZE):
+    """
+    copy src to dest without passing the data through user space where the
+    platform offers copy_file_range or sendfile; otherwise behave like copy2
+
+    os.copy_file_range (python 3.8) and os.sendfile (python 3.3) are missing
+    from python 2, so there this is always shutil.copy2
+    """
+    copy_range = getattr(os, 'copy_file_range', None)
+    # sendfile only accepts a regular file as its output on linux
+    sendfile = getattr(os, 'sendfile', None) if sys.platform.startswith('linux') else None
+    if copy_range is None and sendfile is None:
+        shutil.copy2(src, dest)
+        return
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'wb') as fdest:
+            infd, outfd = fsrc.fileno(), fdest.fileno()
+            remaining = os.fstat(infd).st_size
+            offset = 0
+            while remaining > 0:
+                count = min(remaining, chunk_size)
+                try:
+                    if copy_range is not None:
+                        n = copy_range(infd, outfd, count, offset)
+                    else:
+                        n = sendfile(outfd, infd, offset, count)
+                except OSError:
+                    # e.g. EXDEV across filesystems on older kernels: try the next mechanism
+                    if copy_range is not None:
+                        copy_range = None
+                        if sendfile is not None:
+                            continue
+                    fsrc.seek(offset)
+                    shutil.copyfileobj(fsrc, fdest, chunk_size)
+                    break
+                if n == 0:
+                    break
+                offset += n
+                remaining -= n
+    shutil.copystat(src, dest)
+
+def safe_copy(src, dest, tries=2, single_pass=True, chunk_size=CHUNK_SIZE, digests=None):
     """
     verify checksums on file copy
+
+    by default the source is hashed as it streams to dest and dest is then read
+    once to verify, i.e. two passes over the data rather than three; with
+    single_pass=False the source is hashed separately and copied by kernel_copy().
+    returns the sha1 of the copy; if a digests dictionary is passed in, the
+    verifying read also fills it with the copy's hash for each algorithm
+    already keyed in it
     """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
     i = 0
     while i < tries:
-        hash_src = hash_of_file(src)
-        shutil.copy2(src, dest)
-        hash_dest = hash_of_file(dest)
+        if single_pass:
+            hash_src = copy_and_hash(src, dest, chunk_size)
+        else:
+            hash_src = hash_of_file(src, chunk_size)
+            kernel_copy(src, dest, chunk_size)
+        algorithms = set(['sha1'])
+        if digests is not None:
+            algorithms.update(digests.keys())
+        hashes_dest = hashes_of_file(dest, sorted(algorithms), chunk_size)
+        hash_dest = hashes_dest['sha1']
         if hash_src == hash_dest:
+            if digests is not None:
+                digests.update(hashes_dest)
             return hash_dest
         i += 1
     raise IOError("could not verify safe-copy from {source} to {dest}".format(source=src, dest=dest))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+verify fixity across a whole collection of image packages in parallel
+"""
+
+from arglogger import arglogger
+import datetime
+from filehashing import hash_of_file, stat_key
+from functools import partial
+import logging
+import manifest # part of isaw.images
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from validate_path import validate_path
+
+MANIFEST = 'manifest-sha1.txt'
+
+# files at least this big are hashed as tasks of their own so that one package's
+# master does not hold up a worker while the rest of the pool sits idle
+LARGE_FILE = 256 * 1024 * 1024
+
+# seconds in a day, for converting trust_days
+DAY = 86400
+
+class FixityCache():
+    """
+    a persistent record of when each file was last verified, and against what digest
+
+    a file whose device, inode, size and mtime are unchanged since it was
+    recorded may be trusted without rehashing, for as long as the caller allows
+    """
+
+    @arglogger
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS fixity ("
+            "path TEXT, algorithm TEXT, device INTEGER, inode INTEGER, size INTEGER, "
+            "mtime_ns INTEGER, digest TEXT, verified_at REAL, PRIMARY KEY (path, algorithm))")
+        self.connection.commit()
+
+    @arglogger
+    def lookup(self, filepath, max_age=None, algorithm='sha1'):
+        """
+        return the cached digest for filepath if the file is unchanged and was
+        verified no more than max_age seconds ago; otherwise return None
+        """
+        real_path = os.path.realpath(filepath)
+        row = self.connection.execute(
+            "SELECT device, inode, size, mtime_ns, digest, verified_at FROM fixity WHERE path=? AND algorithm=?",
+            (real_path, algorithm)).fetchone()
+        if row is None:
+            return None
+        try:
+            key = stat_key(real_path)
+        except OSError:
+            return None
+        if tuple(row[0:4]) != key:
+            return None
+        if max_age is not None and time.time() - row[5] > max_age:
+            return None
+        return row[4]
+
+    @arglogger
+    def record(self, filepath, digest, key=None, algorithm='sha1'):
+        """
+        note that filepath was just verified against digest
+        """
+        real_path = os.path.realpath(filepath)
+        if key is None:
+            key = stat_key(real_path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO fixity (path, algorithm, device, inode, size, mtime_ns, digest, verified_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (real_path, algorithm) + tuple(key) + (digest, time.time()))
+        self.connection.commit()
+
+    @arglogger
+    def forget(self, filepath):
+        self.connection.execute("DELETE FROM fixity WHERE path=?", (os.path.realpath(filepath),))
+        self.connection.commit()
+
+    @arglogger
+    def close(self):
+        self.connection.close()
+
+
+def verify_file(filepath, expected, cache=None, trust_days=None, algorithm='sha1'):
+    """
+    check one file against its expected digest, returning the actual digest and
+    whether the file was read to get it
+
+    with a cache and trust_days, a file that is unchanged since it was last
+    verified (within trust_days days) is not rehashed; without trust_days the
+    file is always rehashed, but the cache is still refreshed on success
+    """
+    if cache is not None and trust_days is not None:
+        if cache.lookup(filepath, trust_days * DAY, algorithm) == expected:
+            return expected, False
+    key = stat_key(filepath) if cache is not None else None
+    actual = __hash_file__(filepath, algorithm)
+    if cache is not None and actual == expected:
+        cache.record(filepath, actual, key, algorithm)
+    return actual, True
+
+# set in each worker process by __init_worker__; io_semaphore caps how many
+# workers read at once, and each worker keeps its own fixity cache connection
+io_semaphore = None
+worker_cache = None
+worker_trust_days = None
+
+def __init_worker__(semaphore, cache_path=None, trust_days=None):
+    global io_semaphore, worker_cache, worker_trust_days
+    io_semaphore = semaphore
+    if cache_path is not None:
+        worker_cache = FixityCache(cache_path)
+    worker_trust_days = trust_days
+
+def __hash_file__(filepath, algorithm='sha1'):
+    if io_semaphore is None:
+        return hash_of_file(filepath, algorithm=algorithm)
+    with io_semaphore:
+        return hash_of_file(filepath, algorithm=algorithm)
+
+def plan_package(package_path, large_file=LARGE_FILE):
+    """
+    read a package's manifest and split its entries into hashing tasks
+
+    returns (package id, structural failures, tasks); each task is a tuple of
+    (package id, package path, algorithm, [(filename, expected hash), ...]),
+    checked against the package's preferred manifest
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    package_id = os.path.basename(package_path)
+    try:
+        manifests = manifest.find_manifests(package_path)
+    except (IOError, ValueError) as e:
+        return package_id, [{'file': MANIFEST, 'error': 'unreadable', 'detail': str(e)}], []
+    if len(manifests) == 0:
+        return package_id, [{'file': MANIFEST, 'error': 'no supported manifest'}], []
+    algorithm = manifest.preferred_algorithm(manifests.keys())
+    entries = manifests[algorithm].get_all()
+    failures = []
+    # same completeness checks as Package.validate()
+    if 'master.tif' not in entries:
+        failures.append({'file': 'master.tif', 'error': 'not in manifest'})
+    originals = [f for f in entries.keys() if 'original.' in f and 'sha1' not in os.path.splitext(f)[1]]
+    if len(originals) == 0:
+        failures.append({'file': 'original.*', 'error': 'not in manifest'})
+    small = []
+    tasks = []
+    for filename in sorted(entries.keys()):
+        try:
+            size = os.path.getsize(os.path.join(package_path, filename))
+        except OSError:
+            size = 0
+        if size >= large_file:
+            tasks.append((package_id, package_path, algorithm, [(filename, entries[filename])]))
+        else:
+            small.append((filename, entries[filename]))
+    if len(small) > 0:
+        tasks.append((package_id, package_path, algorithm, small))
+    logger.debug("planned {0} task(s) for package {1}".format(len(tasks), package_id))
+    return package_id, failures, tasks
+
+def verify_files(task):
+    """
+    hash the files in one task and compare them to the manifest
+
+    returns (package id, failures, number of files checked, number of them
+    trusted from the cache without being read, bytes read)
+    """
+    package_id, package_path, algorithm, entries = task
+    failures = []
+    count = 0
+    trusted = 0
+    nbytes = 0
+    for filename, expected in entries:
+        filepath = os.path.join(package_path, filename)
+        if not os.path.isfile(filepath):
+            failures.append({'file': filename, 'error': 'missing', 'expected': expected})
+            continue
+        try:
+            actual, hashed = verify_file(filepath, expected, worker_cache, worker_trust_days, algorithm)
+        except (IOError, OSError) as e:
+            failures.append({'file': filename, 'error': 'unreadable', 'detail': str(e)})
+            continue
+        count += 1
+        if hashed:
+            nbytes += os.path.getsize(filepath)
+        else:
+            trusted += 1
+        if actual != expected:
+            failures.append({'file': filename, 'error': 'checksum mismatch', 'expected': expected, 'actual': actual})
+    return package_id, failures, count, trusted, nbytes
+
+def find_packages(path):
+    """
+    list the directories under path, separating image packages from the rest
+    """
+    real_path = validate_path(path, 'directory')
+    packages = []
+    others = []
+    for d in sorted(os.listdir(real_path)):
+        dpath = os.path.join(real_path, d)
+        if os.path.isdir(dpath):
+            if os.path.isfile(os.path.join(dpath, MANIFEST)):
+                packages.append(dpath)
+            else:
+                others.append(d)
+    return packages, others
+
+@arglogger
+def verify_collection(path, workers=None, io_limit=None, large_file=LARGE_FILE, cache_path=None, trust_days=None):
+    """
+    verify every package under path across a process pool
+
+    workers defaults to the number of cpus; io_limit, if given, is the most files
+    that may be read at the same time across all workers. cache_path and
+    trust_days work as for verify_file(). returns a report dict that can be
+    serialized as json, with failures keyed by package id. files_checked
+    counts files_trusted (accepted from the cache unread) too, but
+    bytes_checked counts only the bytes actually read
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    started = datetime.datetime.utcnow()
+    package_paths, others = find_packages(path)
+    report = {
+        'root': os.path.realpath(path),
+        'started': started.isoformat() + 'Z',
+        'workers': workers or multiprocessing.cpu_count(),
+        'io_limit': io_limit,
+        'trust_days': trust_days,
+        'packages': len(package_paths),
+        'other_directories': others,
+        'files_checked': 0,
+        'files_trusted': 0,
+        'bytes_checked': 0,
+        'failures': {},
+    }
+    semaphore = multiprocessing.BoundedSemaphore(io_limit) if io_limit else None
+    if cache_path is not None:
+        FixityCache(cache_path).close() # create the table before the workers race to do so
+    pool = multiprocessing.Pool(workers, __init_worker__, (semaphore, cache_path, trust_days))
+    try:
+        tasks = []
+        for package_id, failures, package_tasks in pool.imap_unordered(partial(plan_package, large_file=large_file), package_paths, 16):
+            if len(failures) > 0:
+                report['failures'].setdefault(package_id, []).extend(failures)
+            tasks.extend(package_tasks)
+        logger.info("verifying {0} package(s) as {1} task(s)".format(len(package_paths), len(tasks)))
+        for package_id, failures, count, trusted, nbytes in pool.imap_unordered(verify_files, tasks):
+            report['files_checked'] += count
+            report['files_trusted'] += trusted
+            report['bytes_checked'] += nbytes
+            if len(failures) > 0:
+                report['failures'].setdefault(package_id, []).extend(failures)
+                logger.warning("fixity verification FAILED for package '{0}'".format(package_id))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    for failures in report['failures'].values():
+        failures.sort(key=lambda f: f['file'])
+    report['packages_failed'] = len(report['failures'])
+    report['finished'] = datetime.datetime.utcnow().isoformat() + 'Z'
+    return report
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+index the content hashes of every package in a collection, to find duplicates
+"""
+
+from arglogger import arglogger
+from fixity import find_packages
+import logging
+import manifest # part of isaw.images
+import os
+import sqlite3
+import sys
+
+# filenames of package originals, as an sqlite glob (manifests may also list
+# original.*.sha1 sidecars from older packages, which are not originals)
+ORIGINALS = "filename GLOB 'original.*' AND filename NOT GLOB 'original.*.sha1'"
+
+class HashIndex():
+    """
+    a sqlite index of (package id, filename, algorithm, digest, size) across a collection
+
+    it is filled from existing manifests with index_collection(), and kept current
+    by any Manifest opened with index=this object, which re-indexes its package
+    each time it writes. packages being created also claim their originals (see
+    claim_original()), before their manifests are written
+    """
+
+    @arglogger
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "package TEXT, filename TEXT, algorithm TEXT, digest TEXT, size INTEGER, "
+            "PRIMARY KEY (package, filename, algorithm))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS hashes_digest ON hashes (algorithm, digest)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS originals ("
+            "algorithm TEXT, digest TEXT, package TEXT, "
+            "PRIMARY KEY (algorithm, digest))")
+        self.connection.commit()
+
+    @arglogger
+    def index_manifest(self, m):
+        """
+        replace the index entries for one manifest's package and algorithm with its current contents
+        """
+        dirpath = os.path.dirname(m.path)
+        package_id = os.path.basename(dirpath)
+        rows = []
+        for filename, digest in m.data.items():
+            try:
+                size = os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                size = None
+            rows.append((package_id, filename, m.algorithm, digest, size))
+        with self.connection:
+            self.connection.execute("DELETE FROM hashes WHERE package=? AND algorithm=?", (package_id, m.algorithm))
+            self.connection.executemany(
+                "INSERT INTO hashes (package, filename, algorithm, digest, size) VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    @arglogger
+    def index_collection(self, path):
+        """
+        (re)index every manifest of every package under path; returns the number of packages
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        package_paths, others = find_packages(path)
+        for package_path in package_paths:
+            for m in manifest.find_manifests(package_path).values():
+                self.index_manifest(m)
+        logger.info("indexed {0} packages under {1}".format(len(package_paths), path))
+        return len(package_paths)
+
+    @arglogger
+    def forget(self, package_id):
+        """
+        drop every entry for a package, e.g. once it has been deleted
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM hashes WHERE package=?", (package_id,))
+            self.connection.execute("DELETE FROM originals WHERE package=?", (package_id,))
+
+    @arglogger
+    def claim_original(self, package_id, digest, algorithm='sha1'):
+        """
+        record that package_id holds the original with the given digest, unless
+        another package already does; returns the ids of any such others, sorted
+
+        the claim and the lookup are one transaction, so of several processes
+        creating packages from the same original at once, only one gets it
+        """
+        with self.connection:
+            # the insert takes the database's write lock before anything is read
+            self.connection.execute("INSERT OR IGNORE INTO originals (algorithm, digest, package) VALUES (?, ?, ?)", (algorithm, digest, package_id))
+            others = set(row[0] for row in self.connection.execute(
+                "SELECT package FROM originals WHERE algorithm=? AND digest=? AND package!=?", (algorithm, digest, package_id)))
+            others.update(row[0] for row in self.connection.execute(
+                "SELECT package FROM hashes WHERE algorithm=? AND digest=? AND package!=? AND " + ORIGINALS, (algorithm, digest, package_id)))
+            if len(others) > 0:
+                self.connection.execute("DELETE FROM originals WHERE algorithm=? AND digest=? AND package=?", (algorithm, digest, package_id))
+        return sorted(others)
+
+    @arglogger
+    def find(self, digest, algorithm='sha1', originals_only=False):
+        """
+        list the (package id, filename) pairs whose content has the given digest
+        """
+        sql = "SELECT package, filename FROM hashes WHERE algorithm=? AND digest=?"
+        if originals_only:
+            sql += " AND " + ORIGINALS
+        return [tuple(row) for row in self.connection.execute(sql + " ORDER BY package, filename", (algorithm, digest))]
+
+    @arglogger
+    def duplicates(self, algorithm='sha1', originals_only=True):
+        """
+        find content held by more than one package
+
+        returns a dictionary keyed by digest of the (package id, filename) pairs
+        sharing it; by default only originals are compared, since packages made
+        from the same original also share their derivatives
+        """
+        where = "algorithm=?"
+        if originals_only:
+            where += " AND " + ORIGINALS
+        sql = ("SELECT digest, package, filename FROM hashes WHERE " + where + " AND digest IN "
+            "(SELECT digest FROM hashes WHERE " + where + " GROUP BY digest HAVING COUNT(DISTINCT package) > 1) "
+            "ORDER BY digest, package, filename")
+        result = {}
+        for digest, package_id, filename in self.connection.execute(sql, (algorithm, algorithm)):
+            result.setdefault(digest, []).append((package_id, filename))
+        return result
+
+    @arglogger
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+create image packages for a whole batch of originals, running the stages of
+package creation as a pipeline so that copying, color conversion and encoding
+overlap
+"""
+
+from arglogger import arglogger
+import datetime
+import hashindex # part of isaw.images
+import logging
+import multiprocessing
+import os
+import package # part of isaw.images
+from Queue import Empty
+import re
+import sys
+import time
+
+# worker processes per stage of package.CREATE_STAGES, when not given: copying
+# and hashing originals is bound by i/o, the master and derivatives by cpu
+WORKERS = {
+    'original': 2,
+    'master': multiprocessing.cpu_count(),
+    'derivatives': multiprocessing.cpu_count(),
+    'metadata': 1,
+}
+
+# most originals waiting in front of each stage; a stage that falls behind
+# fills its queue and so holds up the stages before it
+QUEUE_SIZE = 4
+
+# package ids are made from original filenames, with anything else replaced by '-'
+RUNSAFE = re.compile(r'[^\w.-]+')
+
+@arglogger
+def find_originals(path):
+    """
+    list the image files (by extension, see package.EXTENSIONS) under path, sorted
+    """
+    originals = []
+    for dirpath, dirnames, filenames in os.walk(os.path.realpath(path)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1][1:].lower() in package.EXTENSIONS.keys():
+                originals.append(os.path.join(dirpath, filename))
+    return originals
+
+@arglogger
+def package_id(original_path):
+    """
+    the id of the package for an original: its filename without the extension
+    """
+    return RUNSAFE.sub('-', os.path.splitext(os.path.basename(original_path))[0])
+
+def __run_stage__(stage, task, index, pyramid):
+    p = package.Package()
+    if stage == package.CREATE_STAGES[0]:
+        # a package left half-built by an earlier ingest is resumed from its journal
+        stages = p.__begin_create__(task['destination'], task['id'], task['original'], task['algorithms'], index)
+    else:
+        p.__attach__(task['path'], index)
+        stages = [s for s in package.CREATE_STAGES if s not in p.journal['completed']]
+    if stage in stages:
+        with p.batch():
+            p.__create_stage__(stage, task['original'], index, pyramid)
+    if stage == package.CREATE_STAGES[-1]:
+        p.__end_create__()
+
+def __stage_worker__(stage, inbox, outbox, results, index_path, pyramid, slots, slot):
+    """
+    run one stage on each task from inbox and pass it on to outbox, or to results
+    if it failed, until told to stop with None
+
+    while a task is being worked on its number is kept in slots[slot], so that
+    it can be failed if this process dies
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    index = hashindex.HashIndex(index_path) if index_path is not None else None
+    while True:
+        task = inbox.get()
+        if task is None:
+            break
+        slots[slot] = task['number']
+        started = time.time()
+        try:
+            __run_stage__(stage, task, index, pyramid)
+        except MemoryError:
+            task['error'] = '{0}: out of memory'.format(stage)
+        except Exception as e:
+            task['error'] = '{0}: {1}: {2}'.format(stage, type(e).__name__, e)
+        task['seconds'][stage] = time.time() - started
+        if 'error' in task.keys():
+            logger.warning("creating package '{0}' FAILED in stage '{1}'".format(task['id'], stage))
+            results.put(task)
+        else:
+            outbox.put(task)
+        slots[slot] = -1
+    if index is not None:
+        index.close()
+
+def __feed__(tasks, inbox):
+    for task in tasks:
+        inbox.put(task) # blocks while the first stage is busy
+
+@arglogger
+def ingest(originals, destination, workers=None, queue_size=QUEUE_SIZE, algorithms=None, index_path=None, pyramid=None):
+    """
+    create a package in destination for each of originals (a list of paths, or
+    a directory to search with find_originals)
+
+    each of package.CREATE_STAGES runs in its own pool of worker processes
+    (workers maps stage names to pool sizes, defaulting to WORKERS), passing
+    originals on through bounded queues of queue_size. algorithms and pyramid
+    are as for Package.create; index_path names a hashindex database used to
+    reject originals already ingested. packages are named by package_id(), and
+    originals whose ids clash are rejected with ValueError before anything is
+    done. a package left half-built by an interrupted ingest is picked up
+    where it left off (see Package.create). a worker process that dies is
+    replaced, and the original it was working on counted as failed. returns a
+    summary dict that can be serialized as json, with failures keyed by
+    original path
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    started = time.time()
+    if not isinstance(originals, (list, tuple)):
+        originals = find_originals(originals)
+    destination = os.path.realpath(destination)
+    if pyramid is None:
+        pyramid = package.PYRAMID
+    pool_sizes = dict(WORKERS)
+    pool_sizes.update(workers or {})
+    unknown = [stage for stage in pool_sizes.keys() if stage not in package.CREATE_STAGES]
+    if len(unknown) > 0:
+        raise ValueError("unknown package creation stage(s): {0}".format(', '.join(sorted(unknown))))
+    tasks = []
+    ids = {}
+    for original_path in originals:
+        id = package_id(original_path)
+        if id in ids.keys():
+            raise ValueError("originals {0} and {1} would both be package '{2}'".format(ids[id], original_path, id))
+        ids[id] = original_path
+        tasks.append({
+            'number': len(tasks),
+            'id': id,
+            'original': os.path.realpath(original_path),
+            'destination': destination,
+            'path': os.path.join(destination, id),
+            'algorithms': algorithms,
+            'seconds': {},
+        })
+    summary = {
+        'destination': destination,
+        'started': datetime.datetime.utcfromtimestamp(started).isoformat() + 'Z',
+        'workers': dict((stage, pool_sizes[stage]) for stage in package.CREATE_STAGES),
+        'queue_size': queue_size,
+        'originals': len(tasks),
+        'created': 0,
+        'failed': 0,
+        'stage_seconds': dict((stage, 0.0) for stage in package.CREATE_STAGES),
+        'failures': {},
+    }
+    logger.info("ingesting {0} original(s) into {1}".format(len(tasks), destination))
+
+    # one bounded queue in front of each stage; the last stage and failed tasks
+    # go to an unbounded results queue, which is drained here. each worker has a
+    # slot in shared memory holding the number of the task it is working on
+    queues = [multiprocessing.Queue(queue_size) for stage in package.CREATE_STAGES]
+    results = multiprocessing.Queue()
+    slots = multiprocessing.Array('i', [-1] * sum(pool_sizes[stage] for stage in package.CREATE_STAGES))
+    processes = {}
+
+    def start_worker(i, slot):
+        stage = package.CREATE_STAGES[i]
+        outbox = queues[i + 1] if i + 1 < len(queues) else results
+        process = multiprocessing.Process(target=__stage_worker__, args=(stage, queues[i], outbox, results, index_path, pyramid, slots, slot))
+        process.daemon = True
+        process.start()
+        processes[slot] = (i, process)
+
+    for i, stage in enumerate(package.CREATE_STAGES):
+        for n in range(pool_sizes[stage]):
+            start_worker(i, len(processes))
+    feeder = multiprocessing.Process(target=__feed__, args=(tasks, queues[0]))
+    feeder.daemon = True
+    feeder.start()
+    try:
+        done = 0
+        while done < len(tasks):
+            try:
+                task = results.get(timeout=5)
+            except Empty:
+                for slot, (i, process) in processes.items():
+                    if process.exitcode in (None, 0):
+                        continue
+                    stage = package.CREATE_STAGES[i]
+                    logger.error("{0} worker died with exit code {1}: starting another".format(stage, process.exitcode))
+                    process.join()
+                    number = slots[slot]
+                    slots[slot] = -1
+                    start_worker(i, slot)
+                    if number >= 0:
+                        task = tasks[number]
+                        task['error'] = '{0}: worker process died with exit code {1}'.format(stage, process.exitcode)
+                        results.put(task)
+                continue
+            done += 1
+            for stage, seconds in task['seconds'].items():
+                summary['stage_seconds'][stage] += seconds
+            if 'error' in task.keys():
+                summary['failed'] += 1
+                summary['failures'][task['original']] = task['error']
+            else:
+                summary['created'] += 1
+                logger.info("created package '{0}' ({1} of {2})".format(task['id'], done, len(tasks)))
+        for i, stage in enumerate(package.CREATE_STAGES):
+            for n in range(pool_sizes[stage]):
+                queues[i].put(None)
+        for process in [process for i, process in processes.values()] + [feeder]:
+            process.join()
+    except:
+        for process in [process for i, process in processes.values()] + [feeder]:
+            process.terminate()
+        raise
+    finished = time.time()
+    elapsed = finished - started
+    summary['finished'] = datetime.datetime.utcfromtimestamp(finished).isoformat() + 'Z'
+    summary['seconds'] = round(elapsed, 3)
+    for stage in package.CREATE_STAGES:
+        summary['stage_seconds'][stage] = round(summary['stage_seconds'][stage], 3)
+    summary['packages_per_second'] = round(summary['created'] / elapsed, 3) if elapsed > 0 else None
+    return summary
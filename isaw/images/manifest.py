@@ -5,19 +5,170 @@ manage manifest file
 """
 
 from arglogger import arglogger
-from filehashing import hash_of_file
+from contextlib import contextmanager
+from filehashing import hashes_of_file, stat_key
+import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import packagelock
+import re
+import sys
 from validate_path import validate_path
 
+RMANIFEST = re.compile(r"^(tag)?manifest-(\w+)\.txt$")
+
+# other files in a package directory that manifests never list: bookkeeping that
+# changes without the package content changing (see derivatives.PROVENANCE and
+# packagelock.LOCK_FILENAME)
+UNMANAGED = ['.DS_Store', 'derivatives.json', 'package.lock']
+
+# when a package has several manifests, verify against the first of these that it
+# has and hashlib supports: strong algorithms before weak, cheaper before dearer
+PREFERENCE = ['blake2b', 'sha512', 'sha256', 'sha1', 'md5']
+
+def manifest_filename(algorithm):
+    return 'manifest-{0}.txt'.format(algorithm)
+
+def algorithm_of(path):
+    """
+    the hash algorithm named by a bagit manifest filename, e.g. 'sha256' for manifest-sha256.txt
+    """
+    m = RMANIFEST.match(os.path.basename(path))
+    if m is None or m.group(1) is not None:
+        return 'sha1'
+    return m.group(2)
+
+def supported(algorithm):
+    try:
+        hashlib.new(algorithm)
+    except ValueError:
+        return False
+    return True
+
+def preferred_algorithm(algorithms):
+    """
+    choose which of several available algorithms to verify against
+    """
+    for algorithm in PREFERENCE:
+        if algorithm in algorithms:
+            return algorithm
+    return sorted(algorithms)[0]
+
+def is_unmanaged(filename):
+    """
+    true for files in a package directory that are not themselves listed in manifests
+    """
+    return RMANIFEST.match(filename) is not None or filename in UNMANAGED or filename.endswith('.tmp')
+
+@arglogger
+def find_manifests(dirpath, index=None):
+    """
+    open every manifest in dirpath whose algorithm hashlib supports, keyed by algorithm
+
+    index, if given, is a hashindex.HashIndex that each manifest keeps current
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    manifests = {}
+    for filename in os.listdir(dirpath):
+        m = RMANIFEST.match(filename)
+        if m is not None and m.group(1) is None:
+            if supported(m.group(2)):
+                manifests[m.group(2)] = Manifest(os.path.join(dirpath, filename), index=index)
+            else:
+                logger.warning("ignoring {0}: hash algorithm is not supported here".format(filename))
+    return manifests
+
+@contextmanager
+def batch(manifests):
+    """
+    batch changes to several manifests at once (see Manifest.batch)
+    """
+    manifests = list(manifests)
+    if len(manifests) == 0:
+        yield
+    else:
+        with manifests[0].batch():
+            with batch(manifests[1:]):
+                yield
+
+@arglogger
+def regenerate_all(manifests, create=False, workers=1, cache=None):
+    """
+    regenerate several manifests of the same directory, reading each file only once
+    warning: overwrites!
+
+    with workers > 1 the files are hashed on a pool of threads (hashlib and file
+    reads release the GIL on large buffers). given a fixity.FixityCache, a file
+    is not reread if it is unchanged on disk since the cache recorded the hash
+    that each manifest already lists for it. every manifest is written once, at
+    the end
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    manifests = list(manifests)
+    dirpath = os.path.dirname(manifests[0].path)
+    algorithms = [m.algorithm for m in manifests]
+    filenames = sorted([o for o in os.listdir(dirpath) if os.path.isfile(os.path.join(dirpath,o)) and not is_unmanaged(o)])
+
+    # the sqlite cache may only be used from this thread, so consult it up front
+    results = {}
+    keys = {}
+    for filename in filenames:
+        filepath = os.path.join(dirpath, filename)
+        if cache is not None:
+            cached = dict((m.algorithm, cache.lookup(filepath, algorithm=m.algorithm)) for m in manifests)
+            if all(cached[m.algorithm] is not None and cached[m.algorithm] == m.data.get(filename) for m in manifests):
+                results[filename] = cached
+                continue
+            keys[filename] = stat_key(filepath)
+        results[filename] = None
+    pending = [filename for filename in filenames if results[filename] is None]
+    logger.debug("hashing {0} of {1} files in {2}".format(len(pending), len(filenames), dirpath))
+
+    def digest(filename):
+        return filename, hashes_of_file(os.path.join(dirpath, filename), algorithms)
+    if workers > 1 and len(pending) > 1:
+        pool = ThreadPool(min(workers, len(pending)))
+        try:
+            hashed = pool.map(digest, pending)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        hashed = [digest(filename) for filename in pending]
+    for filename, digests in hashed:
+        results[filename] = digests
+        if cache is not None:
+            for algorithm in algorithms:
+                cache.record(os.path.join(dirpath, filename), digests[algorithm], keys[filename], algorithm)
+
+    with batch(manifests):
+        for m in manifests:
+            if create:
+                m.data={}
+                m.dirty = True
+        for filename in filenames:
+            for m in manifests:
+                m.set(filename, results[filename][m.algorithm])
+
 class Manifest():
     """
     a class for managing manifest files
+
+    the hash algorithm is taken from the bagit-style filename (manifest-sha256.txt
+    and so on); manifest-sha1.txt is the one every package has. given a
+    hashindex.HashIndex, the manifest re-indexes its package whenever it writes.
+    every change is made holding the lock on the manifest's directory (see
+    packagelock.py), to the manifest as it is on disk at the time
     """
 
     @arglogger
-    def __init__(self, path, create=False):
+    def __init__(self, path, create=False, index=None):
         self.path=os.path.realpath(path)
+        self.algorithm = algorithm_of(self.path)
+        self.index = index
+        self.batching = 0   # depth of nested batch() blocks
+        self.dirty = False  # changes made during a batch that are not yet on disk
         if create:
             open(self.path, 'w').close()
         self.__read__()
@@ -38,32 +189,67 @@ class Manifest():
 
     @arglogger
     def __write__(self):
-        with open(self.path, 'w') as f:
+        if self.batching > 0:
+            self.dirty = True
+            return
+        # write a temporary file alongside and rename it over the manifest, so that
+        # readers never see a partially written manifest
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as f:
             for filename in sorted(self.data.keys()):
                 line = "{0} {1}\n".format(self.data[filename], filename)
                 f.write(line)
+        os.rename(temp_path, self.path)
+        self.dirty = False
+        if self.index is not None:
+            self.index.index_manifest(self)
+
+    @contextmanager
+    def batch(self):
+        """
+        defer writing the manifest file until the end of a block of changes
+
+        the file is written once, when the outermost batch block exits; if that
+        block raises, in-memory changes made during it are discarded instead.
+        the outermost block holds the lock on the manifest's directory, and
+        first rereads the manifest, so that changes made meanwhile by other
+        processes are kept
+        """
+        with packagelock.locked(os.path.dirname(self.path)):
+            if self.batching == 0:
+                if os.path.isfile(self.path):
+                    self.__read__()
+                snapshot = dict(self.data)
+            self.batching += 1
+            try:
+                yield self
+            except:
+                self.batching -= 1
+                if self.batching == 0:
+                    self.data = snapshot
+                    self.dirty = False
+                raise
+            self.batching -= 1
+            if self.batching == 0 and self.dirty:
+                self.__write__()
 
     @arglogger
-    def regenerate(self, create=False):
+    def regenerate(self, create=False, workers=1, cache=None):
         """
         generates a bagit-style manifest for all files in the directory
         warning: overwrites!
+
+        workers and cache work as for regenerate_all()
         """
-        # assumes there is an existing manifest-sha1.txt file, either legacy
+        # assumes there is an existing manifest file, either legacy
         # or because this manifest object was instantiated with create=True
-        if create:
-            self.data={}
-        dirpath = os.path.dirname(self.path)
-        filenames = [o for o in os.listdir(dirpath) if os.path.isfile(os.path.join(dirpath,o))]
-        for filename in filenames:
-            if filename not in ['manifest-sha1.txt', '.DS_Store']:
-                filehash = hash_of_file(os.path.join(dirpath,filename))
-                self.set(filename, filehash)
+        regenerate_all([self], create, workers, cache)
 
     @arglogger
     def set(self, filename, filehash):
-        self.data[filename]=filehash
-        self.__write__()
+        with self.batch():
+            self.data[filename]=filehash
+            self.__write__()
 
     @arglogger
     def get(self, filename):
@@ -79,7 +265,8 @@ class Manifest():
 
     @arglogger
     def remove(self, filename):
-        del self.data[filename]
-        self.__write__()
+        with self.batch():
+            del self.data[filename]
+            self.__write__()
 
 
@@ -5,9 +5,12 @@ manage metadata file
 """
 
 from arglogger import arglogger
+from contextlib import contextmanager
+import copy
 import json
 import logging
 import os
+import packagelock
 import re
 import shutil
 import sys
@@ -158,17 +161,27 @@ def xml2dict(d, element):
 class Metadata():
     """
     a class for managing metadata files
+
+    each change is written to the file straight away, unless it is made inside
+    a session() block. only the keys changed are written; the rest of the file
+    is kept as others may have written it since it was read
     """
 
     @arglogger
     def __init__(self, path, create=False, exiftool_json=None):
         logger = logging.getLogger(sys._getframe().f_code.co_name)
         self.path=os.path.realpath(path)
+        self.sessions = 0   # depth of nested session() blocks
+        self.tree = None    # the parsed file, changed in memory during a session
+        self.dirty = False  # changes made to self.tree that are not yet on disk
+        self.changed = set()    # top-level keys of self.data changed since they were last written
         if create:
             # copy template file and open it
             current = os.path.dirname(os.path.abspath(__file__))
             meta_template = os.path.join(current, 'meta', 'meta-template.xml')
-            shutil.copyfile(meta_template, self.path)
+            temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            shutil.copyfile(meta_template, temp_path)
+            os.rename(temp_path, self.path)
             self.__read__()
 
             # parse any provided exiftool json into the new metadata file
@@ -296,20 +309,20 @@ class Metadata():
                             tags[xtag] += ' ' + exif[etag]
                         tags[xtag] = cleanval(tags[xtag])
 
-                # write the conversions to the xml metadata file
-                
-                for k in sorted(tags.keys()):
-                    if ':' in k:
-                        hierarchy = k.split(':')
-                        logger.debug("setting hierarchy for {0}".format(k))
-                        self.set_hierarchy(hierarchy, tags[k])
-                        logger.debug("writing to original")
-                        self.__write__('original')
-                    else:
-                        logger.debug("setting {0}".format(k))
-                        self.set(k, tags[k])
-                        logger.debug("writing to original")
-                        self.__write__('original')
+                # write the conversions to the xml metadata file, all at once
+                with self.session():
+                    for k in sorted(tags.keys()):
+                        if ':' in k:
+                            hierarchy = k.split(':')
+                            logger.debug("setting hierarchy for {0}".format(k))
+                            self.set_hierarchy(hierarchy, tags[k])
+                            logger.debug("writing to original")
+                            self.__write__('original', [hierarchy[0]])
+                        else:
+                            logger.debug("setting {0}".format(k))
+                            self.set(k, tags[k])
+                            logger.debug("writing to original")
+                            self.__write__('original', [k])
                 
         else:
             self.__read__()
@@ -324,43 +337,119 @@ class Metadata():
         except IOError:
             raise    
         tree=ET.parse(self.path)    
+        self.data = self.__parse__(tree)
+        self.changed = set()
+        return len(self.data)
+
+    def __parse__(self, tree):
+        """
+        the data of a parsed file: its top-level items and those of its isaw info
+        """
+        d={}
         root= tree.getroot()
         for child in root:
             if child.tag=='info':
                 if child.attrib['type']=='isaw':
                     for subchild in child:
-                        xml2dict(self.data, subchild)
+                        xml2dict(d, subchild)
             else:
-                xml2dict(self.data, child)
-        return len(self.data)
+                xml2dict(d, child)
+        return d
+
+    def __merge__(self, tree):
+        """
+        take up what others have written to the parsed file, but for keys changed here
+        """
+        for k, v in self.__parse__(tree).iteritems():
+            if k not in self.changed:
+                self.data[k] = v
 
     @arglogger
-    def __write__(self, info_type='isaw'):
+    def __write__(self, info_type='isaw', keys=None):
+        """
+        write keys (default: all changed since they were last written) of self.data
+        to the file, at the top level or in the info of info_type; keys no longer
+        in self.data are removed from it. the file is read afresh, so the rest of
+        it is kept as others have left it (and taken up in self.data)
+        """
         logger = logging.getLogger(sys._getframe().f_code.co_name)
-        # split dictionary into top-level and info-level items
-        topfd = {k:v for (k,v) in self.data.iteritems() if k in TOPMETA_FRONT}
-        topbd = {k:v for (k,v) in self.data.iteritems() if k in TOPMETA_BACK}
-        infod = {k:v for (k,v) in self.data.iteritems() if k not in TOPMETA_FRONT and k not in TOPMETA_BACK}
-        tree=ET.parse(self.path)    
-        root= tree.getroot()
-        dict2xml(topfd, root)
-        for child in root:
-            if child.tag=='info':
-                if child.attrib['type']==info_type:
-                    dict2xml(infod, child)
-        dict2xml(topbd, root)
-        #logger.debug("info_type={0}".format(info_type))
-        #logger.debug(ET.tostring(root))
-        tree.write(self.path, encoding="UTF-8")
+        if keys is None:
+            keys = sorted(self.changed)
+        # hold the package lock from reading the file until it is replaced, whole,
+        # so that other writers do not interleave and readers never see it half-written
+        with packagelock.locked(os.path.dirname(self.path)):
+            if self.tree is not None:
+                # in a session: change the tree in memory only
+                tree = self.tree
+            else:
+                tree=ET.parse(self.path)    
+                self.__merge__(tree)
+            root= tree.getroot()
+            infos = [child for child in root if child.tag=='info' and child.attrib['type']==info_type]
+            for k in keys:
+                if k in TOPMETA_FRONT or k in TOPMETA_BACK:
+                    parents = [root]
+                else:
+                    parents = infos
+                for parent in parents:
+                    if k in self.data.keys():
+                        dict2xml({k: self.data[k]}, parent)
+                    else:
+                        for ele in parent.findall(k):
+                            parent.remove(ele)
+            self.changed.difference_update(keys)
+            if self.tree is not None:
+                self.dirty = True
+            else:
+                self.__save__(tree)
+
+    def __save__(self, tree):
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        tree.write(temp_path, encoding="UTF-8")
+        os.rename(temp_path, self.path)
+        self.dirty = False
+
+    @contextmanager
+    def session(self):
+        """
+        make many changes, then write the file once
+
+        the file is parsed once, when the outermost session block begins, and
+        what others have written to it is taken up; each change is applied to
+        that tree in memory, and the tree is written when the block exits. if the
+        block raises, its changes are discarded instead. the package lock (see
+        packagelock.py) is held throughout
+        """
+        with packagelock.locked(os.path.dirname(self.path)):
+            if self.sessions == 0:
+                self.tree = ET.parse(self.path)
+                self.__merge__(self.tree)
+                snapshot = (copy.deepcopy(self.data), set(self.changed))
+            self.sessions += 1
+            try:
+                yield self
+            except:
+                self.sessions -= 1
+                if self.sessions == 0:
+                    self.data, self.changed = snapshot
+                    self.tree = None
+                    self.dirty = False
+                raise
+            self.sessions -= 1
+            if self.sessions == 0:
+                tree, self.tree = self.tree, None
+                if self.dirty:
+                    self.__save__(tree)
 
     @arglogger
     def set(self, key, value, flush=True, isaw_info=True, original_info=False):
         self.data[key]=value
+        self.changed.add(key)
         if flush:
             if isaw_info:
-                self.__write__()
+                self.__write__(keys=[key])
             if original_info:
-                self.__write__('original')
+                self.__write__('original', [key])
 
     @arglogger
     def set_hierarchy(self, keys, value, d=None, flush=True, isaw_info=True, original_info=False, level=0):
@@ -383,11 +472,13 @@ class Metadata():
                 logger.debug("first key ({0}) is not in the parent dict, so recursing with a new dict".format(keys[0]))
                 d[keys[0]]=self.set_hierarchy(keys[1:], value, {}, level=level+1)
         if level == 0:
+            if d is self.data:
+                self.changed.add(keys[0])
             if flush:
                 if isaw_info:
-                    self.__write__()
+                    self.__write__(keys=[keys[0]])
                 if original_info:
-                    self.__write__('original')
+                    self.__write__('original', [keys[0]])
         return d
 
     @arglogger
@@ -398,6 +489,7 @@ class Metadata():
             l=[]
         l.append(keyword)
         self.data['typology']=l
+        self.changed.add('typology')
 
     @arglogger
     def get(key, value):
@@ -414,6 +506,7 @@ class Metadata():
     @arglogger
     def remove(self, key):
         del self.data[key]
-        self.__write__()
+        self.changed.add(key)
+        self.__write__(keys=[key])
 
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+read a few fields from the meta.xml of every package in a collection, for
+reports, without opening each as a Package
+"""
+
+from arglogger import arglogger
+import logging
+from metadata import cleanval # part of isaw.images
+import multiprocessing
+import os
+import sys
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+# fields read when none are given
+FIELDS = [
+    'status',
+    'license',
+    'license-release-verified',
+    'isaw-publish-cleared',
+    'title',
+    'flickr-url',
+]
+
+# worker processes reading meta.xml files, when not given
+WORKERS = multiprocessing.cpu_count()
+
+# meta.xml files handed to a worker process at a time
+CHUNKSIZE = 64
+
+@arglogger
+def find_packages(path):
+    """
+    list the directories under path that have a meta.xml, sorted; those directories are not searched further
+    """
+    packages = []
+    for dirpath, dirnames, filenames in os.walk(os.path.realpath(path)):
+        if 'meta.xml' in filenames:
+            packages.append(dirpath)
+            dirnames[:] = []
+        else:
+            dirnames.sort()
+    return sorted(packages)
+
+@arglogger
+def scan_file(meta_path, fields=None):
+    """
+    the record of one meta.xml: a dict of the package's id and path, and the
+    text of each of fields (default: FIELDS) that the file has
+
+    fields are named as the keys of metadata.Metadata.data are, with ':'
+    between levels (e.g. 'photographer:given-name'), and only elements holding
+    text are read. as in Metadata, values come from the top level and the
+    'isaw' info, and the 'original' info is ignored. the file is parsed only
+    as far as needed. a file that cannot be read gives a record with an 'error'
+    """
+    if fields is None:
+        fields = FIELDS
+    package_path = os.path.dirname(os.path.realpath(meta_path))
+    record = {'id': os.path.basename(package_path), 'path': package_path}
+    wanted = set(fields)
+    tags = []           # open elements, below the root
+    info_type = None    # type of the open info element, if any
+    try:
+        context = ET.iterparse(meta_path, events=('start', 'end'))
+        event, root = next(context)
+        for event, element in context:
+            if event == 'start':
+                if len(tags) == 0 and element.tag == 'info':
+                    info_type = element.get('type')
+                tags.append(element.tag)
+                continue
+            if element is root:
+                break
+            if tags[0] != 'info':
+                key = ':'.join(tags)
+            elif info_type == 'isaw':
+                key = ':'.join(tags[1:])
+            else:
+                key = None
+            if key in wanted and element.text is not None:
+                value = cleanval(element.text)
+                if len(value) > 0:
+                    record[key] = value
+                    wanted.remove(key)
+            tags.pop()
+            if len(wanted) == 0:
+                break
+            if len(tags) == 0:
+                if element.tag == 'info' and info_type == 'isaw':
+                    break # nothing read comes after the isaw info
+                info_type = None
+                root.clear() # done with this part of the file
+    except (IOError, OSError, SyntaxError) as e:
+        record['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    return record
+
+def __scan__(job):
+    return scan_file(*job)
+
+def scan(packages, fields=None, workers=None, chunksize=CHUNKSIZE):
+    """
+    yield the record (see scan_file) of each package in packages, in order
+
+    packages is either a list of package directories or a directory to search
+    with find_packages(). the files are read on a pool of worker processes
+    (default: WORKERS), chunksize at a time
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    if not isinstance(packages, (list, tuple)):
+        packages = find_packages(packages)
+    jobs = [(os.path.join(package_path, 'meta.xml'), fields) for package_path in packages]
+    if workers is None:
+        workers = WORKERS
+    logger.debug("scanning {0} meta.xml file(s) with {1} worker(s)".format(len(jobs), workers))
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield __scan__(job)
+        return
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        for record in pool.imap(__scan__, jobs, chunksize):
+            yield record
+    finally:
+        pool.terminate()
+        pool.join()
@@ -5,12 +5,15 @@ ISAW Images: Image Package
 """
 
 from arglogger import arglogger # part of isaw.images
-from io import BytesIO
+import colormanagement # part of isaw.images
+from contextlib import contextmanager
 import datetime
 import dominate
 from dominate.tags import *
-import exiftool
-from filehashing import hash_of_file, safe_copy
+import derivatives # part of isaw.images
+import exifworker # part of isaw.images
+from filehashing import hash_of_file, hashes_of_file, safe_copy
+from fixity import verify_file
 from flickr import Flickr # part of isaw.images
 from functools import wraps
 import json
@@ -18,10 +21,12 @@ import logging
 import manifest # part of isaw.images
 import metadata # part of isaw.images
 import os
+import packagelock # part of isaw.images
 from PIL import Image, TiffImagePlugin
-from PIL.ImageCms import getOpenProfile, getProfileName, profileToProfile, ImageCmsProfile
+from PIL.ImageCms import getProfileName, ImageCmsProfile
 from pilkit.utils import save_image
 import pytz
+import pyramid # part of isaw.images
 import shutil
 import sys
 from validate_path import validate_path
@@ -85,8 +90,44 @@ for k in IMAGETYPES.keys():
             r = ext
         EXTENSIONS[ext] = r
 
-SIZEPREVIEW = 800, 600
-SIZETHUMB = 128, 128
+# bagit-style manifests written for new packages (manifest-sha1.txt is always written);
+# add e.g. 'sha256' to keep stronger checksums alongside, at no extra i/o cost
+MANIFEST_ALGORITHMS = ['sha1']
+
+# write a tiled, multi-resolution copy of the master alongside master.tif, so that
+# small views can be read without decoding the full frame (see pyramid.py)
+PYRAMID = False
+PYRAMID_FILENAME = 'master-pyramid.tif'
+
+# attributes of a package opened read-only that are loaded when first used, and the
+# methods that load them
+LAZY = {
+    'manifest': '__load_manifests__',
+    'manifests': '__load_manifests__',
+    'original': '__load_manifests__',
+    'metadata': '__load_metadata__',
+    'doc': '__render_overview__',
+}
+
+# the package history records event times in this zone
+TIMEZONE = pytz.timezone('US/Eastern')
+
+# the steps of Package.create(), in order; batch ingest (see ingest.py) runs each
+# in its own pool of worker processes
+CREATE_STAGES = ['original', 'master', 'derivatives', 'metadata']
+
+# where a package being created notes the stages it has finished and the hashes of
+# the files they wrote, so that an interrupted create() can be resumed
+CREATE_JOURNAL = os.path.join('temp', 'create-journal.json')
+
+# originals whose decoded pixels would take more bytes than this are converted to
+# the master's color profile in strips of at most this many bytes, written to
+# master.tif as they go, instead of being converted whole in memory
+MASTER_STRIP_BYTES = colormanagement.STRIP_BYTES
+
+# byte budget of the derivative cache kept in a package's temp directory when
+# Package.derivative() is not given a shared one
+DERIVATIVE_CACHE_BYTES = 64 * 1024 * 1024
 
 
 class Package(Flickr):
@@ -96,11 +137,16 @@ class Package(Flickr):
 
 
     @arglogger
-    def __init__(self, path=None, id=None, original_path=None):
+    def __init__(self, path=None, id=None, original_path=None, index=None, readonly=False):
+        self.events = []    # history events not yet written (see batch())
+        self.batching = 0   # depth of nested batch() blocks
+        self.flushed = False    # events written to history.txt during the current batch()
+        self.readonly = False
+        self.journal = None # see __begin_create__()
         if path is not None and id is not None and original_path is not None:
-            self.create(path, id, original_path)
+            self.create(path, id, original_path, index=index)
         elif path is not None and id is None and original_path is None:
-            self.open(path)
+            self.open(path, index, readonly)
         self.flickr_capable = False
         Flickr.__init__(self)
 
@@ -117,32 +163,36 @@ class Package(Flickr):
         filename, extension = os.path.splitext(real_path)
         self.original = '.'.join(('original', EXTENSIONS[extension[1:].lower()]))
         dest_path = os.path.join(self.path, self.original) # fix up filename extensions
-        hash_orig = safe_copy(real_path, dest_path)
+        digests = dict((algorithm, None) for algorithm in self.manifests.keys())
+        safe_copy(real_path, dest_path, digests=digests)
         self.__append_event__('copied original file from {src} to {dest}'.format(src=real_path, dest=dest_path))
-        self.manifest.set(self.original, hash_orig)
+        self.__manifest_set__(self.original, digests)
 
         # capture and store metadata from the original file using exiftool
-        # note this could be optimized by re-using a single exiftool instance, but code refactoring will have to happen
-        with exiftool.ExifTool() as et:
-            metadata = et.get_metadata_batch([dest_path,])
+        # the exiftool process is shared by every package created in this process
+        metadata = exifworker.get_worker().get_metadata_batch([dest_path,])
         exif_path = os.path.join(self.path, 'original-exif.json')
-        with open(exif_path, 'w') as exif_file:
+        temp_path = '{0}.{1}.tmp'.format(exif_path, os.getpid())
+        with open(temp_path, 'w') as exif_file:
             for d in metadata:
                 json.dump(d, exif_file, sort_keys=True, indent=4)
                 logger.debug('wrote exiftool metadata for original file on {exif_path}'.format(exif_path=exif_path))
                 for k in d.keys():
                     logger.debug("exiftool found: {key}='{value}'".format(key=k, value=d[k]))
-        hash_exif = hash_of_file(exif_path)
+        os.rename(temp_path, exif_path)
         self.__append_event__('wrote exif extracted from original file in json format on {exif_path}'.format(exif_path=exif_path))
-        self.manifest.set('original-exif.json', hash_exif)
+        self.__manifest_set__('original-exif.json')
 
         # capture and store technical metadata using jhove (TBD)
         logger.warning('no jhove metadata is created')
 
     @arglogger
-    def __generate_master__(self):
+    def __generate_master__(self, pyramid=False):
         """
         create a master file from the original already in the package and set all metadata
+
+        with pyramid=True, a pyramidal sidecar is written too, from the converted
+        image or, if the master was written in strips, from master.tif in strips
         """
         # open original
         # capture existing ICC profile (if there is one)
@@ -159,75 +209,370 @@ class Package(Flickr):
         try:
             raw_profile = original_image.info['icc_profile']
         except KeyError:
-            raw_profile = getOpenProfile(profile_srgb2).tobytes()
+            original_profile = colormanagement.get_profile(path=profile_srgb2)
             logger.warning('{original} does not have an internal ICC color profile'.format(original=self.original))
         else:
             logger.debug('detected internal ICC color profile in {original}'.format(original=self.original))
-        original_profile = getOpenProfile(BytesIO(raw_profile))
+            original_profile = colormanagement.get_profile(raw_profile)
         original_profile_name = getProfileName(original_profile).strip()
-        target_profile = getOpenProfile(profile_srgb4)
+        target_profile = colormanagement.get_profile(path=profile_srgb4)
         target_profile_name = getProfileName(target_profile).strip()
         logger.debug('attempting to convert from "{original}" to "{target}"'.format(original=original_profile_name, target=target_profile_name))
-        converted_image = profileToProfile(original_image, original_profile, target_profile)
         master_path = os.path.join(self.path, 'master.tif')
-        tiffinfo = TiffImagePlugin.ImageFileDirectory()
-        tiffinfo[TiffImagePlugin.ICCPROFILE] = target_profile.tobytes()
-        tiffinfo.tagtype[TiffImagePlugin.ICCPROFILE] = 1 # byte according to TiffTags.TYPES
-        converted_image.DEBUG=True
-        converted_image.save(master_path, tiffinfo=tiffinfo)
-        hash_master = hash_of_file(master_path)
+        width, height = original_image.size
+        if colormanagement.decoded_bytes(original_image) > MASTER_STRIP_BYTES:
+            # too big to hold twice over: convert and write a strip at a time
+            del original_image
+            colormanagement.convert_to_tiff(original_path, master_path, original_profile, target_profile, MASTER_STRIP_BYTES)
+            converted_image = None
+        else:
+            # with a cached transform, or not at all if the original is already in the target profile
+            converted_image = colormanagement.convert(original_image, original_profile, target_profile)
+            tiffinfo = TiffImagePlugin.ImageFileDirectory()
+            tiffinfo[TiffImagePlugin.ICCPROFILE] = colormanagement.bytes_of(target_profile)
+            tiffinfo.tagtype[TiffImagePlugin.ICCPROFILE] = 1 # byte according to TiffTags.TYPES
+            # pillow writes any profile in the image info over tiffinfo, and a transform
+            # leaves littlecms's re-serialization of the target profile there
+            converted_image.info['icc_profile'] = colormanagement.bytes_of(target_profile)
+            temp_path = '{0}.{1}.tmp'.format(master_path, os.getpid())
+            converted_image.save(temp_path, format='TIFF', tiffinfo=tiffinfo)
+            os.rename(temp_path, master_path)
         logger.debug('saved converted master image to {master}'.format(master=master_path))
         self.__append_event__('created master.tif file at {master}'.format(master=master_path))
-        self.manifest.set('master.tif', hash_master)
+        self.__manifest_set__('master.tif')
+        if pyramid:
+            self.__write_pyramid__(colormanagement.bytes_of(target_profile), converted_image)
+
+    def __write_pyramid__(self, icc_profile, image=None):
+        """
+        write the pyramidal sidecar from image, or else from master.tif a strip at a time
+        """
+        pyramid_path = os.path.join(self.path, PYRAMID_FILENAME)
+        if image is None:
+            master_path = os.path.join(self.path, 'master.tif')
+            master_image = Image.open(master_path)
+            strips = colormanagement.iter_strips(master_path, MASTER_STRIP_BYTES)
+            sizes = pyramid.write_pyramid_strips(strips, master_image.size, master_image.mode, pyramid_path, icc_profile)
+        else:
+            sizes = pyramid.write_pyramid(image, pyramid_path, icc_profile)
+        self.__append_event__('created {levels}-level pyramidal tiff at {path}'.format(levels=len(sizes), path=pyramid_path))
+        self.__manifest_set__(PYRAMID_FILENAME)
+
+    @arglogger
+    def make_pyramid(self):
+        """
+        write (or rewrite) the pyramidal sidecar of an existing package's master
+        """
+        self.__check_writable__()
+        master_image = Image.open(os.path.join(self.path, 'master.tif'))
+        with self.batch():
+            self.__write_pyramid__(master_image.info.get('icc_profile'))
 
 
     def __append_event__(self, msg):
         """
         append an event notice to the package history
+
+        inside a batch() block the event is held, and written along with the
+        rest of the block's events when it ends
         """
         logger = logging.getLogger(sys._getframe().f_code.co_name)
         logger.debug(msg)
-        event = '{stamp} {message}\n'.format(stamp=datetime.datetime.now(pytz.timezone('US/Eastern')).isoformat(), message=msg)
-        with open(os.path.join(self.path, 'history.txt'), 'a') as hf:
-            hf.write(event)
-        self.manifest.set('history.txt', hash_of_file(os.path.join(self.path, "history.txt")))
+        self.events.append('{stamp} {message}\n'.format(stamp=datetime.datetime.now(TIMEZONE).isoformat(), message=msg))
+        if self.batching == 0:
+            self.flush_events()
 
     @arglogger
-    def create(self, path, id, original_path):
+    def flush_events(self):
+        """
+        append the events held so far to the package history in one write, and rehash it once
+
+        call it inside a long batch() block to get the history on disk before a
+        step that might crash; the manifests are still written when the block ends,
+        and history.txt stays listed as written even if the block raises
+        """
+        if len(self.events) == 0:
+            return False
+        self.__check_writable__()
+        with packagelock.locked(self.path):
+            with open(os.path.join(self.path, 'history.txt'), 'a') as hf:
+                hf.write(''.join(self.events))
+            self.events = []
+            self.__manifest_set__('history.txt')
+            if self.batching > 0:
+                self.flushed = True
+        return True
+
+    @contextmanager
+    def batch(self):
+        """
+        defer history and manifest writes until the end of a block of changes
+
+        events are appended to history.txt in one write, which is hashed once,
+        and each manifest is written once (see Manifest.batch). if the block
+        raises, its manifest changes are discarded, and so are its events, but
+        for those already flushed (see flush_events), which stay in history.txt
+        and its manifest entries. the package lock (see packagelock.py) is held
+        throughout
+        """
+        with packagelock.locked(self.path):
+            self.batching += 1
+            try:
+                with manifest.batch(self.manifests.values()):
+                    yield self
+                    if self.batching == 1:
+                        self.flush_events()
+            except:
+                if self.batching == 1:
+                    self.events = []
+                    if self.flushed:
+                        # the manifests were put back as they were: list history.txt as it now is
+                        self.flushed = False
+                        self.__manifest_set__('history.txt')
+                raise
+            finally:
+                if self.batching == 1:
+                    self.flushed = False
+                self.batching -= 1
+
+    def __manifest_set__(self, filename, digests=None):
+        """
+        record a file's hashes in every manifest in the package, reading it only once
+        """
+        self.__check_writable__()
+        if digests is None:
+            digests = {}
+        missing = [algorithm for algorithm in self.manifests.keys() if digests.get(algorithm) is None]
+        if len(missing) > 0:
+            digests = dict(digests)
+            digests.update(hashes_of_file(os.path.join(self.path, filename), missing))
+        for algorithm, m in self.manifests.items():
+            m.set(filename, digests[algorithm])
+
+    @arglogger
+    def create(self, path, id, original_path, algorithms=None, index=None, pyramid=None):
         """
         create a new image package at the targeted path
+
+        algorithms lists the manifests to write (default: MANIFEST_ALGORITHMS).
+        given a hashindex.HashIndex, the new package's manifests are indexed as
+        they are written, and an original that another package in the index
+        already holds is rejected with ValueError before the master and
+        derivatives are made (the partial package is removed). pyramid
+        (default: PYRAMID) also writes a pyramidal sidecar of the master.
+        if an earlier create() of the same package was interrupted, it is
+        picked up where it left off (see __begin_create__)
+        """
+        stages = self.__begin_create__(path, id, original_path, algorithms, index)
+        if pyramid is None:
+            pyramid = PYRAMID
+        # every step below updates the history and manifests; write them once, at the end
+        with self.batch():
+            for stage in stages:
+                self.__create_stage__(stage, original_path, index, pyramid)
+        self.__end_create__()
+        self.original = os.path.basename(original_path)
+
+    def __begin_create__(self, path, id, original_path, algorithms=None, index=None):
+        """
+        make the directory, (empty) manifests and journal of a new package, and
+        return the CREATE_STAGES to run
+
+        if the package directory is already there with a journal, creation is
+        resumed instead, with the journal's algorithms: the files it lists are
+        rehashed, those still as recorded go back in the manifests, and the
+        stages from the first that wrote a missing or changed file are run again
         """
         real_path = validate_path(path, 'directory')
-        os.makedirs(os.path.join(real_path, id, 'temp')) # don't we need to destroy this when done? what is it for?
         self.path = os.path.join(real_path, id)
         self.id = id
-        self.manifest = manifest.Manifest(os.path.join(self.path, 'manifest-sha1.txt'), create=True)
-        self.__import_original__(original_path)
-        self.master = self.__generate_master__()
-        self.original = os.path.basename(original_path)
-        self.make_derivatives()
-        self.metadata = metadata.Metadata(os.path.join(self.path, 'meta.xml'), create=True, exiftool_json=os.path.join(self.path, 'original-exif.json'))
-        self.make_overview()
-        self.__append_event__('created package at {path}'.format(path=self.path))
+        self.journal = self.__read_journal__()
+        resuming = self.journal is not None
+        if not resuming:
+            os.makedirs(os.path.join(self.path, 'temp')) # don't we need to destroy this when done? what is it for?
+            if algorithms is None:
+                algorithms = MANIFEST_ALGORITHMS
+            self.journal = {
+                'original_path': os.path.realpath(original_path),
+                'algorithms': sorted(set(['sha1'] + list(algorithms))),
+                'completed': [],
+                'files': {},
+            }
+        elif self.journal['original_path'] != os.path.realpath(original_path):
+            raise ValueError("package {0} was begun from original {1}, not {2}".format(self.path, self.journal['original_path'], original_path))
+        self.manifests = {}
+        for algorithm in self.journal['algorithms']:
+            self.manifests[algorithm] = manifest.Manifest(os.path.join(self.path, manifest.manifest_filename(algorithm)), create=True, index=index)
+        self.manifest = self.manifests['sha1']
+        if resuming:
+            self.__resume_create__()
+        self.__write_journal__()
+        return [stage for stage in CREATE_STAGES if stage not in self.journal['completed']]
+
+    def __resume_create__(self):
+        """
+        put back in the manifests the files of the completed stages in the journal that are still as it records them
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        completed = self.journal['completed']
+        files = self.journal['files']
+        redo = len(completed)
+        # drop the events of a stage that never finished
+        history_path = os.path.join(self.path, 'history.txt')
+        history_size = files['history.txt']['size'] if 'history.txt' in files.keys() else 0
+        if os.path.isfile(history_path) and os.path.getsize(history_path) > history_size:
+            with open(history_path, 'r+b') as f:
+                f.truncate(history_size)
+        for filename in sorted(files.keys()):
+            record = files[filename]
+            file_path = os.path.join(self.path, filename)
+            if not os.path.isfile(file_path) or os.path.getsize(file_path) != record['size'] or hashes_of_file(file_path, record['digests'].keys()) != record['digests']:
+                logger.warning("{0} is missing or has changed since stage '{1}' wrote it".format(file_path, record['stage']))
+                redo = min(redo, completed.index(record['stage']))
+        self.journal['completed'] = completed[:redo]
+        self.journal['files'] = dict((filename, record) for filename, record in files.items() if record['stage'] in self.journal['completed'])
+        with manifest.batch(self.manifests.values()):
+            for filename, record in self.journal['files'].items():
+                for algorithm, m in self.manifests.items():
+                    m.set(filename, record['digests'][algorithm])
+        if 'original' in self.journal['completed']:
+            self.original = self.journal['original']
+        if len(self.journal['completed']) > 0:
+            self.__append_event__('resumed creating package at {path} after stage {stage}'.format(path=self.path, stage=self.journal['completed'][-1]))
+
+    def __journal_stage__(self, stage):
+        """
+        note in the journal that stage is done, along with the hashes of the files it wrote
+        """
+        if self.journal is None:
+            return
+        files = {}
+        for filename, digest in self.manifest.get_all().items():
+            record = self.journal['files'].get(filename)
+            if record is None or record['digests']['sha1'] != digest:
+                record = {
+                    'stage': stage,
+                    'size': os.path.getsize(os.path.join(self.path, filename)),
+                    'digests': dict((algorithm, m.get(filename)) for algorithm, m in self.manifests.items()),
+                }
+            files[filename] = record
+        self.journal['files'] = files
+        if stage not in self.journal['completed']:
+            self.journal['completed'].append(stage)
+        if getattr(self, 'original', None) is not None:
+            self.journal['original'] = self.original
+        self.__write_journal__()
+
+    def __read_journal__(self):
+        journal_path = os.path.join(self.path, CREATE_JOURNAL)
+        if not os.path.isfile(journal_path):
+            return None
+        with open(journal_path, 'r') as f:
+            return json.load(f)
+
+    def __write_journal__(self):
+        journal_path = os.path.join(self.path, CREATE_JOURNAL)
+        temp_path = '{0}.{1}.tmp'.format(journal_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(self.journal, f, sort_keys=True, indent=4)
+        os.rename(temp_path, journal_path)
+
+    def __end_create__(self):
+        """
+        remove the journal of a package whose creation is finished
+        """
+        journal_path = os.path.join(self.path, CREATE_JOURNAL)
+        if os.path.isfile(journal_path):
+            os.remove(journal_path)
+        self.journal = None
 
     @arglogger
-    def open(self, path):
+    def __create_stage__(self, stage, original_path, index=None, pyramid=False):
+        """
+        run one of the CREATE_STAGES on a package begun with __begin_create__ (or picked up with __attach__)
+        """
+        if stage == 'original':
+            self.__import_original__(original_path)
+            if index is not None:
+                # claimed now, not when the manifest is indexed at the end of the batch,
+                # so that concurrent creates from the same original cannot both pass
+                duplicates = index.claim_original(self.id, self.manifest.get(self.original))
+                if len(duplicates) > 0:
+                    shutil.rmtree(self.path)
+                    raise ValueError("original {0} has already been ingested as package(s) {1}".format(original_path, ', '.join(duplicates)))
+        elif stage == 'master':
+            self.master = self.__generate_master__(pyramid)
+        elif stage == 'derivatives':
+            self.make_derivatives()
+        elif stage == 'metadata':
+            self.metadata = metadata.Metadata(os.path.join(self.path, 'meta.xml'), create=True, exiftool_json=os.path.join(self.path, 'original-exif.json'))
+            self.make_overview()
+            self.__append_event__('created package at {path}'.format(path=self.path))
+        else:
+            raise ValueError("unknown package creation stage '{0}'".format(stage))
+        # get the stage's history on disk before noting it done, so that an
+        # interrupted create() can resume after it (see __begin_create__)
+        self.flush_events()
+        self.__journal_stage__(stage)
+
+    def __attach__(self, path, index=None):
+        """
+        pick up a package that is still being created (e.g. by another process),
+        which unlike open() does not need its metadata to exist yet
+        """
+        self.path = validate_path(path, 'directory')
+        self.id = os.path.basename(self.path)
+        self.manifest = manifest.Manifest(os.path.join(self.path, 'manifest-sha1.txt'), index=index)
+        self.manifests = manifest.find_manifests(self.path, index)
+        self.manifests['sha1'] = self.manifest
+        self.journal = self.__read_journal__()
+        for filename in self.manifest.get_all().keys():
+            front, extension = os.path.splitext(filename)
+            if front == 'original' and 'sha1' not in extension:
+                self.original = filename
+
+    @arglogger
+    def open(self, path, index=None, readonly=False):
         """
         open an existing image package at the targeted path
+
+        given a hashindex.HashIndex, the package's manifests keep it current.
+        with readonly=True only the presence of the manifest and meta.xml is
+        checked: the manifests, metadata and overview (self.doc) are loaded
+        when first used, index.html is not rewritten, and anything that would
+        change the package raises IOError
         """
         logger = logging.getLogger(sys._getframe().f_code.co_name)        
         self.path = validate_path(path, 'directory')
         self.id = os.path.basename(self.path)
+        self.index = index
+        self.readonly = readonly
+        for name in LAZY.keys():
+            self.__dict__.pop(name, None)
+        if readonly:
+            validate_path(os.path.join(self.path, 'manifest-sha1.txt'), 'file')
+            try:
+                validate_path(os.path.join(self.path, 'meta.xml'), 'file')
+            except IOError:
+                logger.warning("no meta.xml file was found in the package for this image ({0})".format(self.id))
+                raise
+            return
         # verify original and master and metadata and checksums
         # TBD
         # open manifest and metadata
-        self.manifest = manifest.Manifest(os.path.join(self.path, 'manifest-sha1.txt'))
+        self.__load_manifests__()
+        self.__load_metadata__()
         try:
-            self.metadata = metadata.Metadata(os.path.join(self.path, 'meta.xml'))
-        except IOError:
-            logger.warning("no meta.xml file was found in the package for this image ({0})".format(self.id))
+            o = self.original
+        except AttributeError:
+            logger.error("no original image file was found in the package for this image ({0})".format(self.id))
+            raise
+        self.make_overview()
 
-            raise 
+    def __load_manifests__(self):
+        self.manifest = manifest.Manifest(os.path.join(self.path, 'manifest-sha1.txt'), index=self.index)
+        self.manifests = manifest.find_manifests(self.path, self.index)
+        self.manifests['sha1'] = self.manifest
         # see if there is an original file yet
         filenames = self.manifest.get_all().keys()
         for filename in filenames:
@@ -235,97 +580,159 @@ class Package(Flickr):
                 front, extension = os.path.splitext(filename)
                 if 'sha1' not in extension:
                     self.original = filename
+
+    def __load_metadata__(self):
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
         try:
-            o = self.original
-        except AttributeError:
-            logger.error("no original image file was found in the package for this image ({0})".format(self.id))
+            self.metadata = metadata.Metadata(os.path.join(self.path, 'meta.xml'))
+        except IOError:
+            logger.warning("no meta.xml file was found in the package for this image ({0})".format(self.id))
             raise
-        self.make_overview()
+
+    def __getattr__(self, name):
+        # packages opened read-only load these attributes when they are first used
+        loader = LAZY.get(name)
+        if loader is None or not self.__dict__.get('readonly', False):
+            raise AttributeError(name)
+        getattr(self, loader)()
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __check_writable__(self):
+        if self.readonly:
+            raise IOError("package {0} was opened read-only".format(self.path))
+
+    @arglogger
+    def overview_current(self):
+        """
+        true if index.html exists and is no older than meta.xml
+        """
+        try:
+            return os.path.getmtime(os.path.join(self.path, 'index.html')) >= os.path.getmtime(os.path.join(self.path, 'meta.xml'))
+        except OSError:
+            return False
 
 
     @arglogger
     def make_derivatives(self, overwrite=False):
         """
         create derivative images
+
+        only derivatives whose master or profile settings have changed since they
+        were made (see derivatives.stale()) are made again, unless overwrite is
+        set; returns False if there was nothing to do
         """
         logger = logging.getLogger(sys._getframe().f_code.co_name)   
-        try:
-            thumbnail = self.thumbnail
-        except AttributeError:
-            pass
+        if overwrite:
+            names = derivatives.PROFILES.keys()
         else:
-            if not overwrite:
+            names = derivatives.stale(self.path, self.manifest.get_all())
+            if len(names) == 0:
                 return False
-        master_path = os.path.join(self.path, 'master.tif')
-        master_image = Image.open(master_path)
-        master_profile = master_image.info.get('icc_profile')
+        self.__check_writable__()
+        # write the history and manifests once for all the derivatives
+        with self.batch():
+            if not overwrite:
+                # another process may have made them while we waited for the lock
+                names = derivatives.stale(self.path, self.manifest.get_all())
+                if len(names) == 0:
+                    return False
+            records = derivatives.read_provenance(self.path)
+            master_path = os.path.join(self.path, 'master.tif')
+            master_image = Image.open(master_path)
+            master_profile = master_image.info.get('icc_profile')
+            logger.debug("master size: {0}, {1}".format(master_image.size[0], master_image.size[1]))
+
+            # each derivative is made from the smallest adequate one already made (e.g. the
+            # thumbnail from the preview), and the master is decoded only once; see
+            # derivatives.plan(). Note: the resampling algorithm that gives the highest
+            # quality result (bicubic) is expensive in terms of compute time, and that
+            # expense is proportional to the size of the source image. derivatives.shrink()
+            # therefore first box-reduces the source by a whole factor to within twice the
+            # target size, and only then runs bicubic. No full-size copy of the master is made.
+            steps = derivatives.derive(master_image, names)
+            del master_image # save RAM once the derivatives made from it are done
+            for name, image in steps:
+                spec = derivatives.PROFILES[name]
+                path = os.path.join(self.path, spec['filename'])
+                temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+                options = dict(spec['options'], icc_profile=master_profile)
+                try:
+                    save_image(image, temp_path, spec['format'], options=options)
+                except IOError:
+                    if 'quality' not in options.keys():
+                        raise
+                    del options['quality']
+                    save_image(image, temp_path, spec['format'], options=options)
+                    logger.warning("{0} image could not be written at quality {1}; using defaults".format(name, spec['options']['quality']))
+                os.rename(temp_path, path)
+                del image # save the RAMs!
+                setattr(self, name, True)
+                self.__append_event__("wrote derivative '{0}' {1} file on {2}".format(name, spec['format'].lower(), path))
+                self.__manifest_set__(spec['filename'])
+                records[spec['filename']] = derivatives.provenance(name, self.manifest.get('master.tif'), self.manifest.get(spec['filename']))
+            derivatives.write_provenance(self.path, records)
+        return True
 
-        # make and save "maximum" image, a jpeg same resolution as the master
-        maximum_image = master_image.copy()
-        maximum_path = os.path.join(self.path, 'maximum.jpg')
-        try:
-            save_image(maximum_image, maximum_path, 'JPEG', options={'optimize':True, 'progressive':False, 'quality':95, 'icc_profile':master_profile})
-        except IOError:
-            save_image(preview_image, preview_path, 'JPEG', options={'optimize':True, 'progressive':False, 'icc_profile':master_profile})
-        self.maximum = True
-        maximum_hash = hash_of_file(maximum_path)
-        self.__append_event__("Wrote derivative 'maximum' jpeg file on {0}".format(maximum_path))
-        self.manifest.set('maximum.jpg', maximum_hash)
-        del maximum_image # save RAM
-
-        # make and save preview image
-        # Note: the resampling algorithm that gives the highest quality result (bicubic)
-        # is expensive in terms of compute time, and that expense is proportional to the
-        # size of the original image and the relative size of the target image. 
-        # Consequently, if the starting image is significantly larger than the desired 
-        # down-sampled image, we'll make a first pass with the much less expensive 
-        # "nearest neighbor" resampling algorithm to get an image that is only twice the
-        # size of the target, then use "bicubic" on it to get the desired outcome. The
-        # wisdom of the Internet seems to point to this as a time-saving step that 
-        # sacrifices little or nothing in quality. Caveat lector. Of course, if we 
-        # really wanted to do this fast, we'd write it in C.
-        preview_image = master_image.copy()
-        del master_image # save RAM
-        size = preview_image.size
-        logger.debug("master size: {0}, {1}".format(size[0], size[1]))
-        if size[0] > 3* SIZEPREVIEW[0] or size[1] > 3* SIZEPREVIEW[1]:
-            preview_image.thumbnail(tuple(s*2 for s in SIZEPREVIEW), Image.NEAREST)
-            logger.debug("did nearest pre-shrink for preview, resulting size: {0}, {1}".format(preview_image.size[0], preview_image.size[1]))
-        preview_image.thumbnail(SIZEPREVIEW)
-        logger.debug("resulting preview size: {0}, {1}".format(preview_image.size[0], preview_image.size[1]))
-        preview_path = os.path.join(self.path, 'preview.jpg')
-        try:
-            save_image(preview_image, preview_path, 'JPEG', options={'optimize':True, 'progressive':True, 'quality':80, 'icc_profile':master_profile})
-        except IOError:
-            save_image(preview_image, preview_path, 'JPEG', options={'optimize':True, 'progressive':True, 'icc_profile':master_profile})
-            logger.warning("preview image could not be written at quality 80; using defaults")
-        self.preview = True
-        preview_hash = hash_of_file(preview_path)
-        self.__append_event__("wrote derivative 'preview' jpeg file on {0}".format(preview_path))
-        self.manifest.set('preview.jpg', preview_hash)
-
-        # make and save thumbnail image
-        # Note: use the same approach as above, but start with the preview image, which
-        # is surely much smaller than the master.
-        thumbnail_image = preview_image.copy()
-        del preview_image # save the RAMs!
-        thumbnail_image.thumbnail(SIZETHUMB)
-        thumbnail_path = os.path.join(self.path, 'thumb.jpg')
+    @arglogger
+    def derivative(self, width, height, format='JPEG', quality=80, cache=None):
+        """
+        get a derivative fitting within width x height, rendering it only if it is not cached
+
+        cache is a derivatives.DerivativeCache, as a rule shared by the whole
+        collection; by default a small one in the package's temp directory is
+        used, which a package opened read-only may not do (IOError). entries are keyed by the master's manifest hash, so a changed
+        master is never served stale derivatives. derivatives are rendered from
+        the pyramidal sidecar if there is one, otherwise from master.tif.
+        returns the path of the derivative file
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        format = format.upper()
+        if format not in IMAGETYPES.keys() or not IMAGETYPES[format]['write']:
+            raise ValueError("cannot write derivatives in format '{0}'".format(format))
+        extension = IMAGETYPES[format].get('write_extension', IMAGETYPES[format]['extensions'][0])
+        key = '{0}-{1}x{2}-q{3}.{4}'.format(self.manifest.get('master.tif'), width, height, quality, extension)
+        own_cache = cache is None
+        if own_cache:
+            self.__check_writable__()
+            cache = derivatives.DerivativeCache(os.path.join(self.path, 'temp', 'derivatives'), DERIVATIVE_CACHE_BYTES)
         try:
-            save_image(thumbnail_image, thumbnail_path, 'JPEG', options={'optimize':True, 'progressive':True, 'quality':80, 'icc_profile':master_profile})
-        except IOError:
-            save_image(thumbnail_image, thumbnail_path, 'JPEG', options={'optimize':True, 'progressive':True, 'icc_profile':master_profile})
-            logger.warning("preview image could not be written at quality 80; using defaults")
-        self.thumbnail = True
-        thumbnail_hash = hash_of_file(thumbnail_path)
-        self.__append_event__("wrote derivative 'thumbnail' jpeg file on {0}".format(thumbnail_path))
-        self.manifest.set('thumb.jpg', thumbnail_hash)
-
-        del thumbnail_image # probably not necessary to save the RAM here cuz gc will get it but anyway...
-        return True
-        
+            filepath = cache.get(key)
+            if filepath is None:
+                if PYRAMID_FILENAME in self.manifest.get_all().keys():
+                    source_path = os.path.join(self.path, PYRAMID_FILENAME)
+                else:
+                    source_path = os.path.join(self.path, 'master.tif')
+                def write(path):
+                    profile = Image.open(source_path).info.get('icc_profile')
+                    image = derivatives.render(source_path, (width, height))
+                    save_image(image, path, format, options={'optimize':True, 'quality':quality, 'icc_profile':profile})
+                filepath = cache.put(key, write)
+                logger.debug("rendered {0}x{1} {2} derivative of {3} on {4}".format(width, height, format, self.id, filepath))
+        finally:
+            if own_cache:
+                cache.close()
+        return filepath
+
     @arglogger
     def make_overview(self):
+        """
+        render the html overview of the package and write it on index.html
+        """
+        self.__check_writable__()
+        self.__render_overview__()
+        outfn = os.path.join(self.path, 'index.html')
+        temp_path = '{0}.{1}.tmp'.format(outfn, os.getpid())
+        with packagelock.locked(self.path):
+            outf = open(temp_path, 'w')
+            outf.write(self.doc.render())
+            outf.close()
+            os.rename(temp_path, outfn)
+
+    def __render_overview__(self):
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
         self.doc = dominate.document(title="Overview '{0}'".format(self.id))
         with self.doc.head:
             style(""" 
@@ -418,12 +825,6 @@ class Package(Flickr):
                             p("{0}: {1}".format(k, val))
 
 
-        outfn = os.path.join(self.path, 'index.html')
-        outf = open(outfn, 'w')
-        outf.write(self.doc.render())
-        outf.close()        
-
-
     @arglogger
     def delete(self):
         """
@@ -433,9 +834,15 @@ class Package(Flickr):
 
 
     @arglogger
-    def validate(self):
+    def validate(self, cache=None, trust_days=None):
         """
         verify completeness and fixity of the current package
+
+        checksums are verified against whichever manifest present is cheapest among
+        the strong algorithms (see manifest.PREFERENCE). by default every file in
+        the manifest is rehashed; given a fixity.FixityCache and trust_days, files
+        that are unchanged on disk since they were verified within the last
+        trust_days days are not rehashed
         """
         logger = logging.getLogger(sys._getframe().f_code.co_name)  
         try:
@@ -444,14 +851,17 @@ class Package(Flickr):
             logger.warning('Package.validate() was called before Package.path was set.')
             return False
         try:
-            manifest = self.manifest
+            manifests = self.manifests
         except AttributeError:
             logger.warning('Package.validate() was called before Package.manifest was set.')
             return False
         result = True
+        algorithm = manifest.preferred_algorithm(manifests.keys())
+        m = manifests[algorithm]
+        logger.debug("validating against {0}".format(os.path.basename(m.path)))
 
         # make sure the minimally required components are present and have been successfully opened
-        filenames=self.manifest.get_all().keys()
+        filenames=m.get_all().keys()
         if 'master.tif' not in filenames:
             result = False
             logger.error("Validation failed to find 'master.tif' in manifest")
@@ -461,15 +871,49 @@ class Package(Flickr):
 
         # verify that checksums are valid for every item in the manifest
         for filename in filenames:
-            checksum = self.manifest.get(filename)
+            checksum = m.get(filename)
             filepath = os.path.join(path, filename)
             real_filepath = validate_path(filepath, 'file')
-            if checksum != hash_of_file(real_filepath):
+            if checksum != verify_file(real_filepath, checksum, cache, trust_days, algorithm)[0]:
                 logger.error("checksum verification FAILED on '{0}' in Package.validate()".format(real_filepath))
                 result = False
 
         return result
 
 
+    @arglogger
+    def add_manifests(self, algorithms):
+        """
+        add manifests for more hash algorithms to an existing package
 
-
+        each file is read once: its sha1 is checked against manifest-sha1.txt and,
+        only if it matches, its new hashes are recorded
+        """
+        new = [algorithm for algorithm in algorithms if algorithm not in self.manifests.keys()]
+        if len(new) == 0:
+            return False
+        self.__check_writable__()
+        with packagelock.locked(self.path):
+            return self.__add_manifests__(new)
+
+    def __add_manifests__(self, new):
+        self.__append_event__('adding {0} manifest(s)'.format(', '.join(new)))
+        self.manifest.__read__() # as it is now that the package is locked
+        entries = self.manifest.get_all()
+        added = {}
+        for algorithm in new:
+            added[algorithm] = manifest.Manifest(os.path.join(self.path, manifest.manifest_filename(algorithm)), create=True, index=self.manifest.index)
+        try:
+            with manifest.batch(added.values()):
+                for filename in sorted(entries.keys()):
+                    digests = hashes_of_file(os.path.join(self.path, filename), ['sha1'] + new)
+                    if digests['sha1'] != entries[filename]:
+                        raise IOError("checksum verification FAILED on '{0}' while adding manifests".format(filename))
+                    for algorithm in new:
+                        added[algorithm].set(filename, digests[algorithm])
+        except:
+            for m in added.values():
+                os.remove(m.path)
+            raise
+        self.manifests.update(added)
+        return True
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+advisory per-package locks, so that processes (on this host or others sharing the
+storage) do not lose each other's changes to a package's files
+"""
+
+from arglogger import arglogger
+from contextlib import contextmanager
+import errno
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+# the lock file in a package directory; it is never listed in manifests
+LOCK_FILENAME = 'package.lock'
+
+# seconds to wait for a lock held by someone else before giving up with IOError
+TIMEOUT = 300.0
+
+# seconds after which a lock file that has not been touched is taken to be left
+# behind by a holder on another host that died; a holder on this host is checked
+# directly. holders touch the lock file every HEARTBEAT seconds while they hold it
+STALE = 1800.0
+HEARTBEAT = 60.0
+
+# seconds between attempts to take a lock held by someone else
+POLL = 0.1
+
+class PackageLock():
+    """
+    an advisory lock on a package directory: a lock file created with O_EXCL,
+    which is atomic on local filesystems and on nfs (v3 and later), recording
+    the host and process that hold it
+
+    the lock is re-entrant within a thread, and other threads of the same
+    process wait for it; use get_lock() or locked() to share one PackageLock
+    per package within a process
+    """
+
+    @arglogger
+    def __init__(self, path, timeout=None, stale=None):
+        self.path = os.path.join(os.path.realpath(path), LOCK_FILENAME)
+        self.timeout = timeout
+        self.stale = stale
+        self.depth = 0  # times the lock has been taken, and not yet released, by the thread holding it
+        self.thread_lock = threading.RLock()
+        self.holder = None      # what we wrote to the lock file while we hold it
+        self.heartbeat = None   # (thread, event to stop it) touching the lock file while we hold it
+
+    def __holder__(self, path=None):
+        """
+        the contents of the lock file (or of another file at path), or None if there is none or it cannot be read yet
+        """
+        try:
+            with open(path or self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def __is_ours__(self):
+        return self.holder is not None and self.__holder__() == self.holder
+
+    def __beat__(self, stop):
+        """
+        touch the lock file every HEARTBEAT seconds until stop is set, so that
+        other hosts do not take a long hold for a stale one
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        while not stop.wait(HEARTBEAT):
+            if not self.__is_ours__():
+                logger.warning("lost the lock on {0} to {1}".format(os.path.dirname(self.path), self.__holder__()))
+                return
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+    def __is_stale__(self, holder):
+        if holder is not None and holder.get('host') == socket.gethostname():
+            try:
+                os.kill(holder['pid'], 0)
+            except OSError as e:
+                return e.errno == errno.ESRCH
+            return False
+        stale = self.stale if self.stale is not None else STALE
+        try:
+            return time.time() - os.path.getmtime(self.path) > stale
+        except OSError:
+            return False
+
+    def __break__(self, holder):
+        """
+        remove a stale lock file, unless someone else has already replaced it
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        broken_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            os.rename(self.path, broken_path)
+        except OSError:
+            return # someone else broke it first
+        if self.__holder__(broken_path) != holder:
+            # the lock was broken and taken again between our look and the rename: put it back
+            try:
+                os.link(broken_path, self.path)
+            except OSError:
+                pass
+        else:
+            logger.warning("broke stale lock on {0} held by {1}".format(os.path.dirname(self.path), holder))
+        os.remove(broken_path)
+
+    def __take__(self):
+        timeout = self.timeout if self.timeout is not None else TIMEOUT
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                self.holder = {'host': socket.gethostname(), 'pid': os.getpid(), 'acquired': time.time()}
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.holder, f)
+                stop = threading.Event()
+                thread = threading.Thread(target=self.__beat__, args=(stop,))
+                thread.daemon = True
+                thread.start()
+                self.heartbeat = (thread, stop)
+                return
+            holder = self.__holder__()
+            if self.__is_stale__(holder):
+                self.__break__(holder)
+                continue
+            if time.time() > deadline:
+                raise IOError("timed out after {0} seconds waiting for the lock on {1}, held by {2}".format(timeout, os.path.dirname(self.path), holder))
+            time.sleep(POLL)
+
+    @arglogger
+    def acquire(self):
+        """
+        take the lock, waiting up to timeout seconds (default: TIMEOUT) if someone else holds it
+        """
+        self.thread_lock.acquire()
+        self.depth += 1
+        if self.depth > 1:
+            # already ours: show that we are still alive
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+            return
+        try:
+            self.__take__()
+        except:
+            self.depth -= 1
+            self.thread_lock.release()
+            raise
+
+    @arglogger
+    def release(self):
+        """
+        let go of the lock; the lock file is removed only if it is still ours, and
+        not one taken by someone else who found ours stale
+        """
+        logger = logging.getLogger(sys._getframe().f_code.co_name)
+        self.depth -= 1
+        if self.depth == 0:
+            thread, stop = self.heartbeat
+            stop.set()
+            thread.join()
+            self.heartbeat = None
+            if self.__is_ours__():
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+            else:
+                logger.warning("lost the lock on {0} to {1}".format(os.path.dirname(self.path), self.__holder__()))
+            self.holder = None
+        self.thread_lock.release()
+
+    def held(self):
+        """
+        true if this process holds the lock
+        """
+        return self.depth > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+# the lock of each package used in this process, and the id of that process
+LOCKS = {}
+LOCKS_PID = None
+LOCKS_LOCK = threading.Lock()
+
+@arglogger
+def get_lock(path):
+    """
+    the PackageLock shared within the calling process for the package directory at path
+    """
+    global LOCKS, LOCKS_PID
+    real_path = os.path.realpath(path)
+    with LOCKS_LOCK:
+        if LOCKS_PID != os.getpid():
+            # locks held by a parent process are not held by its children
+            LOCKS = {}
+            LOCKS_PID = os.getpid()
+        if real_path not in LOCKS.keys():
+            LOCKS[real_path] = PackageLock(real_path)
+        return LOCKS[real_path]
+
+@contextmanager
+def locked(path):
+    """
+    hold the lock on the package directory at path for the duration of a block
+    """
+    lock = get_lock(path)
+    lock.acquire()
+    try:
+        yield lock
+    finally:
+        lock.release()
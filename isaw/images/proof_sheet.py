@@ -6,9 +6,11 @@ code to create an HTML proof sheet from a folder full of isaw.image packages
 
 from arglogger import arglogger
 import datetime
+import derivatives # part of isaw.images
 import dominate
 from dominate.tags import *
 import logging
+import metascan # part of isaw.images
 import os
 import package
 import pytz
@@ -28,17 +30,19 @@ class Proof():
     """
 
     @arglogger
-    def __init__(self, path=None):
+    def __init__(self, path=None, cache=None, trust_days=None):
         logger = logging.getLogger(sys._getframe().f_code.co_name)
         if path is not None:
-            self.__generate__(path)
+            self.__generate__(path, cache, trust_days)
         else:
             logger.warning("Proof.init called with path=None")
 
     @arglogger
-    def __generate__(self, path):
+    def __generate__(self, path, cache=None, trust_days=None):
         """
         create the proof sheet
+
+        cache and trust_days are passed through to Package.validate()
         """
 
         logger = logging.getLogger(sys._getframe().f_code.co_name)
@@ -51,17 +55,22 @@ class Proof():
         for d in directories:
             pkg = package.Package()
             try:
-                pkg.open(os.path.join(path,d))
+                pkg.open(os.path.join(path,d), readonly=True)
             except IOError, e:
                 logger.warning("failed trying to open directory '{0}' as a package: {1}".format(d, e))
                 self.other_directories.append(d)
             else:
-                if pkg.validate():
+                if pkg.validate(cache, trust_days):
                     self.packages.append(pkg)
                 else:
                     logger.warning("successfully opened directory '{0}' as a package, but it failed to validate".format(d))
                     self.other_directories.append(d)
 
+        # read just the metadata shown below, from all the packages at once
+        records = {}
+        for record in metascan.scan([pkg.path for pkg in self.packages], fields=['title', 'flickr-url'] + METAKEYS):
+            records[record['path']] = record
+
         # create the HTML proof sheet
         dirname = os.path.basename(real_path)
         self.doc = dominate.document(title="Proof '{0}'".format(dirname))
@@ -120,19 +129,22 @@ class Proof():
                 h2("Image packages in this folder:")
                 for pkg in self.packages:
                     with div(id=pkg.id, cls='package'):
+                        m = records[os.path.realpath(pkg.path)]
                         try:
-                            title=pkg.metadata.data['title']
+                            title=m['title']
                         except KeyError:
                             title='[[no title]]'
                         p("{0} ({1}".format(title, pkg.id), cls='caption')
-                        pkg.make_derivatives(overwrite=False)
+                        # packages are scanned read-only, and reopened for writing only
+                        # if their derivatives or overview need to be made again
+                        if len(derivatives.stale(pkg.path, pkg.manifest.get_all())) > 0 or not pkg.overview_current():
+                            pkg.open(pkg.path)
+                            pkg.make_derivatives(overwrite=False)
                         with div(cls='image'):
                             with a(href="./{0}/{1}".format(pkg.id, 'index.html')):
                                 img(src="./{0}/{1}".format(pkg.id, 'thumb.jpg'), alt="thumbnail of image with id='{0}'".format(pkg.id))
                         with div(cls='metadata'):
-                            try:        
-                                m=pkg.metadata.data
-                            except AttributeError:
+                            if 'error' in m.keys():
                                 p('[[no valid metadata!]]')
                             else:
                                 for k in METAKEYS:
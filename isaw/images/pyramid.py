@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+write and read tiled, multi-resolution (pyramidal) tiffs
+"""
+
+from arglogger import arglogger
+import logging
+import os
+from PIL import Image
+import struct
+import sys
+import zlib
+
+TILE_SIZE = 256
+
+# tiff compression codes this module writes and can read tile by tile
+COMPRESSION = {None: 1, 'deflate': 8}
+
+# samples and photometric interpretation for each pillow mode the writer supports
+MODES = {
+    'L': (1, 1),
+    'RGB': (3, 2),
+    'RGBA': (4, 2),
+}
+
+# tiff field types
+SHORT = 3
+LONG = 4
+UNDEFINED = 7
+FORMATS = {SHORT: 'H', LONG: 'I', UNDEFINED: 'B'}
+
+@arglogger
+def level_sizes(size, tile_size=TILE_SIZE):
+    """
+    the size of the full image, then of successive halvings until one fits in a single tile
+    """
+    sizes = [size]
+    while size[0] > tile_size or size[1] > tile_size:
+        size = (max(1, size[0] // 2), max(1, size[1] // 2))
+        sizes.append(size)
+    return sizes
+
+def halve(image, size):
+    """
+    average each 2x2 block of image down to one pixel of an image of size, dropping
+    an odd last row or column (a dimension of 1 is kept); each output row depends
+    only on its own two input rows, so an image can be halved a few rows at a time
+    """
+    box = (0, 0, min(image.size[0], 2 * size[0]), min(image.size[1], 2 * size[1]))
+    return image.crop(box).resize(size, Image.BOX)
+
+@arglogger
+def pyramid_levels(image, tile_size=TILE_SIZE):
+    """
+    yield the full image, then successive halvings until one fits in a single tile
+    """
+    yield image
+    for size in level_sizes(image.size, tile_size)[1:]:
+        image = halve(image, size)
+        yield image
+
+def __stack__(top, bottom):
+    """
+    bottom pasted below top, which may be None
+    """
+    if top is None:
+        return bottom
+    image = Image.new(top.mode, (top.size[0], top.size[1] + bottom.size[1]))
+    image.paste(top, (0, 0))
+    image.paste(bottom, (0, top.size[1]))
+    return image
+
+def ifd_bytes(entries, offset, next_offset=0):
+    """
+    pack a tiff image file directory to be written at offset; values that do
+    not fit in an entry are placed directly after the directory
+    """
+    entries = sorted(entries)
+    head = struct.pack('<H', len(entries))
+    extra = b''
+    extra_offset = offset + 2 + 12 * len(entries) + 4
+    body = b''
+    for tag, tagtype, values in entries:
+        if tagtype == UNDEFINED:
+            data = bytes(values)
+            count = len(data)
+        else:
+            data = struct.pack('<{0}{1}'.format(len(values), FORMATS[tagtype]), *values)
+            count = len(values)
+        if len(data) <= 4:
+            body += struct.pack('<HHI', tag, tagtype, count) + data.ljust(4, b'\0')
+        else:
+            body += struct.pack('<HHII', tag, tagtype, count, extra_offset + len(extra))
+            extra += data
+            if len(extra) % 2:
+                extra += b'\0'
+    return head + body + struct.pack('<I', next_offset) + extra
+
+@arglogger
+def write_pyramid(image, path, icc_profile=None, tile_size=TILE_SIZE, compression='deflate'):
+    """
+    write image to path as a tiled tiff holding the full resolution as its first
+    page, followed by reduced-resolution pages down to a single tile
+
+    every page carries icc_profile, if given. pillow cannot write tiled tiffs,
+    hence the hand-rolled writer; readers that do not understand pyramids still
+    see an ordinary image in the first page. returns the list of level sizes
+    """
+    strips = ((y, image.crop((0, y, image.size[0], min(y + tile_size, image.size[1])))) for y in range(0, image.size[1], tile_size))
+    return write_pyramid_strips(strips, image.size, image.mode, path, icc_profile, tile_size, compression)
+
+@arglogger
+def write_pyramid_strips(strips, size, mode, path, icc_profile=None, tile_size=TILE_SIZE, compression='deflate'):
+    """
+    write_pyramid() for an image of size and mode given as (first row, image of
+    rows) strips from top to bottom, as colormanagement.iter_strips() yields them
+
+    each level is tiled and halved into the next as its rows arrive, so only a
+    few rows of each level are held at once; the pages are the same as
+    write_pyramid() makes from the whole image
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    if mode not in MODES.keys():
+        raise ValueError("cannot write a pyramid from an image in mode '{0}'".format(mode))
+    samples, photometric = MODES[mode]
+    sizes = level_sizes(size, tile_size)
+    received = [0] * len(sizes)         # rows of each level made so far
+    untiled = [None] * len(sizes)       # rows of each level not yet written as tiles
+    unhalved = [None] * len(sizes)      # rows of each level not yet halved into the next
+    offsets = [[] for s in sizes]
+    counts = [[] for s in sizes]
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+
+        def add_rows(level, rows):
+            width, height = sizes[level]
+            first = received[level]
+            received[level] += rows.size[1]
+            untiled[level] = __stack__(untiled[level], rows)
+            while untiled[level] is not None and (untiled[level].size[1] >= tile_size or received[level] >= height):
+                band = untiled[level]
+                for x in range(0, width, tile_size):
+                    data = band.crop((x, 0, x + tile_size, tile_size)).tobytes()
+                    if compression == 'deflate':
+                        data = zlib.compress(data, 6)
+                    offsets[level].append(f.tell())
+                    counts[level].append(len(data))
+                    f.write(data)
+                    if f.tell() % 2:
+                        f.write(b'\0')
+                untiled[level] = band.crop((0, tile_size, width, band.size[1])) if band.size[1] > tile_size else None
+            if level + 1 == len(sizes):
+                return
+            half_width, half_height = sizes[level + 1]
+            if unhalved[level] is not None:
+                first -= unhalved[level].size[1]
+            band = unhalved[level] = __stack__(unhalved[level], rows)
+            if height == 1:
+                count = band.size[1]
+            else:
+                count = min(received[level], 2 * half_height) - first
+                count -= count % 2
+            if count <= 0:
+                return
+            unhalved[level] = band.crop((0, count, width, band.size[1])) if band.size[1] > count else None
+            add_rows(level + 1, halve(band.crop((0, 0, width, count)), (half_width, max(1, count // 2))))
+
+        f.write(struct.pack('<2sHI', b'II', 42, 0))
+        for y, rows in strips:
+            add_rows(0, rows)
+        pointer = 4 # where to record the offset of the next directory
+        for level, (width, height) in enumerate(sizes):
+            entries = [
+                (254, LONG, [1 if level > 0 else 0]),   # NewSubfileType: reduced resolution
+                (256, LONG, [width]),                   # ImageWidth
+                (257, LONG, [height]),                  # ImageLength
+                (258, SHORT, [8] * samples),            # BitsPerSample
+                (259, SHORT, [COMPRESSION[compression]]),
+                (262, SHORT, [photometric]),
+                (277, SHORT, [samples]),                # SamplesPerPixel
+                (284, SHORT, [1]),                      # PlanarConfiguration: chunky
+                (322, LONG, [tile_size]),               # TileWidth
+                (323, LONG, [tile_size]),               # TileLength
+                (324, LONG, offsets[level]),            # TileOffsets
+                (325, LONG, counts[level]),             # TileByteCounts
+            ]
+            if mode == 'RGBA':
+                entries.append((338, SHORT, [2]))       # ExtraSamples: unassociated alpha
+            if icc_profile is not None:
+                entries.append((34675, UNDEFINED, bytearray(icc_profile)))
+            ifd_offset = f.tell()
+            f.seek(pointer)
+            f.write(struct.pack('<I', ifd_offset))
+            f.seek(ifd_offset)
+            f.write(ifd_bytes(entries, ifd_offset))
+            pointer = ifd_offset + 2 + 12 * len(entries)
+            logger.debug("wrote pyramid level {0} at {1}x{2} in {3} tiles".format(level, width, height, len(offsets[level])))
+    os.rename(temp_path, path)
+    return sizes
+
+@arglogger
+def read_level(path, level):
+    """
+    read one resolution level of a pyramidal tiff; level 0 is full resolution
+    """
+    image = Image.open(path)
+    image.seek(level)
+    image.load()
+    return image
+
+@arglogger
+def read_region(path, box, level=0):
+    """
+    read the region box (left, upper, right, lower in that level's pixels) of
+    one resolution level, decoding only the tiles that it touches
+
+    files not written by write_pyramid (e.g. other compressions) fall back to
+    decoding the whole level and cropping it
+    """
+    logger = logging.getLogger(sys._getframe().f_code.co_name)
+    image = Image.open(path)
+    image.seek(level)
+    tags = image.tag_v2
+    compression = tags.get(259, 1)
+    if 322 not in tags or compression not in COMPRESSION.values() or image.mode not in MODES.keys():
+        logger.debug("reading all of level {0} of {1} to crop a region".format(level, path))
+        image.load()
+        return image.crop(box)
+    tile_width = tags[322]
+    tile_height = tags[323]
+    offsets = tags[324]
+    counts = tags[325]
+    across = (image.size[0] + tile_width - 1) // tile_width
+    left, upper, right, lower = box
+    region = Image.new(image.mode, (right - left, lower - upper))
+    with open(path, 'rb') as f:
+        for row in range(upper // tile_height, (min(lower, image.size[1]) - 1) // tile_height + 1):
+            for column in range(left // tile_width, (min(right, image.size[0]) - 1) // tile_width + 1):
+                i = row * across + column
+                f.seek(offsets[i])
+                data = f.read(counts[i])
+                if compression == COMPRESSION['deflate']:
+                    data = zlib.decompress(data)
+                tile = Image.frombytes(image.mode, (tile_width, tile_height), data)
+                region.paste(tile, (column * tile_width - left, row * tile_height - upper))
+    return region
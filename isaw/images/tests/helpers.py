@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+fixtures shared by the isaw.images nosetests
+"""
+
+from isaw.images import manifest
+import os
+import shutil
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def make_collection(temp, count):
+    """
+    copy the kalabsha package into temp count times, giving each copy a stand-in
+    master.tif (the test data has none) and a freshly generated manifest
+    """
+    srcpath = os.path.join(DATA, 'kalabsha', '201107061813531')
+    for x in range(0, count):
+        destpath = os.path.join(temp, 'package{0}'.format(x))
+        shutil.copytree(srcpath, destpath)
+        shutil.copyfile(os.path.join(destpath, 'original.jpg'), os.path.join(destpath, 'master.tif'))
+        m = manifest.Manifest(os.path.join(destpath, 'manifest-sha1.txt'))
+        m.regenerate(create=True)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for the rolling fixity audit in audit.py
+"""
+
+from isaw.images import audit
+import logging
+from nose.tools import assert_equals, assert_true
+import os
+import shutil
+from isaw.images.tests.helpers import make_collection
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_audit_run():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    collection = os.path.join(temp, 'collection')
+    os.makedirs(collection)
+    make_collection(collection, 2)
+    state = audit.Audit(os.path.join(temp, 'audit.db'))
+
+    # a one-byte budget still verifies one file per run
+    summary = state.run(collection, byte_budget=1)
+    assert_equals(summary['files_verified'], 1)
+    assert_equals(summary['collection_files'], 16)
+    assert_equals(summary['never_verified'], 15)
+    assert_equals(summary['failures'], [])
+
+    # never-verified files come first, so spending what is left covers everything
+    one = summary
+    first = state.run(collection, byte_budget=one['collection_bytes'] // 2)
+    assert_equals(first['never_verified'], 15 - first['files_verified'])
+    rest = one['collection_bytes'] - one['bytes_verified'] - first['bytes_verified']
+    second = state.run(collection, byte_budget=rest)
+    assert_equals(one['files_verified'] + first['files_verified'] + second['files_verified'], 16)
+    assert_equals(second['never_verified'], 0)
+    assert_equals(second['overdue'], 0)
+
+    # the default budget is one day's share of the cycle
+    summary = state.run(collection, cycle_days=2)
+    assert_equals(summary['byte_budget'], -(-summary['collection_bytes'] // 2))
+    assert_true(summary['bytes_verified'] <= summary['byte_budget'])
+    state.close()
+
+    # damage is reported once the scheduler reaches the file; the state persists
+    with open(os.path.join(collection, 'package1', 'thumb.jpg'), 'w') as f:
+        f.write("foo")
+    state = audit.Audit(os.path.join(temp, 'audit.db'))
+    summary = state.run(collection, byte_budget=summary['collection_bytes'])
+    assert_equals(summary['files_verified'], 16)
+    assert_equals(summary['failures'], [{'package': 'package1', 'file': 'thumb.jpg', 'error': 'checksum mismatch'}])
+    state.close()
+    shutil.rmtree(temp)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for batch derivative building in builder.py
+"""
+
+from isaw.images import builder
+import logging
+from nose.tools import assert_equals, assert_in
+import os
+import shutil
+from isaw.images.tests.helpers import make_collection
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_build_collection():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    make_collection(temp, 3)
+    os.remove(os.path.join(temp, 'package2', 'meta.xml'))
+
+    # the stand-in packages have no derivative provenance, so everything is built
+    assert_equals(builder.derivatives_current(os.path.join(temp, 'package0')), False)
+    summary = builder.build_collection(temp, workers=2, memory_limit=2 * 1024**3)
+    assert_equals(summary['packages'], 3)
+    assert_equals(summary['built'], 2)
+    assert_equals(summary['failed'], 1)
+    assert_in('IOError', summary['failures']['package2'])
+    assert_equals(builder.derivatives_current(os.path.join(temp, 'package0')), True)
+
+    # a second run has nothing to do unless forced, and leaves the packages alone
+    index_path = os.path.join(temp, 'package0', 'index.html')
+    os.utime(index_path, (0, 0))
+    summary = builder.build_collection(temp, workers=2)
+    assert_equals(summary['skipped'], 2)
+    assert_equals(summary['built'], 0)
+    assert_equals(builder.build_package(os.path.join(temp, 'package0'))[1], 'skipped')
+    assert_equals(os.path.getmtime(index_path), 0)
+    summary = builder.build_collection(temp, workers=2, force=True)
+    assert_equals(summary['built'], 2)
+    shutil.rmtree(temp)
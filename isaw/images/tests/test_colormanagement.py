@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for strip-wise color conversion in colormanagement.py
+"""
+
+from isaw.images import colormanagement, manifest, package
+import logging
+from nose.tools import assert_equals, assert_is, assert_raises
+import os
+from PIL import Image, ImageChops
+from PIL.ImageCms import getOpenProfile, profileToProfile
+import shutil
+import struct
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_convert_to_tiff():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    input_profile = getOpenProfile(os.path.join(current, '..', 'icc', 'sRGB_IEC61966-2-1_black_scaled.icc'))
+    output_profile = getOpenProfile(os.path.join(current, '..', 'icc', 'sRGB_v4_ICC_preference.icc'))
+    original = Image.open(os.path.join(current, 'data', 'turkey_road.jpg'))
+    original.load()
+    expected = profileToProfile(original, input_profile, output_profile)
+    # an uncompressed tiff is read strip by strip; a jpeg is decoded whole (within DECODE_BYTES) and then cut up
+    tiff_path = os.path.join(temp, 'original.tif')
+    original.save(tiff_path)
+    assert_equals(len(colormanagement.raw_strips(Image.open(tiff_path))), 1)
+    for source_path in [tiff_path, os.path.join(current, 'data', 'turkey_road.jpg')]:
+        dest_path = os.path.join(temp, 'master.tif')
+        assert_equals(colormanagement.convert_to_tiff(source_path, dest_path, input_profile, output_profile, strip_bytes=100000), (800, 600))
+        master = Image.open(dest_path)
+        assert_equals(master.info['icc_profile'], colormanagement.bytes_of(output_profile))
+        assert_equals(len(master.tile), 15)
+        master.load()
+        assert_is(ImageChops.difference(master, expected).getbbox(), None)
+    # one that would not fit in DECODE_BYTES is refused rather than decoded whole
+    default = colormanagement.DECODE_BYTES
+    colormanagement.DECODE_BYTES = 1000000
+    try:
+        assert_raises(MemoryError, colormanagement.convert_to_tiff, os.path.join(current, 'data', 'turkey_road.jpg'), dest_path, input_profile, output_profile, 100000)
+        # while the uncompressed tiff still converts strip by strip
+        colormanagement.convert_to_tiff(tiff_path, dest_path, input_profile, output_profile, 100000)
+    finally:
+        colormanagement.DECODE_BYTES = default
+    shutil.rmtree(temp)
+
+def test_convert_gray_to_tiff():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    input_profile = colormanagement.get_profile(path=os.path.join(current, '..', 'icc', 'sRGB_IEC61966-2-1_black_scaled.icc'))
+    output_profile = colormanagement.get_profile(path=os.path.join(current, '..', 'icc', 'sRGB_v4_ICC_preference.icc'))
+    # a 16-bit gray scan, read strip by strip two bytes a sample
+    values = [(i * 331) % 65536 for i in range(300 * 200)]
+    original = Image.frombytes('I;16', (300, 200), struct.pack('<{0}H'.format(len(values)), *values))
+    source_path = os.path.join(temp, 'original.tif')
+    original.save(source_path)
+    assert_equals(colormanagement.rows_per_strip(Image.open(source_path), 6000), 10)
+    # gray under an rgb profile is converted as neutral rgb, keeping the top 8 bits of each sample
+    gray = Image.new('L', original.size)
+    gray.putdata([value >> 8 for value in values])
+    expected = profileToProfile(gray.convert('RGB'), input_profile, output_profile)
+    assert_is(ImageChops.difference(colormanagement.convert(original, input_profile, output_profile), expected).getbbox(), None)
+    dest_path = os.path.join(temp, 'master.tif')
+    assert_equals(colormanagement.convert_to_tiff(source_path, dest_path, input_profile, output_profile, 6000), (300, 200))
+    master = Image.open(dest_path)
+    assert_equals(master.mode, 'RGB')
+    assert_equals(len(master.tile), 20)
+    master.load()
+    assert_is(ImageChops.difference(master, expected).getbbox(), None)
+    # modes with no defined conversion are refused on either path
+    Image.new('LA', (10, 10)).save(os.path.join(temp, 'la.tif'))
+    assert_raises(ValueError, colormanagement.convert_to_tiff, os.path.join(temp, 'la.tif'), dest_path, input_profile, output_profile)
+    assert_raises(ValueError, colormanagement.convert, Image.new('LA', (10, 10)), input_profile, output_profile)
+    assert_raises(ValueError, colormanagement.convert, Image.new('CMYK', (10, 10)), input_profile, output_profile)
+    shutil.rmtree(temp)
+
+def test_generate_master_in_strips():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    srcpath = os.path.join(current, 'data', 'kalabsha', '201107061813531')
+    for name, strip_bytes in [('whole', 1024**4), ('strips', 50000)]:
+        destpath = os.path.join(temp, name)
+        shutil.copytree(srcpath, destpath)
+        shutil.copyfile(os.path.join(destpath, 'original.jpg'), os.path.join(destpath, 'master.tif'))
+        manifest.Manifest(os.path.join(destpath, 'manifest-sha1.txt')).regenerate(create=True)
+        p = package.Package(destpath)
+        default = package.MASTER_STRIP_BYTES
+        package.MASTER_STRIP_BYTES = strip_bytes
+        try:
+            p.__generate_master__()
+        finally:
+            package.MASTER_STRIP_BYTES = default
+    whole = Image.open(os.path.join(temp, 'whole', 'master.tif'))
+    strips = Image.open(os.path.join(temp, 'strips', 'master.tif'))
+    assert_equals(len(whole.tile), 1)
+    assert_equals(strips.info['icc_profile'], whole.info['icc_profile'])
+    assert_is(ImageChops.difference(strips, whole).getbbox(), None)
+    assert_equals(package.Package(os.path.join(temp, 'strips')).validate(), True)
+    shutil.rmtree(temp)
+
+def test_profile_and_transform_cache():
+    current = os.path.dirname(os.path.abspath(__file__))
+    icc_path = os.path.join(current, '..', 'icc', 'sRGB_IEC61966-2-1_black_scaled.icc')
+    srgb2 = colormanagement.get_profile(path=icc_path)
+    assert_is(colormanagement.get_profile(path=icc_path), srgb2)
+    with open(icc_path, 'rb') as f:
+        assert_is(colormanagement.get_profile(f.read()), srgb2)
+    # as re-serialized by littlecms, e.g. when pillow embeds it in an image
+    assert_is(colormanagement.get_profile(getOpenProfile(icc_path).tobytes()), srgb2)
+    srgb4 = colormanagement.get_profile(path=os.path.join(current, '..', 'icc', 'sRGB_v4_ICC_preference.icc'))
+    transform = colormanagement.get_transform(srgb2, srgb4, 'RGB')
+    assert_is(colormanagement.get_transform(srgb2, srgb4, 'RGB'), transform)
+    # a profile read from elsewhere is recognized as the same profile
+    assert_equals(colormanagement.same_profile(getOpenProfile(icc_path), srgb2), True)
+    assert_equals(colormanagement.same_profile(srgb2, srgb4), False)
+
+    # conversion matches profileToProfile, and is skipped between identical profiles
+    image = Image.open(os.path.join(current, 'data', 'turkey_road.jpg'))
+    image.load()
+    assert_is(ImageChops.difference(colormanagement.convert(image, srgb2, srgb4), profileToProfile(image, srgb2, srgb4)).getbbox(), None)
+    assert_is(colormanagement.convert(image, srgb4, srgb4), image)
+
+def test_generate_master_already_srgb():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    destpath = os.path.join(temp, 'package')
+    shutil.copytree(os.path.join(current, 'data', 'kalabsha', '201107061813531'), destpath)
+    # give the original the target profile; the master is then its pixels, unconverted
+    srgb4 = getOpenProfile(os.path.join(current, '..', 'icc', 'sRGB_v4_ICC_preference.icc'))
+    original_path = os.path.join(destpath, 'original.jpg')
+    original = Image.open(original_path)
+    original.load()
+    original.save(original_path, quality=95, icc_profile=srgb4.tobytes())
+    shutil.copyfile(original_path, os.path.join(destpath, 'master.tif'))
+    manifest.Manifest(os.path.join(destpath, 'manifest-sha1.txt')).regenerate(create=True)
+    p = package.Package(destpath)
+    p.__generate_master__()
+    master = Image.open(os.path.join(destpath, 'master.tif'))
+    assert_equals(colormanagement.same_profile(colormanagement.get_profile(master.info['icc_profile']), srgb4), True)
+    assert_is(ImageChops.difference(master, Image.open(original_path)).getbbox(), None)
+    shutil.rmtree(temp)
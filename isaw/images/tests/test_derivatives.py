@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for reduced-resolution derivative making in derivatives.py
+"""
+
+from isaw.images import derivatives
+import logging
+from nose.tools import assert_equals, assert_raises, assert_true
+import os
+from PIL import Image
+import shutil
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_shrink():
+    image = Image.new('RGB', (4000, 1000), (200, 100, 50))
+    for size in [(800, 600), (128, 128), (3999, 5000), (5000, 5000)]:
+        expected = image.copy()
+        expected.thumbnail(size)
+        assert_equals(derivatives.fit(image.size, size), expected.size)
+        shrunk = derivatives.shrink(image, size)
+        assert_equals(shrunk.size, expected.size)
+        # flat color survives box reduction and resampling
+        assert_equals(shrunk.getpixel((0, 0)), (200, 100, 50))
+    # the source is untouched
+    assert_equals(image.size, (4000, 1000))
+
+def test_open_reduced():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+
+    # jpegs are decoded at reduced scale, but never below what the target needs
+    jpeg_path = os.path.join(temp, 'big.jpg')
+    Image.new('RGB', (4000, 3000), (200, 100, 50)).save(jpeg_path)
+    image = derivatives.open_reduced(jpeg_path, (800, 600))
+    assert_equals(image.size, (1000, 750))
+    assert_equals(derivatives.render(jpeg_path, (800, 600)).size, (800, 600))
+
+    # the smallest adequate pyramid level of a multi-page tiff is selected
+    tiff_path = os.path.join(temp, 'pyramid.tif')
+    full = Image.new('RGB', (4000, 3000), (200, 100, 50))
+    full.save(tiff_path, save_all=True, append_images=[full.resize((2000, 1500)), full.resize((1000, 750)), full.resize((500, 375))])
+    image = Image.open(tiff_path)
+    assert_equals(derivatives.levels(image), [(0, (4000, 3000)), (1, (2000, 1500)), (2, (1000, 750)), (3, (500, 375))])
+    image = derivatives.open_reduced(tiff_path, (800, 600))
+    assert_equals(image.size, (1000, 750))
+    image = derivatives.open_reduced(tiff_path, (8000, 6000))
+    assert_equals(image.size, (4000, 3000))
+    assert_equals(derivatives.render(tiff_path, (128, 128)).size, (128, 96))
+    shutil.rmtree(temp)
+
+def test_derivative_cache():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    cache = derivatives.DerivativeCache(os.path.join(temp, 'cache'), max_bytes=250)
+    def writer(content):
+        def write(path):
+            with open(path, 'w') as f:
+                f.write(content)
+        return write
+    assert_equals(cache.get('aa-1.jpg'), None)
+    path = cache.put('aa-1.jpg', writer('x' * 100))
+    assert_equals(cache.get('aa-1.jpg'), path)
+    assert_equals(open(path).read(), 'x' * 100)
+    cache.put('bb-2.jpg', writer('y' * 100))
+    # touching the first entry makes the second the least recently used
+    cache.get('aa-1.jpg')
+    cache.put('cc-3.jpg', writer('z' * 100))
+    assert_equals(cache.get('bb-2.jpg'), None)
+    assert_true(cache.get('aa-1.jpg') is not None)
+    assert_true(cache.get('cc-3.jpg') is not None)
+    # an entry bigger than the whole budget is still kept until the next put
+    cache.put('dd-4.jpg', writer('w' * 300))
+    assert_true(cache.get('dd-4.jpg') is not None)
+    assert_equals(cache.get('aa-1.jpg'), None)
+    cache.close()
+    # the cache persists, and notices files removed behind its back
+    cache = derivatives.DerivativeCache(os.path.join(temp, 'cache'), max_bytes=250)
+    os.remove(cache.get('dd-4.jpg'))
+    assert_equals(cache.get('dd-4.jpg'), None)
+    cache.close()
+    shutil.rmtree(temp)
+
+def test_plan_and_derive():
+    # the thumbnail is made from the preview, which is made from the full-size maximum
+    steps = derivatives.plan((4000, 3000))
+    assert_equals(steps, [('maximum', 'master', (4000, 3000)), ('preview', 'maximum', (800, 600)), ('thumbnail', 'preview', (128, 96))])
+    saved = dict(derivatives.PROFILES)
+    try:
+        # a new intermediate size slots in between, without another pass over the master
+        derivatives.register('web', 'web.jpg', (2048, 2048), options={'quality': 85})
+        steps = derivatives.plan((4000, 3000))
+        assert_equals([(name, parent) for name, parent, size in steps], [('maximum', 'master'), ('web', 'maximum'), ('preview', 'web'), ('thumbnail', 'preview')])
+        assert_equals(derivatives.filenames(), ['maximum.jpg', 'preview.jpg', 'thumb.jpg', 'web.jpg'])
+        image = Image.new('RGB', (4000, 3000), (200, 100, 50))
+        made = list(derivatives.derive(image, ['thumbnail', 'web']))
+        assert_equals([(name, derived.size) for name, derived in made], [('web', (2048, 1536)), ('thumbnail', (128, 96))])
+        assert_equals(made[1][1].getpixel((0, 0)), (200, 100, 50))
+        # pinned sources are made along the way, even if not asked for
+        derivatives.register('web', 'web.jpg', (2048, 2048), source='preview')
+        assert_raises(ValueError, derivatives.plan, (4000, 3000))
+        derivatives.register('web', 'web.jpg', (600, 600), source='preview')
+        assert_equals(derivatives.plan((4000, 3000), ['web']), [('preview', 'master', (800, 600)), ('web', 'preview', (600, 450))])
+        assert_equals([name for name, derived in derivatives.derive(image, ['web'])], ['web'])
+        assert_raises(ValueError, derivatives.plan, (4000, 3000), ['nonesuch'])
+    finally:
+        derivatives.PROFILES.clear()
+        derivatives.PROFILES.update(saved)
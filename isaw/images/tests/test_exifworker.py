@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for the shared exiftool process in exifworker.py
+"""
+
+from isaw.images import exifworker
+import logging
+from nose.tools import assert_equals, assert_is, assert_is_not, assert_raises
+import multiprocessing
+import os
+
+logging.basicConfig(level=logging.DEBUG)
+
+def __worker_pid__(ignored):
+    return os.getpid(), id(exifworker.get_worker())
+
+def test_exif_worker():
+    current = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(current, 'data', 'turkey_road.jpg'), os.path.join(current, 'data', 'kalabsha', '201107061813531', 'original.jpg')]
+    worker = exifworker.ExifWorker()
+    metadata = worker.get_metadata_batch(paths)
+    assert_equals([d['SourceFile'] for d in metadata], paths)
+    # the same exiftool process serves later calls, split into batches as needed
+    process = worker.tool._process
+    default = exifworker.BATCH_FILES
+    exifworker.BATCH_FILES = 1
+    try:
+        assert_equals([d['SourceFile'] for d in worker.get_metadata_batch(paths)], paths)
+    finally:
+        exifworker.BATCH_FILES = default
+    assert_is(worker.tool._process, process)
+
+    # a dead exiftool is noticed rather than waited on forever, and replaced
+    process.kill()
+    process.wait()
+    assert_raises(IOError, worker.tool.execute, b'-j', paths[0])
+    assert_equals([d['SourceFile'] for d in worker.get_metadata_batch(paths[:1])], paths[:1])
+    assert_equals(worker.restarts, 1)
+    assert_is_not(worker.tool._process, process)
+    worker.close()
+
+def test_get_worker():
+    assert_is(exifworker.get_worker(), exifworker.get_worker())
+    # each pool process gets a worker of its own
+    pool = multiprocessing.Pool(2)
+    try:
+        pids = pool.map(__worker_pid__, range(4))
+    finally:
+        pool.close()
+        pool.join()
+    assert_equals(os.getpid() in [pid for pid, worker in pids], False)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for filehashing.py
+"""
+
+import hashlib
+from isaw.images import filehashing
+import logging
+from nose.tools import assert_equals, assert_not_equal, assert_in, assert_is
+import os
+import shutil
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_hash_of_file():
+    current = os.path.dirname(os.path.abspath(__file__))
+    original_path = os.path.join(current, 'data', 'kalabsha', '201107061813531', 'original.jpg')
+    with open(original_path, 'rb') as f:
+        expected = hashlib.sha1(f.read()).hexdigest()
+    # default streaming read, odd chunk sizes, and mmap should all agree with a whole-file hash
+    assert_equals(filehashing.hash_of_file(original_path), expected)
+    assert_equals(filehashing.hash_of_file(original_path, chunk_size=4097), expected)
+    assert_equals(filehashing.hash_of_file(original_path, use_mmap=True), expected)
+    assert_equals(filehashing.hash_of_file(original_path, chunk_size=4097, use_mmap=True), expected)
+
+def test_hash_of_empty_file():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    empty_path = os.path.join(temp, 'empty')
+    open(empty_path, 'w').close()
+    assert_equals(filehashing.hash_of_file(empty_path), hashlib.sha1().hexdigest())
+    assert_equals(filehashing.hash_of_file(empty_path, use_mmap=True), hashlib.sha1().hexdigest())
+    shutil.rmtree(temp)
+
+def test_safe_copy():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    try:
+        original_path = os.path.join(current, 'data', 'oracle.jpg')
+        expected = filehashing.hash_of_file(original_path)
+        # single-pass (default) and kernel-side copies return the digest of the copy
+        dest_path = os.path.join(temp, 'single.jpg')
+        assert_equals(filehashing.safe_copy(original_path, dest_path), expected)
+        assert_equals(filehashing.hash_of_file(dest_path), expected)
+        # copystat keeps the time, though on python 2 not to the last fraction of a second
+        assert_equals(int(os.stat(dest_path).st_mtime), int(os.stat(original_path).st_mtime))
+        dest_path = os.path.join(temp, 'kernel.jpg')
+        assert_equals(filehashing.safe_copy(original_path, dest_path, single_pass=False), expected)
+        assert_equals(filehashing.hash_of_file(dest_path), expected)
+        # copying into a directory keeps the source file name, as with shutil.copy2
+        assert_equals(filehashing.safe_copy(original_path, temp), expected)
+        assert_equals(os.path.isfile(os.path.join(temp, 'oracle.jpg')), True)
+    finally:
+        shutil.rmtree(temp)
+
+def test_hashes_of_file():
+    current = os.path.dirname(os.path.abspath(__file__))
+    original_path = os.path.join(current, 'data', 'oracle.jpg')
+    with open(original_path, 'rb') as f:
+        guts = f.read()
+    digests = filehashing.hashes_of_file(original_path, ['sha1', 'sha256', 'md5'])
+    assert_equals(sorted(digests.keys()), ['md5', 'sha1', 'sha256'])
+    for algorithm in digests.keys():
+        assert_equals(digests[algorithm], hashlib.new(algorithm, guts).hexdigest())
+        assert_equals(filehashing.hash_of_file(original_path, algorithm=algorithm), digests[algorithm])
+    assert_equals(filehashing.hashes_of_file(original_path, ['sha1', 'sha256'], use_mmap=True), dict((a, digests[a]) for a in ['sha1', 'sha256']))
+    # safe_copy can hand back extra digests of the copy from its verifying read
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    extra = {'sha256': None}
+    assert_equals(filehashing.safe_copy(original_path, os.path.join(temp, 'copy.jpg'), digests=extra), digests['sha1'])
+    assert_equals(extra, {'sha1': digests['sha1'], 'sha256': digests['sha256']})
+    shutil.rmtree(temp)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for collection-wide fixity verification in fixity.py
+"""
+
+from isaw.images import fixity, manifest, package
+import logging
+from nose.tools import assert_equals, assert_not_equal, assert_in, assert_is
+import os
+import shutil
+from isaw.images.tests.helpers import make_collection
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_verify_collection():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    make_collection(temp, 3)
+    os.makedirs(os.path.join(temp, 'foobar'))
+
+    # an untouched collection verifies cleanly
+    report = fixity.verify_collection(temp, workers=2, io_limit=1)
+    assert_equals(report['packages'], 3)
+    assert_equals(report['other_directories'], ['foobar'])
+    assert_equals(report['files_checked'], 24)
+    assert_equals(report['files_trusted'], 0)
+    assert_equals(report['failures'], {})
+    assert_equals(report['packages_failed'], 0)
+
+    # files trusted from the fixity cache are counted, but not as bytes read
+    cache_path = os.path.join(temp, 'fixity.db')
+    report = fixity.verify_collection(temp, workers=2, cache_path=cache_path)
+    assert_equals(report['files_trusted'], 0)
+    nbytes = report['bytes_checked']
+    assert_not_equal(nbytes, 0)
+    report = fixity.verify_collection(temp, workers=2, cache_path=cache_path, trust_days=1)
+    assert_equals(report['files_checked'], 24)
+    assert_equals(report['files_trusted'], 24)
+    assert_equals(report['bytes_checked'], 0)
+    os.remove(cache_path)
+
+    # clobber one file and delete another; both are reported against their package
+    with open(os.path.join(temp, 'package1', 'master.tif'), 'w') as f:
+        f.write("foo")
+    os.remove(os.path.join(temp, 'package2', 'thumb.jpg'))
+    report = fixity.verify_collection(temp, workers=2, large_file=1024)
+    assert_equals(report['packages_failed'], 2)
+    assert_equals(sorted(report['failures'].keys()), ['package1', 'package2'])
+    assert_equals(report['failures']['package1'][0]['file'], 'master.tif')
+    assert_equals(report['failures']['package1'][0]['error'], 'checksum mismatch')
+    assert_equals(report['failures']['package2'][0]['file'], 'thumb.jpg')
+    assert_equals(report['failures']['package2'][0]['error'], 'missing')
+    shutil.rmtree(temp)
+
+def test_fixity_cache():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    filepath = os.path.join(temp, 'workfile')
+    with open(filepath, 'w') as f:
+        f.write("foo")
+    cache = fixity.FixityCache(os.path.join(temp, 'fixity.db'))
+    assert_equals(cache.lookup(filepath), None)
+    cache.record(filepath, 'abc123')
+    assert_equals(cache.lookup(filepath), 'abc123')
+    assert_equals(cache.lookup(filepath, max_age=3600), 'abc123')
+    # too old to trust
+    assert_equals(cache.lookup(filepath, max_age=-1), None)
+    # changed on disk
+    with open(filepath, 'w') as f:
+        f.write("foobar")
+    assert_equals(cache.lookup(filepath), None)
+    cache.close()
+    # the cache persists across connections
+    cache = fixity.FixityCache(os.path.join(temp, 'fixity.db'))
+    cache.record(filepath, 'def456')
+    cache.close()
+    cache = fixity.FixityCache(os.path.join(temp, 'fixity.db'))
+    assert_equals(cache.lookup(filepath), 'def456')
+    cache.close()
+    shutil.rmtree(temp)
+
+def test_validate_with_cache():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    make_collection(temp, 1)
+    cache = fixity.FixityCache(os.path.join(temp, 'fixity.db'))
+    p = package.Package()
+    p.open(os.path.join(temp, 'package0'))
+    # a full validation populates the cache, so a trusting one need not rehash
+    assert_equals(p.validate(cache), True)
+    master_path = os.path.join(temp, 'package0', 'master.tif')
+    assert_equals(cache.lookup(master_path), p.manifest.get('master.tif'))
+    assert_equals(p.validate(cache, trust_days=1), True)
+    # a changed file is never trusted
+    with open(master_path, 'w') as f:
+        f.write("foo")
+    assert_equals(p.validate(cache, trust_days=1), False)
+    cache.close()
+    shutil.rmtree(temp)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for the collection-wide content-hash index in hashindex.py
+"""
+
+from isaw.images import filehashing, hashindex, manifest, package
+import logging
+from nose.tools import assert_equals, assert_raises
+import os
+import shutil
+from isaw.images.tests.helpers import make_collection
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_index_collection():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    collection = os.path.join(temp, 'collection')
+    os.makedirs(collection)
+    make_collection(collection, 2)
+    index = hashindex.HashIndex(os.path.join(temp, 'hashes.db'))
+    assert_equals(index.index_collection(collection), 2)
+
+    # both copies hold the same original, and only the original is reported
+    m = manifest.Manifest(os.path.join(collection, 'package0', 'manifest-sha1.txt'), index=index)
+    digest = m.get('original.jpg')
+    assert_equals(index.find(digest), [('package0', 'master.tif'), ('package0', 'original.jpg'), ('package1', 'master.tif'), ('package1', 'original.jpg')])
+    assert_equals(index.find(digest, originals_only=True), [('package0', 'original.jpg'), ('package1', 'original.jpg')])
+    assert_equals(index.duplicates(), {digest: [('package0', 'original.jpg'), ('package1', 'original.jpg')]})
+
+    # the manifest keeps the index current, once per write when batched
+    with m.batch():
+        m.set('original.jpg', 'abc123')
+        assert_equals(index.find('abc123'), [])
+    assert_equals(index.find('abc123'), [('package0', 'original.jpg')])
+    assert_equals(index.duplicates(), {})
+    m.remove('original.jpg')
+    assert_equals(index.find('abc123'), [])
+    index.forget('package1')
+    assert_equals(index.find(digest), [('package0', 'master.tif')])
+    index.close()
+    shutil.rmtree(temp)
+
+def test_create_rejects_duplicate():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    original_path = os.path.join(current, 'data', 'turkey_road.jpg')
+    index = hashindex.HashIndex(os.path.join(temp, 'hashes.db'))
+    p = package.Package(temp, 'first', original_path, index=index)
+    assert_equals(len(index.find(p.manifest.get('original.jpg'), originals_only=True)), 1)
+    assert_raises(ValueError, package.Package, temp, 'second', original_path, index=index)
+    assert_equals(os.path.exists(os.path.join(temp, 'second')), False)
+
+    # an original claimed by a create still under way, and not yet indexed, is refused too
+    other_path = os.path.join(current, 'data', 'oracle.jpg')
+    digest = filehashing.hash_of_file(other_path)
+    other = hashindex.HashIndex(os.path.join(temp, 'hashes.db'))
+    assert_equals(other.claim_original('third', digest), [])
+    assert_equals(other.claim_original('third', digest), [])
+    assert_equals(index.find(digest), [])
+    assert_raises(ValueError, package.Package, temp, 'fourth', other_path, index=index)
+    assert_equals(index.claim_original('fourth', digest), ['third'])
+    # until the package that claimed it is forgotten
+    other.forget('third')
+    package.Package(temp, 'fourth', other_path, index=index)
+    other.close()
+    index.close()
+    shutil.rmtree(temp)
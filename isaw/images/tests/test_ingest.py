@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for pipelined batch ingest in ingest.py
+"""
+
+from isaw.images import ingest, package
+import logging
+from nose.tools import assert_equals, assert_raises, assert_true
+import os
+import shutil
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_ingest():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    originals = os.path.join(temp, 'accession')
+    os.makedirs(os.path.join(originals, 'box 2'))
+    destination = os.path.join(temp, 'packages')
+    os.makedirs(destination)
+    shutil.copyfile(os.path.join(current, 'data', 'turkey_road.jpg'), os.path.join(originals, 'road.jpg'))
+    shutil.copyfile(os.path.join(current, 'data', 'kalabsha', '201107061813531', 'original.jpg'), os.path.join(originals, 'box 2', 'temple 1.jpg'))
+    with open(os.path.join(originals, 'box 2', 'broken.jpg'), 'w') as f:
+        f.write('not a jpeg')
+    with open(os.path.join(originals, 'notes.txt'), 'w') as f:
+        f.write('not an image')
+    found = ingest.find_originals(originals)
+    assert_equals([os.path.basename(p) for p in found], ['road.jpg', 'broken.jpg', 'temple 1.jpg'])
+    assert_equals(ingest.package_id(found[2]), 'temple-1')
+
+    summary = ingest.ingest(originals, destination, workers={'original': 1, 'master': 2, 'derivatives': 2}, queue_size=1)
+    assert_equals(summary['originals'], 3)
+    assert_equals(summary['created'], 2)
+    assert_equals(summary['failed'], 1)
+    assert_true(summary['failures'][found[1]].startswith('master: '))
+    for id in ['road', 'temple-1']:
+        p = package.Package(os.path.join(destination, id))
+        assert_equals(sorted(p.manifest.get_all().keys()), ['history.txt', 'master.tif', 'maximum.jpg', 'original-exif.json', 'original.jpg', 'preview.jpg', 'thumb.jpg'])
+        assert_equals(p.validate(), True)
+
+    # originals that would share a package id, or unknown stages, are refused up front
+    assert_raises(ValueError, ingest.ingest, [found[0], found[0]], destination)
+    assert_raises(ValueError, ingest.ingest, [], destination, workers={'thumbnails': 2})
+    shutil.rmtree(temp)
+
+def test_ingest_worker_dies():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    originals = os.path.join(temp, 'accession')
+    os.makedirs(originals)
+    destination = os.path.join(temp, 'packages')
+    os.makedirs(destination)
+    shutil.copyfile(os.path.join(current, 'data', 'turkey_road.jpg'), os.path.join(originals, 'a-road.jpg'))
+    shutil.copyfile(os.path.join(current, 'data', 'kalabsha', '201107061813531', 'original.jpg'), os.path.join(originals, 'b-temple.jpg'))
+    run_stage = ingest.__run_stage__
+    def crash(stage, task, index, pyramid):
+        if stage == 'master' and task['id'] == 'a-road':
+            os._exit(9) # as if killed, e.g. by the kernel when out of memory
+        run_stage(stage, task, index, pyramid)
+    ingest.__run_stage__ = crash
+    try:
+        summary = ingest.ingest(originals, destination, workers={'original': 1, 'master': 1, 'derivatives': 1})
+    finally:
+        ingest.__run_stage__ = run_stage
+    # the lone master worker is replaced, and the batch goes on without the original it had
+    assert_equals(summary['created'], 1)
+    assert_equals(summary['failed'], 1)
+    assert_equals(summary['failures'][os.path.join(os.path.realpath(originals), 'a-road.jpg')], 'master: worker process died with exit code 9')
+    assert_equals(package.Package(os.path.join(destination, 'b-temple')).validate(), True)
+    shutil.rmtree(temp)
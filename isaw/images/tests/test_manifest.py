@@ -3,8 +3,8 @@
 """
 test manifest
 """
-from isaw.images import manifest
-from nose.tools import assert_equals, assert_not_equal, assert_in, assert_is
+from isaw.images import fixity, manifest
+from nose.tools import assert_equals, assert_not_equal, assert_in, assert_not_in, assert_is
 import os
 import shutil
 
@@ -14,3 +14,112 @@ def test_instantiate_manifest():
     os.makedirs(temp)
     m=manifest.Manifest(os.path.join(temp, 'manifest-sha1.txt'), create=True)
     shutil.rmtree(temp)
+
+def test_batch_manifest():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    manifest_path = os.path.join(temp, 'manifest-sha1.txt')
+    m=manifest.Manifest(manifest_path, create=True)
+    # outside a batch, every change is written straight away
+    m.set('a.txt', 'aaaa')
+    with open(manifest_path, 'r') as f:
+        assert_equals(f.readlines(), ['aaaa a.txt\n'])
+    # inside a batch, nothing is written until the outermost block exits
+    with m.batch():
+        m.set('b.txt', 'bbbb')
+        with m.batch():
+            m.set('c.txt', 'cccc')
+        m.remove('a.txt')
+        with open(manifest_path, 'r') as f:
+            assert_equals(f.readlines(), ['aaaa a.txt\n'])
+    with open(manifest_path, 'r') as f:
+        assert_equals(f.readlines(), ['bbbb b.txt\n', 'cccc c.txt\n'])
+    # a batch that raises is rolled back, in memory and on disk
+    try:
+        with m.batch():
+            m.set('d.txt', 'dddd')
+            raise ValueError
+    except ValueError:
+        pass
+    assert_equals(m.get_all(), {'b.txt': 'bbbb', 'c.txt': 'cccc'})
+    with open(manifest_path, 'r') as f:
+        assert_equals(f.readlines(), ['bbbb b.txt\n', 'cccc c.txt\n'])
+    assert_equals(sorted(os.listdir(temp)), ['manifest-sha1.txt'])
+    shutil.rmtree(temp)
+
+def test_regenerate_manifest():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    srcpath = os.path.join(current, 'data', 'kalabsha', '201107061813531')
+    shutil.copytree(srcpath, temp)
+    m=manifest.Manifest(os.path.join(temp, 'manifest-sha1.txt'))
+    expected = m.get_all()
+    del expected['master.tif'] # listed in the test data, but not present
+    # bookkeeping files are never listed
+    with open(os.path.join(temp, 'derivatives.json'), 'w') as f:
+        f.write('{}')
+    m.regenerate(create=True)
+    assert_equals(m.get_all(), expected)
+    m=manifest.Manifest(os.path.join(temp, 'manifest-sha1.txt'))
+    assert_equals(m.get_all(), expected)
+    shutil.rmtree(temp)
+
+def test_multiple_manifests():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    srcpath = os.path.join(current, 'data', 'kalabsha', '201107061813531')
+    shutil.copytree(srcpath, temp)
+    assert_equals(manifest.algorithm_of(os.path.join(temp, 'manifest-sha256.txt')), 'sha256')
+    assert_equals(manifest.algorithm_of(os.path.join(temp, 'manifest-sha1.txt')), 'sha1')
+    sha1=manifest.Manifest(os.path.join(temp, 'manifest-sha1.txt'))
+    sha256=manifest.Manifest(os.path.join(temp, manifest.manifest_filename('sha256')), create=True)
+    assert_equals(sha256.algorithm, 'sha256')
+    manifest.regenerate_all([sha1, sha256], create=True)
+    assert_equals(sorted(sha1.get_all().keys()), sorted(sha256.get_all().keys()))
+    assert_not_equal(sha1.get('original.jpg'), sha256.get('original.jpg'))
+    assert_not_in('manifest-sha1.txt', sha256.get_all().keys())
+    assert_not_in('manifest-sha256.txt', sha1.get_all().keys())
+    # both manifests are found again, and the stronger one is preferred for verification
+    found = manifest.find_manifests(temp)
+    assert_equals(sorted(found.keys()), ['sha1', 'sha256'])
+    assert_equals(found['sha256'].get_all(), sha256.get_all())
+    assert_equals(manifest.preferred_algorithm(found.keys()), 'sha256')
+    assert_equals(manifest.preferred_algorithm(['sha1']), 'sha1')
+    shutil.rmtree(temp)
+
+def test_regenerate_threaded_and_cached():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    srcpath = os.path.join(current, 'data', 'kalabsha', '201107061813531')
+    destpath = os.path.join(temp, 'package')
+    shutil.copytree(srcpath, destpath)
+    m=manifest.Manifest(os.path.join(destpath, 'manifest-sha1.txt'))
+    m.regenerate(create=True)
+    expected = m.get_all()
+    # hashing on a thread pool gives the same, sorted manifest
+    m.regenerate(create=True, workers=4)
+    assert_equals(m.get_all(), expected)
+    with open(m.path, 'r') as f:
+        lines = f.readlines()
+    assert_equals([line.split()[1] for line in lines], sorted(expected.keys()))
+    # with a fixity cache, files unchanged on disk are not reread: change the
+    # bytes of one file in place, but keep its size and modification time
+    cache = fixity.FixityCache(os.path.join(temp, 'fixity.db'))
+    thumb_path = os.path.join(destpath, 'thumb.jpg')
+    os.utime(thumb_path, (1000000000, 1000000000))
+    m.regenerate(create=True, workers=4, cache=cache)
+    assert_equals(m.get_all(), expected)
+    with open(thumb_path, 'r+b') as f:
+        f.seek(100)
+        guts = bytearray(f.read(4))
+        f.seek(100)
+        f.write(bytearray(b ^ 0xff for b in guts))
+    os.utime(thumb_path, (1000000000, 1000000000))
+    m.regenerate(create=True, workers=4, cache=cache)
+    assert_equals(m.get('thumb.jpg'), expected['thumb.jpg'])
+    # without the cache the change is seen
+    m.regenerate(create=True, workers=4)
+    assert_not_equal(m.get('thumb.jpg'), expected['thumb.jpg'])
+    cache.close()
+    shutil.rmtree(temp)
@@ -77,3 +77,55 @@ def test_create_metadata():
     shutil.rmtree(temp)
 
 
+
+def test_metadata_session():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    changes = [
+        (['photographer', 'name'], 'Tom Elliott'),
+        (['title'], 'The Oracle'),
+        (['photographer', 'email'], 'tom.elliott@nyu.edu'),
+        (['description'], 'a bottle cap'),
+    ]
+    # one write per change
+    direct = metadata.Metadata(os.path.join(temp, 'direct.xml'), create=True)
+    for keys, value in changes:
+        direct.set_hierarchy(keys, value, original_info=True)
+    # one write in all, of the same result
+    saved = []
+    save = metadata.Metadata.__save__
+    def counting_save(self, tree):
+        saved.append(self.path)
+        save(self, tree)
+    metadata.Metadata.__save__ = counting_save
+    try:
+        deferred = metadata.Metadata(os.path.join(temp, 'deferred.xml'), create=True)
+        with open(deferred.path, 'r') as f:
+            before = f.read()
+        with deferred.session():
+            for keys, value in changes:
+                deferred.set_hierarchy(keys, value, original_info=True)
+            with open(deferred.path, 'r') as f:
+                assert_equals(f.read(), before)
+    finally:
+        metadata.Metadata.__save__ = save
+    assert_equals(saved, [deferred.path])
+    with open(direct.path, 'r') as f:
+        expected = f.read()
+    with open(deferred.path, 'r') as f:
+        assert_equals(f.read(), expected)
+    assert_equals(metadata.Metadata(deferred.path).data, direct.data)
+
+    # a session that raises changes nothing
+    try:
+        with deferred.session():
+            deferred.set('title', 'Something Else')
+            raise ValueError
+    except ValueError:
+        pass
+    assert_equals(deferred.data['title'], 'The Oracle')
+    with open(deferred.path, 'r') as f:
+        assert_equals(f.read(), expected)
+    assert_equals(sorted(os.listdir(temp)), ['deferred.xml', 'direct.xml'])
+    shutil.rmtree(temp)
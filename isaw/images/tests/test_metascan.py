@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for the bulk metadata scanner in metascan.py
+"""
+
+from isaw.images import metadata, metascan
+import logging
+from nose.tools import assert_equals, assert_in
+import os
+import shutil
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_scan_file():
+    current = os.path.dirname(os.path.abspath(__file__))
+    package_path = os.path.join(current, 'data', 'kalabsha', '201107061813531')
+    meta_path = os.path.join(package_path, 'meta.xml')
+    record = metascan.scan_file(meta_path)
+    data = metadata.Metadata(meta_path).data
+    expected = dict((k, data[k]) for k in metascan.FIELDS)
+    expected.update({'id': '201107061813531', 'path': package_path})
+    assert_equals(record, expected)
+    # nested fields, and fields found only in the 'original' info or not at all
+    record = metascan.scan_file(meta_path, ['photographer:given-name', 'geography:photographed-place:modern-name', 'origin', 'review-notes'])
+    assert_equals(record, {'id': '201107061813531', 'path': package_path, 'photographer:given-name': 'Iris', 'geography:photographed-place:modern-name': 'Kalabsha'})
+
+def test_scan():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    for x in range(0, 5):
+        shutil.copytree(os.path.join(current, 'data', 'kalabsha', '201107061813531'), os.path.join(temp, 'test{0}'.format(x)))
+    os.makedirs(os.path.join(temp, 'foobar', 'other'))
+    with open(os.path.join(temp, 'test3', 'meta.xml'), 'w') as f:
+        f.write('<image-info><status>draft')
+    packages = metascan.find_packages(temp)
+    assert_equals([os.path.basename(p) for p in packages], ['test0', 'test1', 'test2', 'test3', 'test4'])
+    # the same records, in the same order, however many workers read them
+    serial = list(metascan.scan(temp, ['status', 'title'], workers=1))
+    assert_equals(list(metascan.scan(packages, ['status', 'title'], workers=3, chunksize=1)), serial)
+    assert_equals([r['id'] for r in serial], ['test0', 'test1', 'test2', 'test3', 'test4'])
+    assert_equals(serial[0]['status'], 'ready')
+    assert_in('error', serial[3].keys())
+    assert_equals('error' in serial[4].keys(), False)
+    shutil.rmtree(temp)
@@ -5,7 +5,7 @@ nose tests for code in isaw.images/isaw/images/package.py
 """
 
 from io import BytesIO
-from isaw.images import package
+from isaw.images import derivatives, manifest, package
 import logging
 from nose.tools import *
 import os
@@ -239,3 +239,253 @@ def test_make_overview():
     shutil.rmtree(temp)
 
 
+
+def test_add_manifests():
+    # open a copy of the kalabsha package, with a stand-in master.tif and a fresh manifest
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    srcpath = os.path.join(current, 'data', 'kalabsha', '201107061813531')
+    destpath = os.path.join(temp, '201107061813531')
+    shutil.copytree(srcpath, destpath)
+    shutil.copyfile(os.path.join(destpath, 'original.jpg'), os.path.join(destpath, 'master.tif'))
+    manifest.Manifest(os.path.join(destpath, 'manifest-sha1.txt')).regenerate(create=True)
+    p = package.Package()
+    p.open(destpath)
+    assert_equals(sorted(p.manifests.keys()), ['sha1'])
+    # add a sha256 manifest covering the same files
+    assert_equals(p.add_manifests(['sha256']), True)
+    assert_equals(os.path.isfile(os.path.join(destpath, 'manifest-sha256.txt')), True)
+    assert_equals(sorted(p.manifests['sha256'].get_all().keys()), sorted(p.manifest.get_all().keys()))
+    assert_equals(p.add_manifests(['sha256']), False)
+    # a reopened package finds both manifests, and validates against the stronger one
+    pp = package.Package()
+    pp.open(destpath)
+    assert_equals(sorted(pp.manifests.keys()), ['sha1', 'sha256'])
+    assert_equals(pp.validate(), True)
+    with open(os.path.join(destpath, 'thumb.jpg'), 'w') as f:
+        f.write("foo")
+    assert_equals(pp.validate(), False)
+    shutil.rmtree(temp)
+
+def test_derivative():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    original_path = os.path.join(current, 'data', 'turkey_road.jpg')
+    p = package.Package(temp, 'test_package', original_path)
+    cache = derivatives.DerivativeCache(os.path.join(temp, 'cache'))
+
+    # rendered once, then served from the cache
+    path = p.derivative(300, 300, cache=cache)
+    assert_equals(Image.open(path).size, (300, 225))
+    assert_in(p.manifest.get('master.tif'), os.path.basename(path))
+    mtime = os.path.getmtime(path)
+    assert_equals(p.derivative(300, 300, cache=cache), path)
+    assert_equals(os.path.getmtime(path), mtime)
+    png_path = p.derivative(64, 64, 'png', cache=cache)
+    assert_equals(Image.open(png_path).format, 'PNG')
+    assert_raises(ValueError, p.derivative, 64, 64, 'PSD', cache=cache)
+
+    # a changed master gets a fresh derivative
+    p.manifest.set('master.tif', 'abc123')
+    assert_not_equal(p.derivative(300, 300, cache=cache), path)
+    cache.close()
+
+    # without a shared cache, the package keeps its own
+    path = p.derivative(100, 100)
+    assert_in(os.path.join('test_package', 'temp', 'derivatives'), path)
+    shutil.rmtree(temp)
+
+def test_derivative_provenance():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    original_path = os.path.join(current, 'data', 'turkey_road.jpg')
+    package.Package(temp, 'test_package', original_path)
+    path = os.path.join(temp, 'test_package')
+    records = derivatives.read_provenance(path)
+    assert_equals(sorted(records.keys()), ['maximum.jpg', 'preview.jpg', 'thumb.jpg'])
+
+    # a freshly opened package knows its derivatives are current
+    p = package.Package(path)
+    assert_equals(p.make_derivatives(), False)
+    thumb = p.manifest.get('thumb.jpg')
+    preview = p.manifest.get('preview.jpg')
+
+    # only the derivative whose profile changed is made again
+    saved = dict(derivatives.PROFILES)
+    try:
+        derivatives.register('preview', 'preview.jpg', (800, 600), options={'optimize': True, 'progressive': True, 'quality': 70})
+        assert_equals(derivatives.stale(path, p.manifest.get_all()), ['preview'])
+        assert_equals(package.Package(path).make_derivatives(), True)
+        p = package.Package(path)
+        assert_not_equal(p.manifest.get('preview.jpg'), preview)
+        assert_equals(p.manifest.get('thumb.jpg'), thumb)
+        assert_equals(p.make_derivatives(), False)
+    finally:
+        derivatives.PROFILES.clear()
+        derivatives.PROFILES.update(saved)
+    assert_equals(p.make_derivatives(), True)
+
+    # a changed master, or a derivative replaced behind the package's back, makes them stale
+    entries = dict(p.manifest.get_all())
+    entries['master.tif'] = 'abc123'
+    assert_equals(derivatives.stale(path, entries), ['maximum', 'preview', 'thumbnail'])
+    entries = dict(p.manifest.get_all())
+    entries['thumb.jpg'] = 'abc123'
+    assert_equals(derivatives.stale(path, entries), ['thumbnail'])
+    shutil.rmtree(temp)
+
+def test_event_batching():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    original_path = os.path.join(current, 'data', 'turkey_road.jpg')
+    package.Package(temp, 'test_package', original_path)
+    path = os.path.join(temp, 'test_package')
+    history_path = os.path.join(path, 'history.txt')
+    p = package.Package(path)
+    with open(history_path, 'r') as f:
+        before = f.readlines()
+    assert_in('created package at', before[-1])
+
+    # events are held until the end of a batch, then written together
+    with p.batch():
+        p.__append_event__('first')
+        with p.batch():
+            p.__append_event__('second')
+        with open(history_path, 'r') as f:
+            assert_equals(f.readlines(), before)
+        # unless flushed explicitly
+        p.__append_event__('third')
+        assert_equals(p.flush_events(), True)
+        with open(history_path, 'r') as f:
+            assert_equals(len(f.readlines()), len(before) + 3)
+        p.__append_event__('fourth')
+    with open(history_path, 'r') as f:
+        after = f.readlines()
+    assert_equals([line.split(' ', 1)[1] for line in after[len(before):]], ['first\n', 'second\n', 'third\n', 'fourth\n'])
+    assert_true(re.match(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d+[-+]\d\d:\d\d$', after[-1].split(' ', 1)[0]))
+    assert_equals(package.Package(path).validate(), True)
+
+    # a batch that raises drops its events; outside a batch they are written at once
+    try:
+        with p.batch():
+            p.__append_event__('lost')
+            raise ValueError
+    except ValueError:
+        pass
+    p.__append_event__('kept')
+    with open(history_path, 'r') as f:
+        assert_equals([line.split(' ', 1)[1] for line in f.readlines()[len(after):]], ['kept\n'])
+    assert_equals(package.Package(path).validate(), True)
+
+    # events flushed before a batch raises stay written, and listed as such
+    try:
+        with p.batch():
+            p.__append_event__('flushed')
+            p.flush_events()
+            p.__append_event__('dropped')
+            raise ValueError
+    except ValueError:
+        pass
+    with open(history_path, 'r') as f:
+        assert_equals([line.split(' ', 1)[1] for line in f.readlines()[-2:]], ['kept\n', 'flushed\n'])
+    assert_equals(package.Package(path).validate(), True)
+    shutil.rmtree(temp)
+
+def test_open_readonly():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    original_path = os.path.join(current, 'data', 'turkey_road.jpg')
+    package.Package(temp, 'test_package', original_path)
+    path = os.path.join(temp, 'test_package')
+    os.remove(os.path.join(path, 'index.html'))
+
+    # nothing is loaded, rendered or written until it is used
+    p = package.Package(path, readonly=True)
+    assert_equals(sorted(k for k in package.LAZY.keys() if k in p.__dict__), [])
+    assert_equals(p.original, 'original.jpg')
+    assert_equals(p.validate(), True)
+    assert_equals(p.metadata.data['status'], 'draft')
+    assert_in("Overview for 'test_package'", p.doc.render())
+    assert_equals(os.path.isfile(os.path.join(path, 'index.html')), False)
+    assert_equals(p.overview_current(), False)
+    assert_raises(AttributeError, getattr, p, 'thumbnail')
+
+    # and nothing can be changed
+    assert_raises(IOError, p.make_overview)
+    assert_raises(IOError, p.__append_event__, 'something')
+    assert_raises(IOError, p.make_derivatives, True)
+    assert_raises(IOError, p.add_manifests, ['sha256'])
+    assert_raises(IOError, p.derivative, 64, 64)
+    assert_equals(os.path.exists(os.path.join(path, 'temp', 'derivatives')), False)
+    # except with a cache kept elsewhere
+    cache = derivatives.DerivativeCache(os.path.join(temp, 'cache'))
+    assert_equals(os.path.isfile(p.derivative(64, 64, cache=cache)), True)
+    cache.close()
+    assert_equals(package.Package(path).validate(), True)
+
+    # directories that are not packages are still refused at open
+    assert_raises(IOError, package.Package, temp, readonly=True)
+
+    # reopened for writing, the overview is written again
+    p.open(path)
+    assert_equals(p.overview_current(), True)
+    p.__append_event__('something')
+    shutil.rmtree(temp)
+
+def test_resume_create():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    original_path = os.path.join(current, 'data', 'turkey_road.jpg')
+    path = os.path.join(temp, 'test_package')
+    journal_path = os.path.join(path, package.CREATE_JOURNAL)
+
+    # a create() that dies making the derivatives leaves its journal behind
+    make_derivatives = package.Package.make_derivatives
+    def crash(self, overwrite=False):
+        raise MemoryError
+    package.Package.make_derivatives = crash
+    try:
+        assert_raises(MemoryError, package.Package, temp, 'test_package', original_path)
+    finally:
+        package.Package.make_derivatives = make_derivatives
+    assert_equals(os.path.isfile(journal_path), True)
+    p = package.Package()
+    p.path = path
+    journal = p.__read_journal__()
+    assert_equals(journal['completed'], ['original', 'master'])
+    assert_equals(sorted(journal['files'].keys()), ['history.txt', 'master.tif', 'original-exif.json', 'original.jpg'])
+    master_mtime = os.path.getmtime(os.path.join(path, 'master.tif'))
+
+    # running it again picks up after the master, which is not made again
+    package.Package(temp, 'test_package', original_path)
+    assert_equals(os.path.isfile(journal_path), False)
+    assert_equals(os.path.getmtime(os.path.join(path, 'master.tif')), master_mtime)
+    with open(os.path.join(path, 'history.txt'), 'r') as f:
+        history = f.read()
+    assert_in('resumed creating package', history)
+    assert_equals(history.count('created master.tif'), 1)
+    assert_equals(package.Package(path).validate(), True)
+    # a finished package is not begun again
+    assert_raises(OSError, package.Package, temp, 'test_package', original_path)
+    shutil.rmtree(path)
+
+    # a file changed since the journal recorded it is made again, with every later stage
+    package.Package.make_derivatives = crash
+    try:
+        assert_raises(MemoryError, package.Package, temp, 'test_package', original_path)
+    finally:
+        package.Package.make_derivatives = make_derivatives
+    with open(os.path.join(path, 'master.tif'), 'ab') as f:
+        f.write('garbage')
+    assert_raises(ValueError, package.Package, temp, 'test_package', os.path.join(current, 'data', 'kalabsha', '201107061813531', 'original.jpg'))
+    package.Package(temp, 'test_package', original_path)
+    with open(os.path.join(path, 'history.txt'), 'r') as f:
+        assert_equals(f.read().count('created master.tif'), 2)
+    assert_equals(package.Package(path).validate(), True)
+    shutil.rmtree(temp)
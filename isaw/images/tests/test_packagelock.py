@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for the package locks in packagelock.py
+"""
+
+from isaw.images import manifest, metadata, packagelock
+import json
+import logging
+import multiprocessing
+from nose.tools import assert_equals, assert_is, assert_raises, assert_true
+import os
+import shutil
+import socket
+import time
+
+logging.basicConfig(level=logging.DEBUG)
+
+def __set_many__(args):
+    manifest_path, worker = args
+    m = manifest.Manifest(manifest_path)
+    for i in range(20):
+        m.set('{0}-{1}.txt'.format(worker, i), '{0:040x}'.format(i))
+
+def __set_own_key__(args):
+    meta_path, worker = args
+    m = metadata.Metadata(meta_path)
+    for i in range(10):
+        m.set('worker-{0}'.format(worker), str(i))
+
+def __write_lock__(lock_path, host, pid):
+    with open(lock_path, 'w') as f:
+        json.dump({'host': host, 'pid': pid, 'acquired': time.time()}, f)
+
+def test_package_lock():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    lock_path = os.path.join(temp, packagelock.LOCK_FILENAME)
+    lock = packagelock.get_lock(temp)
+    assert_is(packagelock.get_lock(os.path.join(temp, '.')), lock)
+
+    # re-entrant, and gone once the outermost holder lets go
+    with packagelock.locked(temp):
+        with packagelock.locked(temp):
+            assert_equals(os.path.isfile(lock_path), True)
+        assert_equals(lock.held(), True)
+    assert_equals(lock.held(), False)
+    assert_equals(os.path.isfile(lock_path), False)
+
+    # a lock held by a live process is waited for, up to the timeout
+    __write_lock__(lock_path, socket.gethostname(), os.getppid())
+    waiting = packagelock.PackageLock(temp, timeout=0.3)
+    assert_raises(IOError, waiting.acquire)
+    assert_equals(waiting.held(), False)
+
+    # a lock left by a dead process on this host is broken
+    process = multiprocessing.Process(target=time.sleep, args=(0,))
+    process.start()
+    process.join()
+    __write_lock__(lock_path, socket.gethostname(), process.pid)
+    with waiting:
+        with open(lock_path, 'r') as f:
+            assert_equals(json.load(f)['pid'], os.getpid())
+
+    # as is one from another host that has not been touched for too long
+    __write_lock__(lock_path, 'elsewhere', 1)
+    assert_raises(IOError, waiting.acquire)
+    os.utime(lock_path, (time.time() - 10, time.time() - 10))
+    with packagelock.PackageLock(temp, timeout=0.3, stale=5):
+        pass
+    assert_equals(os.listdir(temp), [])
+
+    # a long hold keeps the lock file fresh, so other hosts do not take it for stale
+    default = packagelock.HEARTBEAT
+    packagelock.HEARTBEAT = 0.05
+    try:
+        with packagelock.PackageLock(temp):
+            os.utime(lock_path, (time.time() - 1000, time.time() - 1000))
+            time.sleep(0.3)
+            assert_true(time.time() - os.path.getmtime(lock_path) < 100)
+    finally:
+        packagelock.HEARTBEAT = default
+
+    # a lock broken and taken by someone else is left to them on release
+    with packagelock.PackageLock(temp):
+        __write_lock__(lock_path, 'elsewhere', 1)
+    with open(lock_path, 'r') as f:
+        assert_equals(json.load(f)['host'], 'elsewhere')
+    os.remove(lock_path)
+    shutil.rmtree(temp)
+
+def test_concurrent_manifest_updates():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    manifest_path = os.path.join(temp, 'manifest-sha1.txt')
+    manifest.Manifest(manifest_path, create=True)
+    # each process sets its own files in the same manifest; none are lost
+    pool = multiprocessing.Pool(4)
+    try:
+        pool.map(__set_many__, [(manifest_path, worker) for worker in range(4)])
+    finally:
+        pool.close()
+        pool.join()
+    assert_equals(len(manifest.Manifest(manifest_path).get_all()), 80)
+    assert_equals(os.listdir(temp), ['manifest-sha1.txt'])
+    shutil.rmtree(temp)
+
+def test_concurrent_metadata_updates():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    meta_path = os.path.join(temp, 'meta.xml')
+    metadata.Metadata(meta_path, create=True)
+    # two editors with the file open: each writes only what it changed
+    a = metadata.Metadata(meta_path)
+    b = metadata.Metadata(meta_path)
+    a.set('title', 'A1')
+    a.set('title', 'A2')
+    b.set('status', 'ready')
+    assert_equals(b.data['title'], 'A2')
+    with a.session():
+        a.set('description', 'from a')
+    assert_equals(a.data['status'], 'ready')
+    data = metadata.Metadata(meta_path).data
+    assert_equals((data['title'], data['status'], data['description']), ('A2', 'ready', 'from a'))
+    # a key removed is taken out of the file
+    a.remove('description')
+    assert_equals('description' in metadata.Metadata(meta_path).data.keys(), False)
+
+    # each process sets its own key in the same file; none are lost
+    pool = multiprocessing.Pool(4)
+    try:
+        pool.map(__set_own_key__, [(meta_path, worker) for worker in range(4)])
+    finally:
+        pool.close()
+        pool.join()
+    data = metadata.Metadata(meta_path).data
+    assert_equals([data['worker-{0}'.format(worker)] for worker in range(4)], ['9'] * 4)
+    assert_equals((data['title'], data['status']), ('A2', 'ready'))
+    assert_equals(os.listdir(temp), ['meta.xml'])
+    shutil.rmtree(temp)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nosetests for pyramidal tiff writing and reading in pyramid.py
+"""
+
+from isaw.images import colormanagement, derivatives, package, pyramid
+import logging
+from nose.tools import assert_equals, assert_in, assert_is
+import os
+from PIL import Image, ImageChops
+from PIL.ImageCms import getOpenProfile
+import shutil
+
+logging.basicConfig(level=logging.DEBUG)
+
+def test_write_pyramid():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    image = Image.open(os.path.join(current, 'data', 'turkey_road.jpg'))
+    image.load()
+    icc_path = os.path.join(current, '..', 'icc', 'sRGB_v4_ICC_preference.icc')
+    icc_profile = getOpenProfile(icc_path).tobytes()
+    for compression in [None, 'deflate']:
+        path = os.path.join(temp, 'pyramid.tif')
+        assert_equals(pyramid.write_pyramid(image, path, icc_profile, compression=compression), [(800, 600), (400, 300), (200, 150)])
+
+        # the first page is the full image, readable by anything, with its profile
+        full = Image.open(path)
+        assert_equals(full.info['icc_profile'], icc_profile)
+        full.load()
+        assert_is(ImageChops.difference(full, image).getbbox(), None)
+        assert_equals(derivatives.levels(Image.open(path)), [(0, (800, 600)), (1, (400, 300)), (2, (200, 150))])
+        assert_equals(pyramid.read_level(path, 2).size, (200, 150))
+
+        # regions are assembled from the tiles they touch
+        box = (100, 50, 700, 333)
+        assert_is(ImageChops.difference(pyramid.read_region(path, box), image.crop(box)).getbbox(), None)
+        box = (10, 10, 390, 300)
+        assert_is(ImageChops.difference(pyramid.read_region(path, box, 1), pyramid.read_level(path, 1).crop(box)).getbbox(), None)
+    shutil.rmtree(temp)
+
+def test_write_pyramid_strips():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    image = Image.open(os.path.join(current, 'data', 'turkey_road.jpg'))
+    image.load()
+    # odd sizes, so that halving drops a row and column at some levels
+    image = image.crop((0, 0, 799, 555))
+    image_path = os.path.join(temp, 'image.tif')
+    image.save(image_path)
+    whole_path = os.path.join(temp, 'whole.tif')
+    strips_path = os.path.join(temp, 'strips.tif')
+    sizes = pyramid.write_pyramid(image, whole_path, tile_size=64)
+    assert_equals(sizes, [(799, 555), (399, 277), (199, 138), (99, 69), (49, 34)])
+    # strips of 37 rows, which do not line up with the tiles
+    strips = colormanagement.iter_strips(image_path, 799 * 3 * 37)
+    assert_equals(pyramid.write_pyramid_strips(strips, image.size, image.mode, strips_path, tile_size=64), sizes)
+    for level in range(len(sizes)):
+        assert_is(ImageChops.difference(pyramid.read_level(strips_path, level), pyramid.read_level(whole_path, level)).getbbox(), None)
+    assert_is(ImageChops.difference(pyramid.read_level(strips_path, 1), pyramid.halve(image, (399, 277))).getbbox(), None)
+    shutil.rmtree(temp)
+
+def test_create_with_pyramid():
+    current = os.path.dirname(os.path.abspath(__file__))
+    temp = os.path.join(current, 'temp')
+    os.makedirs(temp)
+    original_path = os.path.join(current, 'data', 'turkey_road.jpg')
+    p = package.Package()
+    p.create(temp, 'test_package', original_path, pyramid=True)
+    assert_in(package.PYRAMID_FILENAME, p.manifest.get_all().keys())
+    pyramid_path = os.path.join(temp, 'test_package', package.PYRAMID_FILENAME)
+    master = Image.open(os.path.join(temp, 'test_package', 'master.tif'))
+    assert_equals(Image.open(pyramid_path).info['icc_profile'], master.info['icc_profile'])
+    assert_equals(derivatives.open_reduced(pyramid_path, (128, 128)).size, (200, 150))
+    pp = package.Package(os.path.join(temp, 'test_package'))
+    assert_equals(pp.validate(), True)
+    # a master too big to convert whole gets its pyramid from master.tif in strips
+    default = package.MASTER_STRIP_BYTES
+    package.MASTER_STRIP_BYTES = 100000
+    try:
+        p = package.Package()
+        p.create(temp, 'strips_package', original_path, pyramid=True)
+    finally:
+        package.MASTER_STRIP_BYTES = default
+    strips_path = os.path.join(temp, 'strips_package', package.PYRAMID_FILENAME)
+    for level in range(3):
+        assert_is(ImageChops.difference(pyramid.read_level(strips_path, level), pyramid.read_level(pyramid_path, level)).getbbox(), None)
+    assert_equals(package.Package(os.path.join(temp, 'strips_package')).validate(), True)
+    shutil.rmtree(temp)